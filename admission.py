@@ -0,0 +1,216 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from flask import request, has_request_context
+
+from instrumentation import instrumentation
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+class RateLimited(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f'Too many requests ({reason}), retry in {retry_after:.1f}s')
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def retry_after_header(self):
+        # Whole seconds for the Retry-After header
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+def parse_limit(value):
+    # '20/minute' -> (20, 60): a bucket of 20 tokens refilled over a minute.
+    # Empty or '0' disables the limit.
+    if not value or value == '0':
+        return None
+    count, _, period = value.partition('/')
+    if period not in PERIODS or not count.isdigit() or int(count) < 1:
+        raise ValueError(f'Invalid rate limit {value!r}, expected e.g. "20/minute"')
+    return int(count), PERIODS[period]
+
+
+def _refill(tokens, updated, now, capacity, period):
+    return min(capacity, tokens + (now - updated) * capacity / period)
+
+
+class MemoryBackend:
+    # Per-process buckets, oldest evicted first once maxsize keys are held
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def consume(self, key, capacity, period):
+        # Returns 0 if a token was taken, otherwise seconds until one is available
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = _refill(tokens, updated, now, capacity, period)
+            retry_after = 0.0 if tokens >= 1 else (1 - tokens) * period / capacity
+            if not retry_after:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return retry_after
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBackend:
+    # Buckets in a small SQLite file shared by every worker on the host. Kept
+    # apart from the application database so limiter writes never queue behind
+    # application transactions.
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._purged_at = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS rate_buckets '
+            '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL, full_at REAL NOT NULL) '
+            'WITHOUT ROWID'
+        )
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def consume(self, key, capacity, period):
+        now = time.time()
+        conn = self._connection()
+        # IMMEDIATE takes the write lock up front, so concurrent workers cannot
+        # both read the same token count
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM rate_buckets WHERE key = ?', (key,)).fetchone()
+            tokens = _refill(row[0], row[1], now, capacity, period) if row else capacity
+            retry_after = 0.0 if tokens >= 1 else (1 - tokens) * period / capacity
+            if not retry_after:
+                tokens -= 1
+            conn.execute(
+                'INSERT OR REPLACE INTO rate_buckets (key, tokens, updated, full_at) VALUES (?, ?, ?, ?)',
+                (key, tokens, now, now + (capacity - tokens) * period / capacity)
+            )
+            if now - self._purged_at > self.PURGE_INTERVAL:
+                # Full buckets hold no state worth keeping
+                conn.execute('DELETE FROM rate_buckets WHERE full_at < ?', (now,))
+                self._purged_at = now
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return retry_after
+
+    def reset(self, key):
+        self._connection().execute('DELETE FROM rate_buckets WHERE key = ?', (key,))
+
+    def clear(self):
+        self._connection().execute('DELETE FROM rate_buckets')
+
+
+class AdmissionControl:
+    # Token-bucket rate limits for the login and registration forms and the
+    # waiting room's tickets, plus a cap
+    # on concurrent password hashing per worker. Requests over either limit are
+    # refused at once with a 429 instead of queueing behind a busy CPU.
+    def __init__(self, backend=None, limits=None, hash_concurrency=None, hash_wait=0.05):
+        self.backend = backend or MemoryBackend()
+        # name -> (capacity, period seconds)
+        self.limits = limits or {}
+        self.hash_wait = hash_wait
+        self._set_hash_concurrency(hash_concurrency or os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self.hashing_now = 0
+        self.hashing_peak = 0
+        self.rejected = 0
+
+    def init_app(self, app):
+        if app.config.get('RATE_LIMIT_BACKEND', 'memory') == 'sqlite':
+            self.backend = SQLiteBackend(
+                app.config.get('RATE_LIMIT_DB') or os.path.join(app.instance_path, 'rate_limit.db')
+            )
+        else:
+            self.backend = MemoryBackend()
+        self.limits = {}
+        for name in ('login_ip', 'login_user', 'register_ip', 'waiting_room_ip'):
+            limit = parse_limit(app.config.get(f'RATE_LIMIT_{name.upper()}'))
+            if limit:
+                self.limits[name] = limit
+        self._set_hash_concurrency(app.config.get('HASH_CONCURRENCY') or os.cpu_count() or 1)
+        self.hash_wait = app.config.get('HASH_QUEUE_TIMEOUT', self.hash_wait)
+        app.extensions['admission'] = self
+
+    def _set_hash_concurrency(self, slots):
+        self.hash_concurrency = slots
+        self._hash_slots = threading.BoundedSemaphore(slots)
+
+    def check(self, name, key):
+        # Takes a token from the `name` bucket for `key`; raises RateLimited when it is empty
+        limit = self.limits.get(name)
+        if limit is None or key is None:
+            return
+        retry_after = self.backend.consume(f'{name}:{key}', *limit)
+        if retry_after:
+            self._reject(name)
+            raise RateLimited(name, retry_after)
+
+    def reset(self, name, key):
+        if name in self.limits and key is not None:
+            self.backend.reset(f'{name}:{key}')
+
+    @contextmanager
+    def hashing(self, wait=None):
+        # Wrap password hashing and verification. Waits at most hash_wait seconds
+        # (or `wait`) for a free slot; past that the CPU is saturated and the
+        # request is refused.
+        if not self._hash_slots.acquire(timeout=self.hash_wait if wait is None else wait):
+            self._reject('hash_concurrency')
+            raise RateLimited('hash_concurrency', 1.0)
+        with self._lock:
+            self.hashing_now += 1
+            self.hashing_peak = max(self.hashing_peak, self.hashing_now)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.hashing_now -= 1
+            self._hash_slots.release()
+
+    def _reject(self, reason):
+        with self._lock:
+            self.rejected += 1
+        instrumentation.record_rejection(request.endpoint if has_request_context() else None, reason)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': type(self.backend).__name__,
+                'hash_concurrency': self.hash_concurrency,
+                'hashing': self.hashing_now,
+                'hashing_peak': self.hashing_peak,
+                'rejected': self.rejected,
+            }
+
+
+admission = AdmissionControl()
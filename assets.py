@@ -0,0 +1,239 @@
+import base64
+import gzip
+import hashlib
+import hmac
+import json
+import mimetypes
+import os
+import posixpath
+import re
+import urllib.request
+
+from flask import request, url_for, send_from_directory
+
+# Third-party files served from static/vendor once `flask vendor-assets` has
+# downloaded them; until then pages, and bundles built without them, fall back
+# to the CDN URL. Each is pinned to a digest in subresource-integrity form
+# (algorithm-base64); a download that does not match is refused.
+VENDOR = {
+    'vendor/bootstrap/bootstrap.min.css': (
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+        'sha256-fx038NkLY4U1TCrBDiu5FWPEa9eiZu01EiLryshJbCo=',
+    ),
+    'vendor/bootstrap/bootstrap.bundle.min.js': (
+        'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js',
+        'sha384-geWF76RCwLtnZ8qwWowPQNguL3RmwHVBC9FhGdlKrxdiJJigb/j/68SIy3Te4Bkz',
+    ),
+    'vendor/bootstrap-icons/bootstrap-icons.min.css': (
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/bootstrap-icons.min.css',
+        'sha256-9kPW/n5nn53j4WMRYAxe9c1rCY96Oogo/MKSVdKzPmI=',
+    ),
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff2': (
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff2',
+        'sha256-R2rfQrQDJQmPz6izarPnaRhrtPbOaiSXU+LhqcIr+Z4=',
+    ),
+    'vendor/bootstrap-icons/fonts/bootstrap-icons.woff': (
+        'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff',
+        'sha256-ux3pibg5cPb05U3hzZdMXLpVtzWC2l4bIlptDt8ClIM=',
+    ),
+}
+
+# Bundle name -> source files under static/, concatenated in order. Vendor
+# files come first, so one left on the CDN still loads before the bundle.
+BUNDLES = {
+    'css/app.css': [
+        'vendor/bootstrap/bootstrap.min.css',
+        'vendor/bootstrap-icons/bootstrap-icons.min.css',
+        'css/base.css',
+    ],
+    'js/app.js': [
+        'vendor/bootstrap/bootstrap.bundle.min.js',
+        'js/jobs.js',
+        'js/reference.js',
+        'js/waiting-room.js',
+    ],
+}
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt')
+# Manifest key listing, per bundle, the vendor files built without
+CDN_KEY = '_cdn'
+
+CSS_URL = re.compile(r'url\(\s*(?:"([^"]*)"|\'([^\']*)\'|([^\'"\s)]+))\s*\)')
+CSS_CHARSET = re.compile(r'@charset\s+"[^"]*";\s*')
+
+
+class AssetError(Exception):
+    pass
+
+
+def minify_css(css):
+    # Enough for the hand-written stylesheets; vendor files arrive minified
+    css = re.sub(r'/\*(?!!).*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip()
+
+
+def integrity(content, algorithm='sha256'):
+    return f'{algorithm}-{base64.b64encode(hashlib.new(algorithm, content).digest()).decode()}'
+
+
+def fingerprint(name, content):
+    root, extension = posixpath.splitext(name)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:12]}{extension}'
+
+
+class AssetPipeline:
+    # Builds fingerprinted, precompressed bundles into static/dist and serves them.
+    # Templates call asset_urls(bundle); without a build they get the source files.
+    def __init__(self, static_folder=None, max_age=31536000):
+        self.static_folder = static_folder
+        self.max_age = max_age
+        self.manifest = {}
+
+    @property
+    def dist_folder(self):
+        return os.path.join(self.static_folder, 'dist')
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.dist_folder, 'manifest.json')
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.max_age = app.config.get('ASSETS_MAX_AGE', self.max_age)
+        self.manifest = self._load_manifest()
+        app.add_template_global(self.asset_url, 'asset_url')
+        app.add_template_global(self.asset_urls, 'asset_urls')
+        app.extensions['assets'] = self
+
+    def asset_url(self, filename):
+        # url_for('static', filename=...) that prefers the fingerprinted build output
+        built = self.manifest.get(filename)
+        if built:
+            return url_for('main.asset', filename=built)
+        if filename in VENDOR and not os.path.exists(os.path.join(self.static_folder, filename)):
+            return VENDOR[filename][0]
+        return url_for('static', filename=filename)
+
+    def asset_urls(self, bundle):
+        if bundle in self.manifest:
+            cdn = self.manifest.get(CDN_KEY, {}).get(bundle, [])
+            return [VENDOR[source][0] for source in cdn] + [self.asset_url(bundle)]
+        return [self.asset_url(source) for source in BUNDLES[bundle]]
+
+    def send(self, filename):
+        # Serves dist files, preferring a precompressed variant the client accepts
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if encoding in request.accept_encodings and \
+                    os.path.isfile(os.path.join(self.dist_folder, filename + suffix)):
+                response = send_from_directory(self.dist_folder, filename + suffix,
+                                               mimetype=mimetype, max_age=self.max_age)
+                response.content_encoding = encoding
+                break
+        else:
+            response = send_from_directory(self.dist_folder, filename, mimetype=mimetype, max_age=self.max_age)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    def vendor(self, log=print):
+        # Downloads the pinned third-party files into static/. Nothing is
+        # written unless every file matches its digest.
+        downloaded = {}
+        for name, (source, expected) in VENDOR.items():
+            with urllib.request.urlopen(source, timeout=30) as response:
+                content = response.read()
+            actual = integrity(content, expected.split('-', 1)[0])
+            if not hmac.compare_digest(actual, expected):
+                raise AssetError(f'{source} does not match its pinned digest: expected {expected}, got {actual}')
+            downloaded[name] = content
+            log(f'{name}: {len(content)} bytes, {actual}, from {source}')
+        for name, content in downloaded.items():
+            path = os.path.join(self.static_folder, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(content)
+
+    def build(self, log=print):
+        missing = [name for sources in BUNDLES.values() for name in sources
+                   if not os.path.exists(os.path.join(self.static_folder, name))]
+        if any(name not in VENDOR for name in missing):
+            raise AssetError('Missing source files: ' + ', '.join(name for name in missing if name not in VENDOR))
+        if missing:
+            log('Not vendored, left on the CDN (run `flask vendor-assets` to bundle them): ' + ', '.join(missing))
+
+        manifest = {}
+        cdn = {}
+        for bundle, sources in BUNDLES.items():
+            cdn[bundle] = [source for source in sources if source in missing]
+            sources = [source for source in sources if source not in missing]
+            if bundle.endswith('.css'):
+                parts = [self._css_source(source, bundle, manifest) for source in sources]
+                content = ('@charset "UTF-8";' + '\n'.join(parts)).encode('utf-8')
+            else:
+                parts = []
+                for source in sources:
+                    with open(os.path.join(self.static_folder, source), encoding='utf-8') as f:
+                        parts.append(f.read().strip())
+                content = ';\n'.join(parts).encode('utf-8')
+            manifest[bundle] = self._write(bundle, content)
+            log(f'{bundle} -> {manifest[bundle]} ({len(content)} bytes)')
+        manifest[CDN_KEY] = {bundle: sources for bundle, sources in cdn.items() if sources}
+
+        # Earlier builds are kept so pages rendered before a deploy still load
+        with open(self.manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        self.manifest = manifest
+        return manifest
+
+    def _css_source(self, source, bundle, manifest):
+        with open(os.path.join(self.static_folder, source), encoding='utf-8') as f:
+            css = CSS_CHARSET.sub('', f.read())
+        if not source.endswith('.min.css'):
+            css = minify_css(css)
+
+        def rewrite(match):
+            # Fingerprint files referenced from the stylesheet and point at them
+            # relative to the bundle's location in dist/
+            reference = next(group for group in match.groups() if group is not None).strip()
+            if reference.startswith(('data:', 'http:', 'https:', '//', '#')):
+                return match.group(0)
+            target = posixpath.normpath(posixpath.join(posixpath.dirname(source), reference.split('?')[0].split('#')[0]))
+            if target not in manifest:
+                with open(os.path.join(self.static_folder, target), 'rb') as f:
+                    manifest[target] = self._write(target, f.read())
+            return f'url("{posixpath.relpath(manifest[target], posixpath.dirname(bundle))}")'
+
+        return CSS_URL.sub(rewrite, css)
+
+    def _write(self, name, content):
+        built = fingerprint(name, content)
+        path = os.path.join(self.dist_folder, built)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        if built.endswith(COMPRESSIBLE):
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(content, 9, mtime=0))
+            try:
+                import brotli
+            except ImportError:
+                brotli = None
+            if brotli is not None:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(content, quality=11))
+        return built
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+
+assets = AssetPipeline()
@@ -0,0 +1,330 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import date, datetime
+
+from flask import g, has_request_context, request
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session as OrmSession
+
+from models import db, AuditLog, User, Role, Session, SessionLevel, ApplicationSettings, State, Municipality
+from user_search import UserSearch
+
+ENTRIES = AuditLog.__table__
+
+# Admin-managed data; enrollments, jobs and counters change too often to be worth it
+AUDITED = (User, Role, Session, SessionLevel, ApplicationSettings, State, Municipality)
+# Table filter choices; 'locations' is the import of states and municipalities
+TABLES = sorted({model.__tablename__ for model in AUDITED} | {'locations'})
+# The key, already in row_id, and bookkeeping columns
+IGNORED = {'id', 'created_at', 'updated_at', 'username_norm', 'email_norm', 'name_norm', 'enrolled'}
+# Recorded as changed, without the values
+REDACTED = {'password_hash'}
+
+logger = logging.getLogger(__name__)
+
+
+def _value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def _changes(target, action):
+    # {"column": [before, after]} for the columns this flush wrote. Reads only
+    # loaded state, so a deleted row never triggers a query.
+    state = inspect(target)
+    changes = {}
+    for attr in state.mapper.column_attrs:
+        key = attr.key
+        if key in IGNORED:
+            continue
+        if action == 'update':
+            history = state.attrs[key].history
+            if not history.has_changes():
+                continue
+            before = history.deleted[0] if history.deleted else None
+            after = history.added[0] if history.added else None
+            if before == after:
+                continue
+        elif action == 'insert':
+            before, after = None, state.dict.get(key)
+            if after is None:
+                continue
+        else:
+            before, after = state.dict.get(key), None
+            if before is None:
+                continue
+        if key in REDACTED:
+            before, after = before and '***', after and '***'
+        changes[key] = [_value(before), _value(after)]
+    return changes
+
+
+def _privileged():
+    # Changes are captured from admin requests and from work outside a request,
+    # i.e. jobs and commands. Registrations and users' own changes are not.
+    # Admin views have loaded the user already to check their role.
+    if not has_request_context():
+        return True
+    user = g.get('_login_user')
+    return user is not None and user.is_authenticated and user.is_admin()
+
+
+def _context():
+    # Actor, endpoint and address of the current request, if any
+    if not has_request_context():
+        return {'actor_id': None, 'actor_name': None, 'endpoint': None, 'remote_addr': None}
+    # Whoever Flask-Login has already loaded; an audit entry never loads the user itself
+    user = g.get('_login_user')
+    authenticated = user is not None and user.is_authenticated
+    return {
+        'actor_id': user.id if authenticated else None,
+        'actor_name': user.username if authenticated else None,
+        'endpoint': request.endpoint,
+        'remote_addr': request.remote_addr,
+    }
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _capture(session, flush_context):
+    # Entries wait in session.info until the transaction commits, so rolled
+    # back changes are never logged
+    if not audit_log.enabled or not _privileged():
+        return
+    ignored = session.info.get('audit_ignored', ())
+    entries = []
+    for action, targets in (('insert', session.new), ('update', session.dirty), ('delete', session.deleted)):
+        for target in targets:
+            if not isinstance(target, AUDITED) or id(target) in ignored:
+                continue
+            changes = _changes(target, action)
+            if changes:
+                entries.append(audit_log.entry(action, target.__table__.name, target.id, changes))
+    if entries:
+        session.info.setdefault('audit_pending', []).extend(entries)
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _committed(session):
+    session.info.pop('audit_ignored', None)
+    entries = session.info.pop('audit_pending', None)
+    if entries:
+        audit_log.enqueue(entries)
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _rolled_back(session):
+    session.info.pop('audit_ignored', None)
+    session.info.pop('audit_pending', None)
+
+
+class AuditTrail:
+    # Audit log of admin changes, captured from ORM flushes and written off the
+    # request path: committed entries go to a bounded in-process queue and a
+    # writer thread inserts them in batches of up to batch_size, at least every
+    # flush_interval seconds. When the queue is full a request waits up to
+    # queue_timeout for room, then writes its own entries, so a slow database
+    # slows mutations down rather than losing entries. The queue is drained at exit.
+    def __init__(self, batch_size=200, flush_interval=1.0, queue_size=10000, queue_timeout=0.5,
+                 asynchronous=True, enabled=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        # Write entries in the request that committed them, e.g. for scripts
+        self.asynchronous = asynchronous
+        self.enabled = enabled
+        self.app = None
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writer = None
+        self._pid = None
+        self.queued = 0
+        self.written = 0
+        self.batches = 0
+        self.direct = 0
+        self.dropped = 0
+        atexit.register(self.close)
+
+    def init_app(self, app):
+        self.batch_size = app.config.get('AUDIT_BATCH_SIZE', self.batch_size)
+        self.flush_interval = app.config.get('AUDIT_FLUSH_INTERVAL', self.flush_interval)
+        self.queue_size = app.config.get('AUDIT_QUEUE_SIZE', self.queue_size)
+        self.queue_timeout = app.config.get('AUDIT_QUEUE_TIMEOUT', self.queue_timeout)
+        self.asynchronous = app.config.get('AUDIT_ASYNC', self.asynchronous)
+        self.enabled = app.config.get('AUDIT_ENABLED', self.enabled)
+        self.app = app
+        app.extensions['audit_log'] = self
+
+    def entry(self, action, table_name, row_id=None, changes=None, **context):
+        # One audit_log row; context overrides the request's actor, endpoint and address
+        row = _context()
+        row.update(context)
+        row.update(created_at=datetime.utcnow(), action=action, table_name=table_name, row_id=row_id,
+                   changes=json.dumps(changes or {}, default=str, sort_keys=True))
+        return row
+
+    def record(self, action, table_name, row_id=None, changes=None, **context):
+        # For changes made with Core statements, which no flush sees. Logged when
+        # the current transaction commits.
+        if self.enabled:
+            db.session.info.setdefault('audit_pending', []).append(
+                self.entry(action, table_name, row_id, changes, **context)
+            )
+
+    def ignore(self, target):
+        # Leaves target's changes out of the log until the transaction ends,
+        # e.g. a password re-hashed on login
+        db.session.info.setdefault('audit_ignored', set()).add(id(target))
+
+    def log(self, action, table_name, row_id=None, changes=None, **context):
+        # For work already committed over several transactions, e.g. a chunked import
+        if self.enabled:
+            self.enqueue([self.entry(action, table_name, row_id, changes, **context)])
+
+    def _start(self):
+        # The writer is started on first use and again in each forked worker,
+        # which inherits the queue but not the thread
+        with self._lock:
+            if self._writer is not None and self._pid == os.getpid() and self._writer.is_alive():
+                return self._queue
+            self._queue = queue.Queue(self.queue_size)
+            self._writer = threading.Thread(target=self._run, args=(self._queue,), name='audit-writer', daemon=True)
+            self._pid = os.getpid()
+            self._writer.start()
+            return self._queue
+
+    def enqueue(self, entries):
+        if not self.asynchronous:
+            self._write(entries)
+            return
+        pending = self._start()
+        for n, entry in enumerate(entries):
+            try:
+                pending.put(entry, timeout=self.queue_timeout)
+            except queue.Full:
+                # The writer is behind: write the rest here, in this request
+                self._write(entries[n:])
+                with self._lock:
+                    self.direct += len(entries) - n
+                return
+            with self._lock:
+                self.queued += 1
+
+    def _run(self, pending):
+        while True:
+            entry = pending.get()
+            if entry is None:
+                pending.task_done()
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    entry = pending.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+            self._write(batch, retries=3)
+            for _ in range(len(batch) + stop):
+                pending.task_done()
+            if stop:
+                return
+
+    def _write(self, entries, retries=0):
+        # One executemany INSERT in its own transaction, independent of the caller's
+        for attempt in range(retries + 1):
+            try:
+                with self.app.app_context(), db.engine.begin() as conn:
+                    conn.execute(db.insert(ENTRIES), entries)
+            except Exception:
+                if attempt < retries:
+                    time.sleep(0.5 * 2 ** attempt)
+                    continue
+                logger.exception('Dropping %d audit log entries', len(entries))
+                with self._lock:
+                    self.dropped += len(entries)
+                return
+            with self._lock:
+                self.written += len(entries)
+                self.batches += 1
+            return
+
+    def flush(self):
+        # Blocks until every queued entry has been written
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+    def close(self, timeout=10):
+        # Writes what is still queued and stops the writer; registered with atexit
+        with self._lock:
+            writer, pending = self._writer, self._queue
+            if writer is None or self._pid != os.getpid() or not writer.is_alive():
+                return
+            self._writer = None
+        pending.put(None)
+        writer.join(timeout)
+
+    def filter(self, query, since=None, until=None, actor=None, table_name=None):
+        # `actor` is a user id or a username; usernames match the copy in each
+        # entry, so deleted users' entries are still found
+        if since:
+            query = query.where(AuditLog.created_at >= since)
+        if until:
+            query = query.where(AuditLog.created_at < until)
+        if actor:
+            query = query.where(AuditLog.actor_id == int(actor) if actor.isdigit() else AuditLog.actor_name == actor)
+        if table_name:
+            query = query.where(AuditLog.table_name == table_name)
+        return query
+
+    def page(self, query, after=None, before=None, per_page=50):
+        # Keyset pagination, newest first, on (created_at, id) as for users; both
+        # filters are served by an index ending in (created_at, id)
+        if before:
+            created_at, entry_id = UserSearch.decode_cursor(before)
+            rows = db.session.execute(
+                query.where(db.tuple_(AuditLog.created_at, AuditLog.id) > (created_at, entry_id))
+                .order_by(AuditLog.created_at.asc(), AuditLog.id.asc()).limit(per_page + 1)
+            ).scalars().all()
+            has_newer = len(rows) > per_page
+            rows = list(reversed(rows[:per_page]))
+            newer = UserSearch.encode_cursor(rows[0]) if has_newer and rows else None
+            older = UserSearch.encode_cursor(rows[-1]) if rows else None
+            return rows, newer, older
+
+        if after:
+            created_at, entry_id = UserSearch.decode_cursor(after)
+            query = query.where(db.tuple_(AuditLog.created_at, AuditLog.id) < (created_at, entry_id))
+        rows = db.session.execute(
+            query.order_by(AuditLog.created_at.desc(), AuditLog.id.desc()).limit(per_page + 1)
+        ).scalars().all()
+        has_older = len(rows) > per_page
+        rows = rows[:per_page]
+        newer = UserSearch.encode_cursor(rows[0]) if after and rows else None
+        older = UserSearch.encode_cursor(rows[-1]) if has_older else None
+        return rows, newer, older
+
+    def stats(self):
+        with self._lock:
+            depth = self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+            return {
+                'queue_depth': depth,
+                'queued': self.queued,
+                'written': self.written,
+                'batches': self.batches,
+                'direct_writes': self.direct,
+                'dropped': self.dropped,
+            }
+
+
+audit_log = AuditTrail()
@@ -0,0 +1,139 @@
+# Cost of the audit log on admin mutations. Seeds a throwaway SQLite database
+# with --users students, then has --threads logged-in admin clients update
+# them through POST /users/<id>/update, once with the audit log off, once
+# writing each request's entries in that request and once through the batched
+# background writer. Reports updates/s and request latency for each, and how
+# long the writer took to drain its queue afterwards. Fails if an entry is
+# missing once the queue has drained.
+#
+#   python benchmarks/audit_log.py [--users N] [--threads N]
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def seed(users):
+    from ceilapp import create_app, init_db
+    from models import db, User, Role
+
+    with create_app({'AUDIT_ENABLED': False}).app_context():
+        init_db()
+        student_role_id = db.session.execute(db.select(Role.id).where(Role.name == 'Student')).scalar_one()
+        first_id = db.session.execute(db.select(db.func.max(User.id))).scalar() + 1
+        db.session.execute(db.insert(User), [
+            {'id': first_id + n, 'username': f'audit{first_id + n}', 'email': f'audit{first_id + n}@example.com',
+             'role_id': student_role_id}
+            for n in range(users)
+        ])
+        db.session.commit()
+    return list(range(first_id, first_id + users)), student_role_id
+
+
+def run(label, config, user_ids, role_id, threads):
+    from ceilapp import create_app
+    from models import db, AuditLog
+    from audit import audit_log
+
+    app = create_app(config)
+    with app.app_context():
+        before = db.session.execute(db.select(db.func.count(AuditLog.id))).scalar()
+    batches = audit_log.stats()['batches']
+
+    latencies = []
+    lock = threading.Lock()
+    shares = [user_ids[n::threads] for n in range(threads)]
+
+    def loop(share):
+        client = app.test_client()
+        client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+        for user_id in share:
+            started = time.perf_counter()
+            response = client.post(f'/users/{user_id}/update', data={
+                'name': f'{label} {user_id}', 'email': f'audit{user_id}@example.com',
+                'role_id': role_id, 'is_active': 'on',
+            })
+            elapsed = time.perf_counter() - started
+            assert response.status_code == 302, response.status_code
+            with lock:
+                latencies.append(elapsed)
+
+    workers = [threading.Thread(target=loop, args=(share,)) for share in shares]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    drain_started = time.perf_counter()
+    audit_log.flush()
+    drained = time.perf_counter() - drain_started
+    batches = audit_log.stats()['batches'] - batches
+    audit_log.close()
+
+    with app.app_context():
+        logged = db.session.execute(db.select(db.func.count(AuditLog.id))).scalar() - before
+    return {
+        'label': label,
+        'rate': len(latencies) / elapsed,
+        'p50': percentile(latencies, 0.50) * 1000,
+        'p95': percentile(latencies, 0.95) * 1000,
+        'p99': percentile(latencies, 0.99) * 1000,
+        'drained': drained * 1000,
+        'logged': logged,
+        'batches': batches,
+        'expected': len(user_ids) if config.get('AUDIT_ENABLED', True) else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000, help='users updated in each run')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent admin clients')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp(prefix='ceilapp-audit-')
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{os.path.join(db_dir, "audit.db")}',
+        'SECRET_KEY': 'audit-benchmark',
+        # Logins are not what is measured
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+        'RATE_LIMIT_LOGIN_IP': '',
+        'DB_POOL_SIZE': str(args.threads + 1),
+    })
+    user_ids, role_id = seed(args.users)
+
+    rows = [
+        run('off', {'AUDIT_ENABLED': False}, user_ids, role_id, args.threads),
+        run('inline', {'AUDIT_ASYNC': False}, user_ids, role_id, args.threads),
+        run('batched', {'AUDIT_ASYNC': True}, user_ids, role_id, args.threads),
+    ]
+    print(f'{args.users} user updates from {args.threads} admin clients per run')
+    print(f'{"audit log":<10} {"updates/s":>10} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"drain ms":>9} {"entries":>8} {"batches":>8}')
+    failures = []
+    for r in rows:
+        print(f'{r["label"]:<10} {r["rate"]:>10.0f} {r["p50"]:>8.1f} {r["p95"]:>8.1f} {r["p99"]:>8.1f} '
+              f'{r["drained"]:>9.1f} {r["logged"]:>8} {r["batches"]:>8}')
+        if r['logged'] != r['expected']:
+            failures.append(f'{r["label"]}: {r["logged"]} entries for {r["expected"]} updates')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# Cold-start budget for a fresh worker: import + create_app() + first request,
+# each measured in a new interpreter against an initialised throwaway database.
+# Fails if startup runs any SQL or hashes any password, or exceeds the budget.
+#
+#   python benchmarks/cold_start.py [--runs N] [--budget-ms MS]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def measure():
+    started = time.perf_counter()
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    statements = []
+    event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    import passwords
+    hashes = []
+    generate = passwords.generate_password_hash
+    passwords.generate_password_hash = lambda *args: hashes.append(1) or generate(*args)
+
+    import ceilapp
+    imported = time.perf_counter()
+    app = ceilapp.create_app()
+    created = time.perf_counter()
+    startup_statements, startup_hashes = len(statements), len(hashes)
+
+    response = app.test_client().get('/')
+    first_request = time.perf_counter()
+
+    print(json.dumps({
+        'import_ms': (imported - started) * 1000,
+        'create_app_ms': (created - imported) * 1000,
+        'first_request_ms': (first_request - created) * 1000,
+        'total_ms': (first_request - started) * 1000,
+        'startup_statements': startup_statements,
+        'startup_hashes': startup_hashes,
+        'status': response.status_code,
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--budget-ms', type=float, default=1000.0)
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure()
+        return
+
+    env = dict(os.environ)
+    env.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(tempfile.mkdtemp(prefix="ceilapp-cold-"), "cold.db")}')
+    env['SECRET_KEY'] = 'cold-start'
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'ceilapp', 'init-db'],
+                   env=env, cwd=ROOT, check=True, capture_output=True)
+
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure'],
+                                env=env, cwd=ROOT, check=True, capture_output=True, text=True)
+        runs.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    for key in ('import_ms', 'create_app_ms', 'first_request_ms', 'total_ms'):
+        values = [run[key] for run in runs]
+        print(f'{key:<18} median {statistics.median(values):8.1f}   max {max(values):8.1f}')
+    statements = max(run['startup_statements'] for run in runs)
+    hashes = max(run['startup_hashes'] for run in runs)
+    print(f'{"startup SQL":<18} {statements}')
+    print(f'{"startup hashes":<18} {hashes}')
+
+    median_total = statistics.median(run['total_ms'] for run in runs)
+    failed = (statements or hashes or median_total > args.budget_ms
+              or any(run['status'] != 200 for run in runs))
+    print(f'budget {args.budget_ms:.0f} ms: {"FAIL" if failed else "ok"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
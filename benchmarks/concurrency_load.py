@@ -0,0 +1,164 @@
+# Concurrent /register + /login load test against a threaded WSGI server.
+# Reports throughput, latency, failed requests and "database is locked" errors
+# for each database backend given (default: a throwaway SQLite file).
+#
+#   python benchmarks/concurrency_load.py [--database-url URL ...] [--threads N] [--iterations N]
+#
+# e.g. --database-url sqlite:////tmp/load.db --database-url postgresql://ceil@localhost/ceil_load
+import argparse
+import http.cookiejar
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def client(base_url, run_id, thread_id, iterations, results):
+    opener = urllib.request.build_opener(
+        NoRedirect, urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+    )
+
+    def post(path, data, expected):
+        started = time.perf_counter()
+        try:
+            response = opener.open(base_url + path, urllib.parse.urlencode(data).encode())
+            status, location = response.status, response.headers.get('Location', '')
+        except urllib.error.HTTPError as e:
+            status, location = e.code, e.headers.get('Location', '')
+        elapsed = time.perf_counter() - started
+        results.append((path, elapsed, status in (301, 302, 303) and location.endswith(expected)))
+
+    for i in range(iterations):
+        username = f'load-{run_id}-{thread_id}-{i}'
+        post('/register', {
+            'username': username, 'email': f'{username}@example.com',
+            'password': 'secret', 'confirm_password': 'secret'
+        }, '/login')
+        post('/login', {'username': username, 'password': 'secret'}, '/dashboard')
+        # Log out so the next registration is not redirected to the dashboard
+        try:
+            opener.open(base_url + '/logout')
+        except urllib.error.HTTPError:
+            pass
+
+
+def run_worker(args):
+    os.environ['DATABASE_URL'] = args.worker
+    os.environ['PASSWORD_HASH_METHOD'] = args.hash_method
+    # Every client shares one address; measure the database, not the rate limits
+    for name in ('RATE_LIMIT_LOGIN_IP', 'RATE_LIMIT_LOGIN_USER', 'RATE_LIMIT_REGISTER_IP',
+                 'RATE_LIMIT_WAITING_ROOM_IP'):
+        os.environ[name] = ''
+    # Queue for the hashing slots rather than being refused with a 429
+    os.environ['HASH_QUEUE_TIMEOUT'] = '60'
+    # Every client registers at once; measure the database, not the waiting room
+    os.environ['WAITING_ROOM_RATE'] = '0'
+
+    from sqlalchemy import event
+    from werkzeug.serving import make_server
+
+    from ceilapp import create_app, init_db
+    from database import pool_metrics
+    from models import db
+
+    app = create_app()
+    lock_errors = []
+    with app.app_context():
+        init_db()
+        engine = db.engine
+
+    @event.listens_for(engine, 'handle_error')
+    def count_lock_errors(context):
+        if 'database is locked' in str(context.original_exception):
+            lock_errors.append(1)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    pool_metrics.reset()
+    results = []
+    run_id = uuid.uuid4().hex[:8]
+    threads = [
+        threading.Thread(target=client, args=(base_url, run_id, n, args.iterations, results))
+        for n in range(args.threads)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    latencies = [latency for _, latency, _ in results]
+    print(json.dumps({
+        'backend': engine.dialect.name,
+        'requests': len(results),
+        'failed': sum(1 for _, _, ok in results if not ok),
+        'lock_errors': len(lock_errors),
+        'throughput': round(len(results) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+        'pool': pool_metrics.stats(),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--database-url', action='append', dest='urls')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--iterations', type=int, default=10, help='register+login pairs per thread')
+    parser.add_argument('--hash-method', default='pbkdf2:sha256:1000',
+                        help='cheap by default so the database, not hashing, is the bottleneck')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    urls = args.urls or [f'sqlite:///{os.path.join(tempfile.mkdtemp(prefix="ceilapp-load-"), "load.db")}']
+    print(f'{"backend":<10} {"requests":>8} {"failed":>7} {"locked":>7} {"req/s":>8} '
+          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max wait ms":>12}')
+    for url in urls:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', url,
+             '--threads', str(args.threads), '--iterations', str(args.iterations),
+             '--hash-method', args.hash_method],
+            capture_output=True, text=True, cwd=ROOT
+        )
+        lines = [line for line in output.stdout.splitlines() if line.startswith('{')]
+        if output.returncode or not lines:
+            print(f'{url}: failed\n{output.stderr[-2000:]}')
+            continue
+        r = json.loads(lines[-1])
+        print(f'{r["backend"]:<10} {r["requests"]:>8} {r["failed"]:>7} {r["lock_errors"]:>7} {r["throughput"]:>8} '
+              f'{r["p50_ms"]:>8} {r["p95_ms"]:>8} {r["p99_ms"]:>8} {r["pool"]["max_wait"] * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
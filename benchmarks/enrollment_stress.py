@@ -0,0 +1,279 @@
+# Seat allocation stress test. Seeds a throwaway SQLite database with one
+# session, a few small levels and --claims students, then has --processes
+# worker processes with --threads threads each claim seats for all of them at
+# once. Some claims are sent twice with the same idempotency key from two
+# threads, as a client retrying a lost response would. Once a process has sent
+# its claims it cancels a share of them, again from all its threads, so freed
+# seats are promoted from the waiting lists while other processes still claim.
+# A share of the students (--late-rate) only claims during that phase, one late
+# claim after each cancel, so claims that find a level full race the
+# cancellations freeing its seats.
+#
+# Reports claims/s and claim latency, then checks the result: no level holds
+# more students than its capacity, each level's seat counter matches its
+# enrolled rows, nobody waits while a seat is free, waiting lists were promoted
+# in order, every student holds at most one place, and a repeated key always
+# returned the first claim's enrollment. Exits with status 1 if any check fails.
+#
+#   python benchmarks/enrollment_stress.py [--claims N] [--processes N] [--threads N] [--levels N] [--capacity N]
+import argparse
+import json
+import os
+import queue
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def seed(args):
+    from ceilapp import create_app, init_db
+    from models import db, User, Role, Session, SessionLevel
+
+    with create_app().app_context():
+        init_db()
+        session = Session(code='STRESS', name='Stress', name_ar='Stress',
+                          start_date=date.today(), end_date=date.today())
+        db.session.add(session)
+        db.session.flush()
+        for n in range(args.levels):
+            db.session.add(SessionLevel(session_id=session.id, level=f'Level {n + 1}', capacity=args.capacity))
+        student_role_id = db.session.execute(db.select(Role.id).where(Role.name == 'Student')).scalar_one()
+        first_id = db.session.execute(db.select(db.func.max(User.id))).scalar() + 1
+        db.session.execute(db.insert(User), [
+            {'id': first_id + n, 'username': f'stress{n}', 'email': f'stress{n}@example.com', 'role_id': student_role_id}
+            for n in range(args.claims)
+        ])
+        db.session.commit()
+        level_ids = db.session.execute(
+            db.select(SessionLevel.id).where(SessionLevel.session_id == session.id)
+        ).scalars().all()
+    return list(range(first_id, first_id + args.claims)), level_ids
+
+
+def run_worker(args):
+    # One process: claims seats for its share of the students from --threads threads
+    from ceilapp import create_app
+    from enrollment import seat_allocator
+
+    tasks = json.loads(sys.stdin.read())
+    app = create_app()
+    work = queue.Queue()
+    late = queue.Queue()
+    for task in tasks:
+        # A retried claim is queued twice in a row, so two threads send it at once
+        for _ in range(2 if task['retry'] else 1):
+            (late if task['late'] else work).put(task)
+
+    lock = threading.Lock()
+    latencies = []
+    cancel_latencies = []
+    late_latencies = []
+    errors = []
+    by_key = {}
+    mismatched = []
+    start = threading.Barrier(args.threads)
+    claimed = threading.Barrier(args.threads)
+    cancels = queue.Queue()
+    phases = {}
+
+    def timed(f, *args):
+        started = time.perf_counter()
+        try:
+            return f(*args), time.perf_counter() - started
+        except Exception as e:
+            with lock:
+                errors.append(f'{type(e).__name__}: {e}'[:200])
+            return None, None
+
+    def claim(task, timings):
+        with app.app_context():
+            result, elapsed = timed(seat_allocator.claim, task['level_id'], task['user_id'], task['key'])
+            if result is None:
+                return
+            enrollment_id = result[0].id
+        with lock:
+            timings.append(elapsed)
+            first = by_key.setdefault(task['key'], enrollment_id)
+            if first != enrollment_id:
+                mismatched.append(task['key'])
+            elif task['cancel'] and not task.get('queued'):
+                task['queued'] = True
+                cancels.put(enrollment_id)
+
+    def loop():
+        start.wait()
+        while True:
+            try:
+                task = work.get_nowait()
+            except queue.Empty:
+                break
+            claim(task, latencies)
+
+        if claimed.wait() == 0:
+            phases['claimed_at'] = time.time()
+        while not (cancels.empty() and late.empty()):
+            try:
+                enrollment_id = cancels.get_nowait()
+            except queue.Empty:
+                pass
+            else:
+                with app.app_context():
+                    result, elapsed = timed(seat_allocator.cancel, enrollment_id)
+                if result is not None:
+                    with lock:
+                        cancel_latencies.append(elapsed)
+            try:
+                claim(late.get_nowait(), late_latencies)
+            except queue.Empty:
+                pass
+
+    threads = [threading.Thread(target=loop) for _ in range(args.threads)]
+    started_at = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps({'latencies': latencies, 'cancel_latencies': cancel_latencies,
+                      'late_latencies': late_latencies, 'errors': errors, 'mismatched': mismatched,
+                      'started_at': started_at, 'claimed_at': phases['claimed_at'],
+                      'stats': seat_allocator.stats()}))
+
+
+def verify(level_ids):
+    # Returns a list of failed checks
+    from ceilapp import create_app
+    from models import db, SessionLevel, Enrollment
+
+    failures = []
+    with create_app().app_context():
+        for level in db.session.execute(db.select(SessionLevel).where(SessionLevel.id.in_(level_ids))).scalars():
+            counts = dict(db.session.execute(
+                db.select(Enrollment.status, db.func.count())
+                .where(Enrollment.session_level_id == level.id).group_by(Enrollment.status)
+            ).all())
+            enrolled = counts.get('enrolled', 0)
+            waitlisted = counts.get('waitlisted', 0)
+            print(f'{level.level}: {enrolled}/{level.capacity} enrolled, {waitlisted} waiting, '
+                  f'{counts.get("cancelled", 0)} cancelled')
+            if enrolled > level.capacity:
+                failures.append(f'{level.level} is overbooked: {enrolled} > {level.capacity}')
+            if level.enrolled != enrolled:
+                failures.append(f'{level.level} seat counter {level.enrolled} != {enrolled} enrolled rows')
+            if waitlisted and enrolled < level.capacity:
+                failures.append(f'{level.level} has free seats while {waitlisted} students wait')
+            # Promotion takes the lowest ids first, so every promoted claim is
+            # older than every claim still waiting
+            last_promoted = db.session.execute(
+                db.select(db.func.max(Enrollment.id))
+                .where(Enrollment.session_level_id == level.id, Enrollment.promoted_at.isnot(None))
+            ).scalar()
+            first_waiting = db.session.execute(
+                db.select(db.func.min(Enrollment.id))
+                .where(Enrollment.session_level_id == level.id, Enrollment.status == 'waitlisted')
+            ).scalar()
+            if last_promoted and first_waiting and last_promoted > first_waiting:
+                failures.append(f'{level.level} promoted enrollment {last_promoted} ahead of {first_waiting}')
+
+        duplicates = db.session.execute(
+            db.select(Enrollment.user_id).where(Enrollment.status.in_(('enrolled', 'waitlisted')))
+            .group_by(Enrollment.session_id, Enrollment.user_id).having(db.func.count() > 1)
+        ).scalars().all()
+        if duplicates:
+            failures.append(f'{len(duplicates)} students hold more than one place')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--claims', type=int, default=5000, help='students, each claiming one seat')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=16, help='concurrent claims per process')
+    parser.add_argument('--levels', type=int, default=5)
+    parser.add_argument('--capacity', type=int, default=200, help='seats per level')
+    parser.add_argument('--retry-rate', type=float, default=0.1, help='share of claims sent twice with one key')
+    parser.add_argument('--cancel-rate', type=float, default=0.1, help='share of claims cancelled again')
+    parser.add_argument('--late-rate', type=float, default=0.1, help='share of claims sent while others cancel')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    db_dir = tempfile.mkdtemp(prefix='ceilapp-enrollment-')
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{os.path.join(db_dir, "enrollment.db")}',
+        'SECRET_KEY': 'enrollment-stress',
+        # Enough connections that threads wait on the database, not the pool
+        'DB_POOL_SIZE': str(args.threads),
+    })
+    user_ids, level_ids = seed(args)
+
+    rng = random.Random(args.seed)
+    tasks = [{'user_id': user_id, 'level_id': rng.choice(level_ids), 'key': f'claim-{user_id}',
+              'retry': rng.random() < args.retry_rate, 'cancel': rng.random() < args.cancel_rate,
+              'late': rng.random() < args.late_rate}
+             for user_id in user_ids]
+    shares = [tasks[n::args.processes] for n in range(args.processes)]
+
+    command = [sys.executable, os.path.abspath(__file__), '--worker', '--threads', str(args.threads)]
+    workers = [subprocess.Popen(command, cwd=ROOT, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, text=True) for _ in shares]
+    outputs = [worker.communicate(json.dumps(share)) for worker, share in zip(workers, shares)]
+
+    results = []
+    for worker, (stdout, stderr) in zip(workers, outputs):
+        lines = [line for line in stdout.splitlines() if line.startswith('{')]
+        if worker.returncode or not lines:
+            raise SystemExit(f'worker failed\n{stderr[-2000:]}')
+        results.append(json.loads(lines[-1]))
+
+    # From the first worker starting its claims to the last one sending its last claim
+    elapsed = max(r['claimed_at'] for r in results) - min(r['started_at'] for r in results)
+    latencies = [latency for r in results for latency in r['latencies']]
+    errors = [error for r in results for error in r['errors']]
+    totals = {name: sum(r['stats'][name] for r in results) for name in results[0]['stats']}
+    seats = args.levels * args.capacity
+    print(f'{len(latencies)} claims ({totals["replayed"]} replayed) for {seats} seats from '
+          f'{args.processes} processes x {args.threads} threads in {elapsed:.2f}s')
+    print(f'{len(latencies) / elapsed:.0f} claims/s   p50 {percentile(latencies, 0.50) * 1000:.1f} ms   '
+          f'p95 {percentile(latencies, 0.95) * 1000:.1f} ms   p99 {percentile(latencies, 0.99) * 1000:.1f} ms')
+    cancel_latencies = [latency for r in results for latency in r['cancel_latencies']]
+    print(f'{len(cancel_latencies)} cancels   p50 {percentile(cancel_latencies, 0.50) * 1000:.1f} ms   '
+          f'p95 {percentile(cancel_latencies, 0.95) * 1000:.1f} ms')
+    late_latencies = [latency for r in results for latency in r['late_latencies']]
+    print(f'{len(late_latencies)} late claims during the cancels   p50 {percentile(late_latencies, 0.50) * 1000:.1f} ms   '
+          f'p95 {percentile(late_latencies, 0.95) * 1000:.1f} ms')
+    print(f'{totals["enrolled"]} seated, {totals["waitlisted"]} waitlisted, {totals["cancelled"]} cancelled, '
+          f'{totals["promoted"]} promoted, {len(errors)} errors')
+
+    failures = verify(level_ids)
+    mismatched = sum(len(r['mismatched']) for r in results)
+    if mismatched:
+        failures.append(f'{mismatched} retried claims returned a different enrollment')
+    if errors:
+        failures.append(f'{len(errors)} claims or cancels failed, e.g. {errors[0]}')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    if failures:
+        sys.exit(1)
+    print('OK: no level overbooked, counters consistent, waiting lists in order, retries idempotent')
+
+
+if __name__ == '__main__':
+    main()
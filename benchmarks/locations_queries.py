@@ -0,0 +1,96 @@
+# Query-count regression check for /locations against a full national dataset
+# (58 states, 1,541 municipalities) in a throwaway SQLite database.
+# Exits non-zero when the page needs more than MAX_STATEMENTS statements, or
+# when a state's municipality count on the page differs from the table's.
+#
+#   python benchmarks/locations_queries.py
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DB_DIR = tempfile.mkdtemp(prefix='ceilapp-bench-')
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(DB_DIR, "bench.db")}'
+
+from sqlalchemy import event
+
+from ceilapp import create_app, init_db
+from dashboard_stats import dashboard_stats
+from models import db, State, Municipality
+
+STATES = 58
+MUNICIPALITIES = 1541
+MAX_STATEMENTS = 4
+# State id and the fourth cell, the municipality count, of each row of the states table
+STATE_ROW = re.compile(r'data-state-id="(\d+)".*?(?:<td>.*?</td>\s*){3}<td>(\d+)</td>', re.S)
+
+
+app = create_app()
+
+
+def seed():
+    with app.app_context():
+        init_db()
+        db.session.execute(db.insert(State), [
+            {'code': f'{n:02d}', 'name': f'State {n}', 'name_ar': f'ولاية {n}'}
+            for n in range(1, STATES + 1)
+        ])
+        db.session.execute(db.insert(Municipality), [
+            {'name': f'Municipality {n}', 'name_ar': f'بلدية {n}', 'state_id': n % STATES + 1}
+            for n in range(MUNICIPALITIES)
+        ])
+        db.session.commit()
+        # Core inserts bypass the ORM events that keep the per-state counters
+        dashboard_stats.recompute()
+
+
+def main():
+    seed()
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    client.get('/locations')  # warm settings and user caches
+
+    statements = []
+    with app.app_context():
+        engine = db.engine
+
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', record)
+    started = time.perf_counter()
+    response = client.get('/locations')
+    elapsed = time.perf_counter() - started
+    event.remove(engine, 'before_cursor_execute', record)
+
+    print(f'status:     {response.status_code}')
+    print(f'statements: {len(statements)} (budget {MAX_STATEMENTS})')
+    print(f'size:       {len(response.data) / 1024:.1f} KiB')
+    print(f'time:       {elapsed * 1000:.1f} ms')
+
+    with app.app_context():
+        expected = {state_id: 0 for state_id in db.session.execute(db.select(State.id)).scalars()}
+        expected.update(db.session.execute(
+            db.select(Municipality.state_id, db.func.count()).group_by(Municipality.state_id)
+        ).all())
+    rendered = {int(state_id): int(count) for state_id, count in STATE_ROW.findall(response.get_data(as_text=True))}
+    wrong = {state_id: (rendered.get(state_id), count) for state_id, count in expected.items()
+             if rendered.get(state_id) != count}
+    print(f'counts:     {len(expected) - len(wrong)}/{len(expected)} states correct')
+
+    failed = False
+    if response.status_code != 200 or len(statements) > MAX_STATEMENTS:
+        for statement in statements:
+            print('  ' + ' '.join(statement.split())[:120])
+        failed = True
+    for state_id, (shown, count) in sorted(wrong.items())[:10]:
+        print(f'  state {state_id}: page shows {shown}, table has {count}')
+    if failed or wrong:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
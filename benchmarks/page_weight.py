@@ -0,0 +1,101 @@
+# Page weight of / and /dashboard: the HTML plus every stylesheet and script it
+# loads, as transferred with gzip/brotli, and how many of those requests are
+# render-blocking or go to another origin. Local files are fetched through the
+# test client; CDN files only with --fetch-external.
+#
+#   python benchmarks/page_weight.py [--fetch-external] [--json]
+#
+# Compare before/after `flask vendor-assets && flask build-assets`.
+import argparse
+import contextlib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DB_DIR = tempfile.mkdtemp(prefix='ceilapp-bench-')
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(DB_DIR, "bench.db")}'
+
+from ceilapp import create_app, init_db
+
+PAGES = ['/', '/dashboard']
+ACCEPT_ENCODING = 'br, gzip'
+STYLESHEET = re.compile(r'<link[^>]+rel="stylesheet"[^>]+href="([^"]+)"|<link[^>]+href="([^"]+)"[^>]+rel="stylesheet"')
+SCRIPT = re.compile(r'<script[^>]+src="([^"]+)"')
+
+
+def fetch_external(url):
+    request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return len(response.read())
+
+
+def measure(client, page, fetch):
+    started = time.perf_counter()
+    response = client.get(page, headers={'Accept-Encoding': ACCEPT_ENCODING})
+    html = response.get_data(as_text=True)
+
+    stylesheets = [a or b for a, b in STYLESHEET.findall(html)]
+    scripts = SCRIPT.findall(html)
+    assets, external = [], []
+    for url in stylesheets + scripts:
+        if url.startswith(('http:', 'https:', '//')):
+            external.append(url)
+            size = fetch_external(url) if fetch else None
+        else:
+            asset = client.get(url, headers={'Accept-Encoding': ACCEPT_ENCODING})
+            size = len(asset.data)
+        assets.append({'url': url, 'bytes': size, 'render_blocking': url in stylesheets})
+    elapsed = time.perf_counter() - started
+
+    known = [asset['bytes'] for asset in assets if asset['bytes'] is not None]
+    return {
+        'status': response.status_code,
+        'html_bytes': len(response.data),
+        'requests': 1 + len(assets),
+        'render_blocking_requests': 1 + sum(asset['render_blocking'] for asset in assets),
+        'external_requests': len(external),
+        'external_origins': len({url.split('/')[2] for url in external}),
+        'asset_bytes': sum(known),
+        'unmeasured_assets': len(assets) - len(known),
+        'local_ms': round(elapsed * 1000, 1),
+        'assets': assets,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fetch-external', action='store_true', help='download CDN files to count their size')
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.app_context(), contextlib.redirect_stdout(sys.stderr):
+        init_db()
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+
+    results = {}
+    for page in PAGES:
+        # Anonymous home page, logged-in dashboard
+        page_client = app.test_client() if page == '/' else client
+        measure(page_client, page, False)  # warm caches
+        results[page] = measure(page_client, page, args.fetch_external)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f'{"page":<12} {"html":>8} {"assets":>9} {"requests":>9} {"blocking":>9} {"external":>9} {"local ms":>9}')
+    for page, r in results.items():
+        assets = f'{r["asset_bytes"] / 1024:.1f}K' + ('+?' if r['unmeasured_assets'] else '')
+        print(f'{page:<12} {r["html_bytes"] / 1024:>7.1f}K {assets:>9} {r["requests"]:>9} '
+              f'{r["render_blocking_requests"]:>9} {r["external_requests"]:>9} {r["local_ms"]:>9}')
+
+
+if __name__ == '__main__':
+    main()
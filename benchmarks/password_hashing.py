@@ -0,0 +1,59 @@
+# Hashing cost per method: logins/sec on one core and batch hashing throughput
+# through the process pool, to pick PASSWORD_HASH_METHOD / PASSWORD_HASH_WORKERS.
+#
+#   python benchmarks/password_hashing.py [method ...] [--seconds N] [--batch N]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from passwords import PasswordHasher
+
+DEFAULT_METHODS = [
+    'scrypt:32768:8:1',
+    'scrypt:16384:8:1',
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha256:260000',
+]
+
+
+def logins_per_sec(hasher, seconds):
+    # A login is one verification of a stored hash
+    password_hash = hasher.hash('correct horse battery staple')
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        hasher.verify(password_hash, 'correct horse battery staple')
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def batch_hashes_per_sec(hasher, batch):
+    passwords = [f'password-{i}' for i in range(batch)]
+    hasher.hash_many(passwords[:hasher.batch_threshold])  # start the pool
+    started = time.perf_counter()
+    hasher.hash_many(passwords)
+    return batch / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('methods', nargs='*', default=DEFAULT_METHODS)
+    parser.add_argument('--seconds', type=float, default=2.0, help='time spent per login measurement')
+    parser.add_argument('--batch', type=int, default=256, help='passwords hashed per batch measurement')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    print(f'{"method":<24} {"ms/login":>9} {"logins/s/core":>14} {"batch/s (" + str(args.workers) + " procs)":>20}')
+    for method in args.methods:
+        hasher = PasswordHasher(method=method, workers=args.workers)
+        per_core = logins_per_sec(hasher, args.seconds)
+        batch = batch_hashes_per_sec(hasher, args.batch)
+        hasher.shutdown()
+        print(f'{method:<24} {1000 / per_core:>9.1f} {per_core:>14.1f} {batch:>20.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Queries per request for authenticated pages, with the legacy ORM user loader
+# ("before") and the principal cache ("after").
+#
+#   python benchmarks/principal_queries.py [requests-per-page]
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DB_DIR = tempfile.mkdtemp(prefix='ceilapp-bench-')
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(DB_DIR, "bench.db")}'
+
+from sqlalchemy import event
+
+from ceilapp import create_app, init_db, login_manager, load_user
+from models import db, User
+from principal_cache import principal_cache
+
+app = create_app()
+
+PAGES = ['/dashboard', '/users']
+
+
+def legacy_load_user(user_id):
+    return User.query.get(int(user_id))
+
+
+def measure(loader, requests_per_page):
+    login_manager.user_loader(loader)
+    principal_cache.clear()
+    client = app.test_client()
+    client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+
+    counter = {'statements': 0}
+
+    def count(*args):
+        counter['statements'] += 1
+
+    results = {}
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        for page in PAGES:
+            client.get(page)  # warm caches
+            counter['statements'] = 0
+            for _ in range(requests_per_page):
+                client.get(page)
+            results[page] = counter['statements'] / requests_per_page
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return results
+
+
+def main():
+    with app.app_context():
+        init_db()
+    requests_per_page = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    before = measure(legacy_load_user, requests_per_page)
+    after = measure(load_user, requests_per_page)
+    login_manager.user_loader(load_user)
+
+    print(f'{"page":<12} {"before":>8} {"after":>8}')
+    for page in PAGES:
+        print(f'{page:<12} {before[page]:>8.2f} {after[page]:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# Compares the `flask serve` worker models on the /login and /users workloads.
+# Seeds a throwaway SQLite database, starts the server once per model, and
+# drives each workload from --clients threads over keep-alive connections.
+# Reports throughput, p50/p95/p99 latency, failed requests and the server's
+# memory (PSS summed over its processes, so pages shared copy-on-write by
+# preforked workers are only counted once; Linux only).
+#
+#   python benchmarks/server_models.py [--model NAME ...] [--clients N] [--duration S] [--users N]
+#
+# e.g. python benchmarks/server_models.py --model prefork --workers 9 --hash-method scrypt
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODELS = ('threaded', 'prefork', 'async')
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def seed(users):
+    from ceilapp import create_app, init_db
+    from models import db, User, Role, normalize_search
+    from passwords import password_hasher
+    from dashboard_stats import dashboard_stats
+
+    with create_app().app_context():
+        init_db()
+        student_role_id = db.session.execute(db.select(Role.id).where(Role.name == 'Student')).scalar_one()
+        password_hash = password_hasher.hash('password')
+        for offset in range(0, users, 5000):
+            db.session.execute(db.insert(User), [
+                {
+                    'username': f'user{n}', 'email': f'user{n}@example.com', 'name': f'User {n}',
+                    'username_norm': f'user{n}', 'email_norm': f'user{n}@example.com',
+                    'name_norm': normalize_search(f'User {n}'),
+                    'password_hash': password_hash, 'role_id': student_role_id,
+                }
+                for n in range(offset, min(offset + 5000, users))
+            ])
+            db.session.commit()
+        dashboard_stats.recompute()
+
+
+def process_tree(pid):
+    pids = [pid]
+    for task in os.listdir(f'/proc/{pid}/task'):
+        with open(f'/proc/{pid}/task/{task}/children') as f:
+            for child in f.read().split():
+                pids.extend(process_tree(int(child)))
+    return pids
+
+
+def memory_mb(pid):
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        return None
+    total = 0
+    for process in process_tree(pid):
+        try:
+            with open(f'/proc/{process}/smaps_rollup') as f:
+                total += sum(int(line.split()[1]) for line in f if line.startswith('Pss:'))
+        except OSError:
+            pass
+    return round(total / 1024, 1)
+
+
+def login(conn, username, password):
+    conn.request('POST', '/login', urllib.parse.urlencode({'username': username, 'password': password}),
+                 {'Content-Type': 'application/x-www-form-urlencoded'})
+    response = conn.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie', '').split(';', 1)[0]
+    return response.status, cookie
+
+
+def client(port, workload, deadline, results, admin_cookie):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    n = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            if workload == 'login':
+                # No cookie is sent back, so every request really logs in
+                status, _ = login(conn, f'user{n % 1000}', 'password')
+                ok = status == 302
+            else:
+                conn.request('GET', '/users', headers={'Cookie': admin_cookie})
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            ok = False
+        results.append((time.perf_counter() - started, ok))
+        n += 1
+    conn.close()
+
+
+def wait_for(port, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited during startup')
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/login')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+
+def run_model(args, model, env, port):
+    command = [sys.executable, '-m', 'flask', '--app', 'ceilapp', 'serve', '--model', model,
+               '--bind', f'127.0.0.1:{port}', '--keepalive', str(args.keepalive)]
+    if model == 'prefork' and args.workers:
+        command += ['--workers', str(args.workers)]
+    if args.threads:
+        command += ['--threads', str(args.threads)]
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    rows = []
+    try:
+        wait_for(port, process)
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        _, admin_cookie = login(conn, 'admin', 'admin123')
+        conn.close()
+        idle_memory = memory_mb(process.pid)
+        for workload in args.workloads:
+            results = []
+            deadline = time.perf_counter() + args.duration
+            threads = [threading.Thread(target=client, args=(port, workload, deadline, results, admin_cookie))
+                       for _ in range(args.clients)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+            latencies = [latency for latency, _ in results]
+            rows.append((model, workload, len(results) / elapsed,
+                         percentile(latencies, 0.50) * 1000, percentile(latencies, 0.95) * 1000,
+                         percentile(latencies, 0.99) * 1000, sum(1 for _, ok in results if not ok),
+                         idle_memory, memory_mb(process.pid)))
+    except RuntimeError as e:
+        log.seek(0)
+        print(f'{model}: {e}\n{log.read().decode(errors="replace")[-2000:]}')
+    finally:
+        process.terminate()
+        process.wait(30)
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', action='append', dest='models', choices=MODELS)
+    parser.add_argument('--workload', action='append', dest='workloads', choices=('login', 'users'))
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client threads')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per workload')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--workers', type=int, help='prefork processes (default 2 x CPUs + 1)')
+    parser.add_argument('--threads', type=int, help='threads per process (default depends on the model)')
+    parser.add_argument('--keepalive', type=int, default=5)
+    parser.add_argument('--hash-method', default='scrypt',
+                        help='the production method by default, since /login is dominated by it')
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    args.models = args.models or list(MODELS)
+    args.workloads = args.workloads or ['login', 'users']
+
+    db_dir = tempfile.mkdtemp(prefix='ceilapp-serve-')
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': f'sqlite:///{os.path.join(db_dir, "serve.db")}',
+        'PASSWORD_HASH_METHOD': args.hash_method,
+        'SECRET_KEY': 'benchmark',
+        # Every client connects from 127.0.0.1; queue for hashing slots instead of a 429
+        'RATE_LIMIT_LOGIN_IP': '', 'RATE_LIMIT_LOGIN_USER': '', 'RATE_LIMIT_REGISTER_IP': '',
+        'RATE_LIMIT_WAITING_ROOM_IP': '',
+        'HASH_QUEUE_TIMEOUT': '60',
+    })
+    os.environ.update(env)
+    seed(args.users)
+    print(f'seeded {args.users} users; {os.cpu_count()} CPUs, {args.clients} clients, '
+          f'{args.duration:g} s per workload, hash {args.hash_method}')
+
+    print(f'{"model":<10} {"workload":<8} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"failed":>7} {"idle MB":>8} {"after MB":>8}')
+    for model in args.models:
+        for row in run_model(args, model, env, args.port):
+            model_name, workload, rate, p50, p95, p99, failed, idle, after = row
+            print(f'{model_name:<10} {workload:<8} {rate:>8.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} '
+                  f'{failed:>7} {idle if idle is not None else "-":>8} {after if after is not None else "-":>8}')
+
+
+if __name__ == '__main__':
+    main()
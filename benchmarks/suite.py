@@ -0,0 +1,424 @@
+# Benchmark suite over every page and the main mutation endpoints.
+# Seeds a synthetic dataset in a throwaway SQLite database, then drives each
+# scenario through the Flask test client (one request at a time) and through a
+# threaded local WSGI server (--threads concurrent clients). Reports throughput,
+# p50/p95/p99 latency, SQL statements per request and peak RSS, and writes the
+# results as JSON. With --baseline, exits non-zero on regressions.
+#
+#   python benchmarks/suite.py [--users N] [--requests N] [--threads N] [--output FILE] [--baseline FILE]
+#
+# e.g. python benchmarks/suite.py --users 200000 --output bench.json
+#      python benchmarks/suite.py --baseline bench.json
+import argparse
+import http.cookiejar
+import itertools
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ADMIN = {'username': 'admin', 'password': 'admin123'}
+
+# Suffix for codes and names created by the mutation scenarios, unique across modes
+UNIQUE = itertools.count()
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def seed(args):
+    from ceilapp import init_db
+    from models import db, User, Role, Session, State, Municipality, normalize_search
+    from passwords import password_hasher
+    from dashboard_stats import dashboard_stats
+
+    init_db()
+    db.session.execute(db.insert(State), [
+        {'code': f'{n:02d}', 'name': f'State {n}', 'name_ar': f'ولاية {n}'}
+        for n in range(1, args.states + 1)
+    ])
+    db.session.execute(db.insert(Municipality), [
+        {'name': f'Municipality {n}', 'name_ar': f'بلدية {n}', 'state_id': n % args.states + 1}
+        for n in range(args.municipalities)
+    ])
+    today = datetime.utcnow().date()
+    db.session.execute(db.insert(Session), [
+        {'code': f'S{n:03d}', 'name': f'Session {n}', 'name_ar': f'دورة {n}',
+         'start_date': today + timedelta(days=30 * n), 'end_date': today + timedelta(days=30 * n + 28)}
+        for n in range(args.sessions)
+    ])
+
+    # Every synthetic user shares one hash; hashing 200k passwords is not what is being measured
+    student_role_id = db.session.execute(db.select(Role.id).where(Role.name == 'Student')).scalar_one()
+    password_hash = password_hasher.hash('password')
+    started = datetime.utcnow() - timedelta(seconds=args.users)
+    for offset in range(0, args.users, 5000):
+        db.session.execute(db.insert(User), [
+            {
+                'username': f'user{n}', 'email': f'user{n}@example.com', 'name': f'User {n}',
+                'username_norm': f'user{n}', 'email_norm': f'user{n}@example.com',
+                'name_norm': normalize_search(f'User {n}'),
+                'password_hash': password_hash, 'role_id': student_role_id, 'is_active': n % 10 != 0,
+                'created_at': started + timedelta(seconds=n),
+            }
+            for n in range(offset, min(offset + 5000, args.users))
+        ])
+        db.session.commit()
+    dashboard_stats.recompute()
+
+
+class Scenario:
+    def __init__(self, name, method, build, expected, auth=True, cookies=True, prepare=None):
+        self.name = name
+        self.method = method
+        # build(i, params) -> (path, form data or None)
+        self.build = build
+        self.expected = expected
+        self.auth = auth
+        # False sends every request without a session, e.g. so each /login really logs in
+        self.cookies = cookies
+        # prepare() runs in an app context before the scenario and returns its params
+        self.prepare = prepare
+
+
+def scenarios(args):
+    from models import db, User, Session, State
+    from user_search import user_search
+
+    def user_cursors():
+        # Start of pages 2, 10, 100 and 1,000 of /users, newest first
+        cursors = []
+        for page in (2, 10, 100, 1000):
+            user = db.session.execute(
+                db.select(User).order_by(User.created_at.desc(), User.id.desc())
+                .offset((page - 1) * 10 - 1).limit(1)
+            ).scalar()
+            if user is not None:
+                cursors.append(user_search.encode_cursor(user))
+        return cursors
+
+    def users_to_update():
+        return db.session.execute(
+            db.select(User.id, User.email, User.name, User.role_id)
+            .where(User.username.like('user%')).order_by(User.id).limit(1000)
+        ).all()
+
+    def seeded_sessions():
+        return db.session.execute(
+            db.select(Session.id, Session.code).where(Session.code.like('S%')).order_by(Session.id)
+        ).all()
+
+    def added_states():
+        return db.session.execute(
+            db.select(State.id).where(State.code.like('X%')).order_by(State.id)
+        ).scalars().all()
+
+    def update_user(i, users):
+        user = users[i % len(users)]
+        return f'/users/{user.id}/update', {
+            'name': user.name, 'email': user.email, 'role_id': user.role_id, 'is_active': 'on'
+        }
+
+    def update_session(i, sessions):
+        session = sessions[i % len(sessions)]
+        return '/session/edit', {
+            'session_id': session.id, 'code': session.code, 'name': f'Session {session.id}',
+            'name_ar': 'دورة', 'start_date': '2030-01-01', 'end_date': '2030-01-29'
+        }
+
+    def delete_state(i, state_ids):
+        return f'/states/{state_ids[i]}/delete', {}
+
+    searches = ['user12', 'ser99', 'example', 'us', 'User 5']
+    return [
+        Scenario('home', 'GET', lambda i, p: ('/', None), (200,), auth=False),
+        Scenario('login', 'POST', lambda i, p: ('/login', ADMIN), (302,), auth=False, cookies=False),
+        Scenario('dashboard', 'GET', lambda i, p: ('/dashboard', None), (200,)),
+        Scenario('users', 'GET', lambda i, p: ('/users', None), (200,)),
+        Scenario('users_page', 'GET', lambda i, p: (f'/users?after={urllib.parse.quote(p[i % len(p)])}', None),
+                 (200,), prepare=user_cursors),
+        Scenario('users_search', 'GET', lambda i, p: (f'/users?search={urllib.parse.quote(searches[i % len(searches)])}', None),
+                 (200,)),
+        Scenario('locations', 'GET', lambda i, p: ('/locations', None), (200,)),
+        Scenario('api_municipalities', 'GET', lambda i, p: (f'/api/municipalities?state_id={i % args.states + 1}', None),
+                 (200,)),
+        Scenario('sessions', 'GET', lambda i, p: ('/sessions', None), (200,)),
+        Scenario('settings', 'GET', lambda i, p: ('/settings', None), (200,)),
+        Scenario('session_add', 'POST', lambda i, p: ('/session/add', {
+            'code': f'B{next(UNIQUE)}', 'name': 'Bench', 'name_ar': 'Bench',
+            'start_date': '2030-01-01', 'end_date': '2030-02-01'
+        }), (302,)),
+        Scenario('session_edit', 'POST', update_session, (302,), prepare=seeded_sessions),
+        Scenario('user_update', 'POST', update_user, (302,), prepare=users_to_update),
+        Scenario('state_add', 'POST', lambda i, p: ('/states/add', {
+            'code': f'X{next(UNIQUE)}', 'name': 'Bench', 'name_ar': 'Bench'
+        }), (302,)),
+        Scenario('state_delete', 'POST', delete_state, (302,), prepare=added_states),
+        Scenario('municipality_add', 'POST', lambda i, p: ('/municipalities/add', {
+            'name': f'Bench {next(UNIQUE)}', 'name_ar': 'Bench', 'state_id': i % args.states + 1
+        }), (302,)),
+        Scenario('settings_update', 'POST', lambda i, p: ('/settings/update', {
+            'organization_name': 'Ceil UFAS1', 'organization_name_ar': 'سيلاب', 'registration_open': 'on'
+        }), (302,)),
+    ]
+
+
+def summarize(latencies, failures, statements, elapsed):
+    return {
+        'requests': len(latencies),
+        'failed': failures,
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'queries_per_request': round(statements / len(latencies), 2) if latencies else 0.0,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def run_test_client(app, scenario, params, requests):
+    session_client = app.test_client(use_cookies=scenario.cookies)
+    if scenario.auth:
+        session_client.post('/login', data=ADMIN)
+
+    def call(i):
+        path, data = scenario.build(i, params)
+        client = session_client if scenario.cookies else app.test_client(use_cookies=False)
+        if scenario.method == 'GET':
+            return client.get(path).status_code
+        return client.post(path, data=data).status_code
+
+    # Warm caches; mutations are not repeated so each id is used once
+    start = 3 if scenario.method == 'GET' else 0
+    for i in range(start):
+        call(i)
+
+    latencies, failures = [], 0
+    with counting_statements(app) as counter:
+        started = time.perf_counter()
+        for i in range(start, start + requests):
+            t = time.perf_counter()
+            status = call(i)
+            latencies.append(time.perf_counter() - t)
+            failures += status not in scenario.expected
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, failures, counter['statements'], elapsed)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def run_server(app, base_url, scenario, params, requests, threads):
+    indexes = iter(range(requests))
+    lock = threading.Lock()
+    latencies, failures = [], []
+
+    def worker():
+        handlers = [NoRedirect]
+        if scenario.cookies:
+            handlers.append(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        opener = urllib.request.build_opener(*handlers)
+        if scenario.auth:
+            try:
+                opener.open(base_url + '/login', urllib.parse.urlencode(ADMIN).encode())
+            except urllib.error.HTTPError:
+                pass
+        while True:
+            with lock:
+                i = next(indexes, None)
+            if i is None:
+                return
+            path, data = scenario.build(i, params)
+            body = urllib.parse.urlencode(data).encode() if data is not None else None
+            t = time.perf_counter()
+            try:
+                response = opener.open(base_url + path, body)
+                response.read()
+                status = response.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            latencies.append(time.perf_counter() - t)
+            if status not in scenario.expected:
+                failures.append(status)
+
+    with counting_statements(app) as counter:
+        started = time.perf_counter()
+        pool = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+    return summarize(latencies, len(failures), counter['statements'], elapsed)
+
+
+class counting_statements:
+    def __init__(self, app):
+        from models import db
+        with app.app_context():
+            self.engine = db.engine
+        self.counter = {'statements': 0}
+
+    def _count(self, *args):
+        self.counter['statements'] += 1
+
+    def __enter__(self):
+        from sqlalchemy import event
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self.counter
+
+    def __exit__(self, *exc):
+        from sqlalchemy import event
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def compare(results, baseline, tolerance):
+    # A regression is any increase in statements per request, a new failure,
+    # or a p95 more than `tolerance` above the baseline
+    regressions = []
+    for mode, scenarios_ in results.items():
+        for name, current in scenarios_.items():
+            previous = baseline.get('results', {}).get(mode, {}).get(name)
+            if not previous:
+                continue
+            if current['queries_per_request'] > previous['queries_per_request'] + 0.01:
+                regressions.append(f'{mode}/{name}: queries/request {previous["queries_per_request"]} -> {current["queries_per_request"]}')
+            if current['failed'] > previous['failed']:
+                regressions.append(f'{mode}/{name}: failed {previous["failed"]} -> {current["failed"]}')
+            if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+                regressions.append(f'{mode}/{name}: p95 {previous["p95_ms"]} ms -> {current["p95_ms"]} ms')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--states', type=int, default=58)
+    parser.add_argument('--municipalities', type=int, default=1541)
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per scenario and mode')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent clients against the local server')
+    parser.add_argument('--mode', choices=('all', 'test-client', 'server'), default='all')
+    parser.add_argument('--only', action='append', help='run only the named scenario (repeatable)')
+    parser.add_argument('--hash-method', default='pbkdf2:sha256:1000',
+                        help='cheap by default so /login measures the app, not the hash cost')
+    parser.add_argument('--output', help='write results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON from a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative p95 increase')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp(prefix='ceilapp-suite-')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(db_dir, "suite.db")}'
+    os.environ['PASSWORD_HASH_METHOD'] = args.hash_method
+    os.environ['PASSWORD_HASH_WORKERS'] = '1'
+    # Every scenario logs in from 127.0.0.1 far more often than the default limits allow
+    for name in ('RATE_LIMIT_LOGIN_IP', 'RATE_LIMIT_LOGIN_USER', 'RATE_LIMIT_REGISTER_IP',
+                 'RATE_LIMIT_WAITING_ROOM_IP'):
+        os.environ[name] = ''
+    # Queue for the hashing slots rather than being refused with a 429
+    os.environ['HASH_QUEUE_TIMEOUT'] = '60'
+
+    from werkzeug.serving import make_server
+    from ceilapp import create_app
+
+    app = create_app({'UPLOAD_FOLDER': os.path.join(db_dir, 'uploads')})
+    started = time.perf_counter()
+    with app.app_context():
+        seed(args)
+    seed_seconds = time.perf_counter() - started
+    print(f'seeded {args.users} users, {args.states} states, {args.municipalities} municipalities, '
+          f'{args.sessions} sessions in {seed_seconds:.1f} s')
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)  # no per-request access log
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    modes = ['test-client', 'server'] if args.mode == 'all' else [args.mode]
+    results = {mode: {} for mode in modes}
+    print(f'{"mode":<12} {"scenario":<20} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+          f'{"queries":>8} {"failed":>7} {"rss MB":>8}')
+    for mode in modes:
+        for scenario in scenarios(args):
+            if args.only and scenario.name not in args.only:
+                continue
+            params = None
+            if scenario.prepare:
+                with app.app_context():
+                    params = scenario.prepare()
+                if not params:
+                    continue
+            requests = min(args.requests, len(params)) if scenario.name == 'state_delete' else args.requests
+            if mode == 'test-client':
+                r = run_test_client(app, scenario, params, requests)
+            else:
+                r = run_server(app, base_url, scenario, params, requests, args.threads)
+            results[mode][scenario.name] = r
+            print(f'{mode:<12} {scenario.name:<20} {r["throughput"]:>8} {r["p50_ms"]:>8} {r["p95_ms"]:>8} '
+                  f'{r["p99_ms"]:>8} {r["queries_per_request"]:>8} {r["failed"]:>7} {r["peak_rss_mb"]:>8}')
+    server.shutdown()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'dataset': {'users': args.users, 'states': args.states, 'municipalities': args.municipalities,
+                    'sessions': args.sessions},
+        'requests': args.requests,
+        'threads': args.threads,
+        'seed_seconds': round(seed_seconds, 2),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    failed = [f'{mode}/{name}' for mode, rs in results.items() for name, r in rs.items() if r['failed']]
+    if failed:
+        print('scenarios with unexpected status codes: ' + ', '.join(failed))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+# Template micro-benchmark. Per template: time to parse and compile the source,
+# time to load it from the bytecode cache instead, and render time on the
+# first and later requests. Per page: first request on a fresh worker without
+# and with a precompiled bytecode cache, against the median of later requests.
+# Each fresh worker is a new interpreter.
+#
+#   python benchmarks/template_render.py [--requests N]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PAGES = ('/login', '/dashboard', '/users', '/locations', '/sessions', '/settings')
+
+
+def measure(requests, preloaded):
+    # Runs in a fresh interpreter: logs in, then requests every page `requests` times
+    from flask import before_render_template, template_rendered
+    from ceilapp import create_app
+    from server import preload
+
+    app = create_app()
+    if preloaded:
+        # As `flask serve` does before accepting requests
+        preload(app)
+    renders = {}
+    starts = {}
+    before_render_template.connect(lambda sender, template, context, **extra:
+                                   starts.__setitem__(template.name, time.perf_counter()), app, weak=False)
+    template_rendered.connect(lambda sender, template, context, **extra:
+                              renders.setdefault(template.name, []).append(
+                                  (time.perf_counter() - starts.pop(template.name)) * 1000), app, weak=False)
+
+    client = app.test_client()
+    pages = {}
+    for path in PAGES:
+        # /login is measured logged out, the admin pages logged in
+        if path != '/login' and not pages.get('logged_in'):
+            client.post('/login', data={'username': 'admin', 'password': 'admin123'})
+            pages['logged_in'] = True
+        timings = pages[path] = []
+        for _ in range(requests):
+            started = time.perf_counter()
+            status = client.get(path).status_code
+            timings.append((time.perf_counter() - started) * 1000)
+            if status != 200:
+                raise SystemExit(f'{path} returned {status}')
+    pages.pop('logged_in')
+    print(json.dumps({'pages': pages, 'renders': renders}))
+
+
+def compile_timings(repeat):
+    # In-process: parse + compile from source, and load from bytecode, per template
+    import marshal
+    from ceilapp import create_app
+    from template_cache import template_cache
+
+    app = create_app({'TEMPLATE_CACHE_DIR': tempfile.mkdtemp(prefix='ceilapp-jinja-')})
+    env = app.jinja_env
+    rows = {}
+    for name in template_cache.template_names():
+        source, filename, _ = env.loader.get_source(env, name)
+        compile_ms = min(_timed(lambda: env.compile(source, name, filename)) for _ in range(repeat))
+        data = marshal.dumps(env.compile(source, name, filename))
+        load_ms = min(_timed(lambda: marshal.loads(data)) for _ in range(repeat))
+        rows[name] = (len(source.splitlines()), compile_ms, load_ms)
+    return rows
+
+
+def _timed(f):
+    started = time.perf_counter()
+    f()
+    return (time.perf_counter() - started) * 1000
+
+
+def fresh_worker(env, requests, preloaded=False):
+    command = [sys.executable, os.path.abspath(__file__), '--measure', '--requests', str(requests)]
+    output = subprocess.run(command + (['--preloaded'] if preloaded else []), env=env, cwd=ROOT, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=100, help='requests per page in each fresh worker')
+    parser.add_argument('--repeat', type=int, default=5, help='repetitions of each compile timing (best is kept)')
+    parser.add_argument('--measure', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--preloaded', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.measure:
+        measure(args.requests, args.preloaded)
+        return
+
+    db_dir = tempfile.mkdtemp(prefix='ceilapp-templates-')
+    env = dict(os.environ)
+    env.update({
+        'DATABASE_URL': f'sqlite:///{os.path.join(db_dir, "templates.db")}',
+        'SECRET_KEY': 'template-benchmark',
+        'TEMPLATE_CACHE_DIR': os.path.join(db_dir, 'jinja_cache'),
+        'RATE_LIMIT_LOGIN_IP': '', 'RATE_LIMIT_LOGIN_USER': '',
+    })
+    flask = [sys.executable, '-m', 'flask', '--app', 'ceilapp']
+    subprocess.run(flask + ['init-db'], env=env, cwd=ROOT, check=True, capture_output=True)
+
+    cold = fresh_worker(dict(env, TEMPLATE_CACHE='0'), args.requests)
+    subprocess.run(flask + ['compile-templates'], env=env, cwd=ROOT, check=True, capture_output=True)
+    cached = fresh_worker(env, args.requests)
+    preloaded = fresh_worker(env, args.requests, preloaded=True)
+
+    print(f'{"template":<20} {"lines":>6} {"compile ms":>11} {"load ms":>8} {"1st render":>11} {"median":>8}')
+    for name, (lines, compile_ms, load_ms) in compile_timings(args.repeat).items():
+        renders = cached['renders'].get(name, [])
+        first = f'{renders[0]:.2f}' if renders else '-'
+        median = f'{statistics.median(renders[1:]):.2f}' if len(renders) > 1 else '-'
+        print(f'{name:<20} {lines:>6} {compile_ms:>11.2f} {load_ms:>8.3f} {first:>11} {median:>8}')
+
+    print()
+    # First request to each page in a fresh worker: compiling from source, loading
+    # from the bytecode cache on first use, and preloaded at startup by `flask serve`
+    print(f'{"page":<12} {"1st, no cache":>14} {"1st, cached":>12} {"1st, preloaded":>15} {"median":>8}   (ms)')
+    for path in PAGES:
+        later = cached['pages'][path][1:] or cached['pages'][path]
+        print(f'{path:<12} {cold["pages"][path][0]:>14.1f} {cached["pages"][path][0]:>12.1f} '
+              f'{preloaded["pages"][path][0]:>15.1f} {statistics.median(later):>8.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# Registration surge with and without the waiting room. Measures how many
+# registrations a second the /register form sustains, then lets --clients
+# visitors arrive at once, as when registration opens, and drives each through
+# the form like a browser: a visitor sent to the waiting room polls its status
+# endpoint as the page's script does, and a visitor refused with a 429 waits
+# for Retry-After and submits again.
+#
+# Reports registrations completed, 429s, form submit latency, time from arrival
+# to registration, the peak number of concurrent form submits (what the
+# expensive path sees) and the cost of the status polls.
+#
+#   python benchmarks/waiting_room.py [--clients N] [--rate R] [--hash-method METHOD]
+import argparse
+import http.cookiejar
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class InFlight:
+    # WSGI middleware counting concurrent POSTs to /register
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.now = 0
+        self.peak = 0
+
+    def __call__(self, environ, start_response):
+        counted = environ['REQUEST_METHOD'] == 'POST' and environ['PATH_INFO'] == '/register'
+        if counted:
+            with self.lock:
+                self.now += 1
+                self.peak = max(self.peak, self.now)
+        try:
+            return self.app(environ, start_response)
+        finally:
+            if counted:
+                with self.lock:
+                    self.now -= 1
+
+
+def serve(config):
+    import logging
+    from werkzeug.serving import make_server
+    from ceilapp import create_app
+
+    app = create_app(config)
+    counter = InFlight(app.wsgi_app)
+    app.wsgi_app = counter
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, counter
+
+
+class Visitor:
+    def __init__(self, base_url, name, results, deadline):
+        self.base_url = base_url
+        self.name = name
+        self.results = results
+        self.deadline = deadline
+        self.opener = urllib.request.build_opener(
+            NoRedirect, urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, path, data=None):
+        started = time.perf_counter()
+        try:
+            response = self.opener.open(self.base_url + path, data and urllib.parse.urlencode(data).encode())
+            status, headers, body = response.status, response.headers, response.read()
+        except urllib.error.HTTPError as e:
+            status, headers, body = e.code, e.headers, e.read()
+        return status, headers, body, time.perf_counter() - started
+
+    def run(self):
+        arrived = time.perf_counter()
+        while time.perf_counter() < self.deadline:
+            status, headers, _, _ = self.request('/register')
+            if status in (302, 303) and '/waiting-room' in headers.get('Location', ''):
+                self.wait_in_line()
+                continue
+            status, headers, _, elapsed = self.request('/register', {
+                'username': self.name, 'email': f'{self.name}@example.com',
+                'password': 'secret', 'confirm_password': 'secret',
+            })
+            self.results['submits'].append(elapsed)
+            if status == 429:
+                self.results['rejected'].append(1)
+                time.sleep(int(headers.get('Retry-After', 1)))
+            elif status in (302, 303) and headers.get('Location', '').endswith('/login'):
+                self.results['registered'].append(time.perf_counter() - arrived)
+                return
+            elif status in (302, 303) and '/waiting-room' in headers.get('Location', ''):
+                self.wait_in_line()
+            else:
+                self.results['errors'].append(status)
+                return
+        self.results['gave_up'].append(1)
+
+    def wait_in_line(self):
+        # What static/js/waiting-room.js does
+        while time.perf_counter() < self.deadline:
+            status, _, body, elapsed = self.request('/waiting-room/status')
+            self.results['polls'].append(elapsed)
+            if status != 200:
+                return
+            payload = json.loads(body)
+            if payload['admitted']:
+                return
+            time.sleep(payload['poll_after'])
+
+
+def surge(label, config, clients, timeout):
+    from waiting_room import waiting_room
+
+    server, counter = serve(config)
+    waiting_room.clear()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    results = {key: [] for key in ('submits', 'registered', 'rejected', 'polls', 'errors', 'gave_up')}
+    deadline = time.perf_counter() + timeout
+    visitors = [Visitor(base_url, f'{label}-{n}', results, deadline) for n in range(clients)]
+    threads = [threading.Thread(target=visitor.run) for visitor in visitors]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    return {
+        'label': label,
+        'elapsed': elapsed,
+        'registered': len(results['registered']),
+        'rejected': len(results['rejected']),
+        'failed': len(results['errors']) + len(results['gave_up']),
+        'submit_p50': percentile(results['submits'], 0.50) * 1000,
+        'submit_p95': percentile(results['submits'], 0.95) * 1000,
+        'done_p50': percentile(results['registered'], 0.50),
+        'done_p95': percentile(results['registered'], 0.95),
+        'peak_submits': counter.peak,
+        'polls': len(results['polls']),
+        'poll_p95': percentile(results['polls'], 0.95) * 1000,
+    }
+
+
+def capacity(threads, duration):
+    # Registrations per second with every submit queueing for a hashing slot
+    server, _ = serve({'WAITING_ROOM_RATE': 0, 'HASH_QUEUE_TIMEOUT': 60})
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    done = []
+    deadline = time.perf_counter() + duration
+
+    def loop(index):
+        n = 0
+        while time.perf_counter() < deadline:
+            visitor = Visitor(base_url, f'capacity-{index}-{n}', {}, deadline)
+            status, headers, _, _ = visitor.request('/register', {
+                'username': visitor.name, 'email': f'{visitor.name}@example.com',
+                'password': 'secret', 'confirm_password': 'secret',
+            })
+            if status in (302, 303) and headers.get('Location', '').endswith('/login'):
+                done.append(1)
+            n += 1
+
+    workers = [threading.Thread(target=loop, args=(i,)) for i in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    return len(done) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=100, help='visitors arriving at once')
+    parser.add_argument('--rate', type=float, help='waiting room admissions/s (default: measured capacity)')
+    parser.add_argument('--burst', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds before a visitor gives up')
+    parser.add_argument('--hash-method', default='scrypt',
+                        help='the production method by default, since it dominates /register')
+    args = parser.parse_args()
+
+    db_dir = tempfile.mkdtemp(prefix='ceilapp-waiting-room-')
+    os.environ.update({
+        'DATABASE_URL': f'sqlite:///{os.path.join(db_dir, "waiting_room.db")}',
+        'PASSWORD_HASH_METHOD': args.hash_method,
+        'SECRET_KEY': 'waiting-room-benchmark',
+        # Every visitor comes from 127.0.0.1
+        'RATE_LIMIT_REGISTER_IP': '',
+        'RATE_LIMIT_WAITING_ROOM_IP': '',
+    })
+    from ceilapp import create_app, init_db
+    with create_app().app_context():
+        init_db()
+
+    measured = capacity(threads=os.cpu_count() or 1, duration=5)
+    # Admissions arrive in clumps; leave headroom below the measured rate
+    rate = args.rate or max(1.0, round(measured * 0.8, 1))
+    print(f'/register capacity: {measured:.1f} registrations/s; {args.clients} visitors arriving at once, '
+          f'waiting room admitting {rate:g}/s (burst {args.burst})')
+
+    rows = [
+        surge('none', {'WAITING_ROOM_RATE': 0}, args.clients, args.timeout),
+        surge('waiting', {'WAITING_ROOM_RATE': rate, 'WAITING_ROOM_BURST': args.burst}, args.clients, args.timeout),
+    ]
+    print(f'{"waiting room":<13} {"done":>5} {"failed":>7} {"429s":>6} {"submit p50":>11} {"submit p95":>11} '
+          f'{"done p50 s":>11} {"done p95 s":>11} {"peak submits":>13} {"polls":>6} {"poll p95":>9}')
+    for r in rows:
+        print(f'{r["label"]:<13} {r["registered"]:>5} {r["failed"]:>7} {r["rejected"]:>6} {r["submit_p50"]:>11.1f} '
+              f'{r["submit_p95"]:>11.1f} {r["done_p50"]:>11.1f} {r["done_p95"]:>11.1f} {r["peak_submits"]:>13} '
+              f'{r["polls"]:>6} {r["poll_p95"]:>9.1f}')
+
+
+if __name__ == '__main__':
+    main()
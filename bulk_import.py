@@ -0,0 +1,255 @@
+import csv
+import io
+import json
+import os
+import time
+from collections import Counter
+from itertools import islice
+
+from models import db, User, State, Municipality, normalize_search
+from passwords import password_hasher
+from dashboard_stats import apply_deltas, user_counter_keys, municipality_counter_keys
+from reference_data import reference_data
+
+DEFAULT_CHUNK_SIZE = 5000
+
+
+class ImportFileError(Exception):
+    pass
+
+
+class ImportReport:
+    def __init__(self, kind):
+        self.kind = kind
+        self.rows = 0
+        self.inserted = 0
+        self.skipped = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def error(self, line, message, row):
+        self.errors.append((line, message, row))
+
+    def finish(self):
+        self.elapsed = time.perf_counter() - self.started
+        return self
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    def write_errors(self, path):
+        # One line per rejected row with the reason, so it can be fixed and re-imported
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(['line', 'error', 'row'])
+            for line, message, row in self.errors:
+                writer.writerow([line, message, json.dumps(row, ensure_ascii=False)])
+
+    def summary(self):
+        return {
+            'kind': self.kind,
+            'rows': self.rows,
+            'inserted': self.inserted,
+            'skipped': self.skipped,
+            'errors': len(self.errors),
+            'elapsed': round(self.elapsed, 3),
+            'rows_per_sec': round(self.rows_per_sec, 1),
+        }
+
+
+def read_rows(stream, filename):
+    # Yields (line number, dict) pairs without loading the whole file
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.csv':
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        reader = csv.DictReader(text)
+        reader.fieldnames = [name.strip().lower() for name in reader.fieldnames or []]
+        for row in reader:
+            yield reader.line_num, {key: (value or '').strip() for key, value in row.items() if key}
+    elif extension == '.xlsx':
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            raise ImportFileError('XLSX import requires openpyxl (pip install openpyxl)') from None
+        workbook = load_workbook(stream, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [str(name or '').strip().lower() for name in next(rows, ())]
+            for line, values in enumerate(rows, start=2):
+                yield line, {
+                    key: '' if value is None else str(value).strip()
+                    for key, value in zip(header, values) if key
+                }
+        finally:
+            workbook.close()
+    else:
+        raise ImportFileError(f'Unsupported file type: {extension or filename}')
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _check_length(row, column, model_column):
+    limit = model_column.type.length
+    if limit and len(row.get(column, '')) > limit:
+        return f'{column} longer than {limit} characters'
+    return None
+
+
+def import_locations(rows, chunk_size=DEFAULT_CHUNK_SIZE, progress=None):
+    # Each row names a state by code and optionally a municipality in it.
+    # Unknown states are created from the state_name/state_name_ar columns.
+    report = ImportReport('locations')
+    state_ids = dict(db.session.execute(db.select(State.code, State.id)).all())
+    existing = set(db.session.execute(db.select(Municipality.state_id, Municipality.name)).all())
+
+    for chunk in chunked(rows, chunk_size):
+        new_states = {}
+        municipalities = []
+        for line, row in chunk:
+            report.rows += 1
+            code = row.get('state_code', '')
+            if not code:
+                report.error(line, 'state_code is required', row)
+                continue
+            message = (
+                _check_length(row, 'state_code', State.code)
+                or _check_length(row, 'name', Municipality.name)
+                or _check_length(row, 'name_ar', Municipality.name_ar)
+            )
+            if message:
+                report.error(line, message, row)
+                continue
+            if code not in state_ids and code not in new_states:
+                if not row.get('state_name') or not row.get('state_name_ar'):
+                    report.error(line, f'unknown state {code}: state_name and state_name_ar are required', row)
+                    continue
+                new_states[code] = {'code': code, 'name': row['state_name'], 'name_ar': row['state_name_ar']}
+            if row.get('name'):
+                if not row.get('name_ar'):
+                    report.error(line, 'name_ar is required', row)
+                    continue
+                municipalities.append((line, code, row))
+            elif code in state_ids:
+                report.skipped += 1
+
+        # Bulk inserts bypass the ORM events, so the dashboard counters are updated here
+        deltas = Counter()
+        if new_states:
+            db.session.execute(db.insert(State), list(new_states.values()))
+            reference_data.invalidate('states')
+            deltas[('states', '')] += len(new_states)
+            state_ids.update(db.session.execute(
+                db.select(State.code, State.id).where(State.code.in_(list(new_states)))
+            ).all())
+            report.inserted += len(new_states)
+
+        batch = []
+        for line, code, row in municipalities:
+            key = (state_ids[code], row['name'])
+            if key in existing:
+                report.skipped += 1
+                continue
+            existing.add(key)
+            batch.append({'state_id': key[0], 'name': row['name'], 'name_ar': row['name_ar']})
+            for counter in municipality_counter_keys(key[0]):
+                deltas[counter] += 1
+        if batch:
+            db.session.execute(db.insert(Municipality), batch)
+            report.inserted += len(batch)
+        apply_deltas(db.session.connection(), deltas)
+
+        db.session.commit()
+        if progress:
+            progress(report.rows)
+
+    return report.finish()
+
+
+def import_users(rows, chunk_size=DEFAULT_CHUNK_SIZE, default_role='Student', progress=None):
+    # Uniqueness is checked against in-memory sets loaded once, not per row.
+    # Rows may carry a plain `password` (hashed here) or a ready `password_hash`.
+    # progress(rows read so far) is called after each committed chunk.
+    report = ImportReport('users')
+    role_ids = {role.name.casefold(): role.id for role in reference_data.get('roles')}
+    if default_role.casefold() not in role_ids:
+        raise ImportFileError(f'Unknown default role: {default_role}')
+    usernames = set(db.session.execute(db.select(User.username)).scalars())
+    emails = set(db.session.execute(db.select(User.email_norm)).scalars())
+
+    for chunk in chunked(rows, chunk_size):
+        batch = []
+        passwords = []
+        for line, row in chunk:
+            report.rows += 1
+            username = row.get('username', '')
+            email = row.get('email', '')
+            if not username or not email:
+                report.error(line, 'username and email are required', row)
+                continue
+            if '@' not in email:
+                report.error(line, 'invalid email', row)
+                continue
+            message = (
+                _check_length(row, 'username', User.username)
+                or _check_length(row, 'email', User.email)
+                or _check_length(row, 'name', User.name)
+            )
+            if message:
+                report.error(line, message, row)
+                continue
+            role_id = role_ids.get((row.get('role') or default_role).casefold())
+            if role_id is None:
+                report.error(line, f'unknown role {row.get("role")}', row)
+                continue
+            email_norm = normalize_search(email)
+            if username in usernames:
+                report.error(line, 'username already exists', row)
+                continue
+            if email_norm in emails:
+                report.error(line, 'email already registered', row)
+                continue
+            usernames.add(username)
+            emails.add(email_norm)
+
+            name = row.get('name') or None
+            batch.append({
+                'username': username,
+                'email': email,
+                'name': name,
+                'username_norm': normalize_search(username),
+                'email_norm': email_norm,
+                'name_norm': normalize_search(name),
+                'role_id': role_id,
+                'is_active': True,
+                'password_hash': row.get('password_hash') or None,
+            })
+            passwords.append(row.get('password') or None)
+
+        # Hash only the rows that came with a plain password, in one call per chunk
+        pending = [i for i, password in enumerate(passwords) if password and not batch[i]['password_hash']]
+        for i, password_hash in zip(pending, password_hasher.hash_many([passwords[i] for i in pending])):
+            batch[i]['password_hash'] = password_hash
+
+        if batch:
+            db.session.execute(db.insert(User), batch)
+            # Bulk inserts bypass the ORM events, so the dashboard counters are updated here
+            deltas = Counter()
+            for row in batch:
+                for key in user_counter_keys(row['role_id'], row['is_active']):
+                    deltas[key] += 1
+            apply_deltas(db.session.connection(), deltas)
+            db.session.commit()
+            report.inserted += len(batch)
+        if progress:
+            progress(report.rows)
+
+    return report.finish()
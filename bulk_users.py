@@ -0,0 +1,132 @@
+import time
+from collections import Counter
+
+from models import db, User, Role
+from reference_data import reference_data
+from principal_cache import principal_cache
+from user_search import user_search
+from dashboard_stats import apply_deltas, user_counter_keys
+from enrollment import seat_allocator
+from audit import audit_log
+
+ACTIONS = ('activate', 'deactivate', 'set_role', 'delete')
+# Larger selections are sent as a filter instead of an id list
+MAX_IDS = 10000
+
+
+class BulkActionError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def target_clause(ids=None, filters=None):
+    # WHERE clause for the users an action applies to: an id list, or the
+    # same search/role/status filter the /users page uses
+    if ids is not None:
+        if filters:
+            raise BulkActionError('Send either ids or filter, not both')
+        if not isinstance(ids, list) or not all(type(user_id) is int for user_id in ids):
+            raise BulkActionError('ids must be a list of user ids')
+        if len(ids) > MAX_IDS:
+            raise BulkActionError(f'At most {MAX_IDS} ids per request; use a filter for larger selections')
+        return User.id.in_(ids)
+
+    filters = filters if isinstance(filters, dict) else {}
+    search = str(filters.get('search') or '').strip()
+    role_id = filters.get('role') or None
+    status = filters.get('status') or None
+    if role_id is not None and type(role_id) is not int:
+        raise BulkActionError('filter.role must be a role id')
+    if status not in (None, 'active', 'inactive'):
+        raise BulkActionError("filter.status must be 'active' or 'inactive'")
+    if not (search or role_id or status):
+        # An empty filter would select every user
+        raise BulkActionError('Send ids or a filter with at least one of search, role and status')
+    return user_search.filter(db.select(User.id), search, role_id, status).whereclause
+
+
+def parse_bulk_action(action, ids=None, filters=None, role_id=None):
+    # Validates a request; returns (target clause, column, value), where
+    # column/value is what an update sets and column is None for delete
+    if action not in ACTIONS:
+        raise BulkActionError(f"action must be one of {', '.join(ACTIONS)}")
+    target = target_clause(ids, filters)
+    if action == 'activate':
+        return target, 'is_active', True
+    if action == 'deactivate':
+        return target, 'is_active', False
+    if action == 'set_role':
+        if type(role_id) is not int or reference_data.get_by_id('roles', role_id) is None:
+            raise BulkActionError('role_id must be an existing role id')
+        return target, 'role_id', role_id
+    return target, None, None
+
+
+def run_bulk_action(action, ids=None, filters=None, role_id=None, actor=None):
+    # Applies one action to every selected user with a single UPDATE or DELETE
+    # in one transaction. Returns a summary; raises BulkActionError without
+    # changing anything when the request is invalid or would remove the last admin.
+    # `actor` overrides the audit log's actor, for jobs run on an admin's behalf.
+    started = time.perf_counter()
+    target, column, value = parse_bulk_action(action, ids, filters, role_id)
+
+    # One grouped count gives the matched and changed totals and the counter deltas
+    matched = changed = 0
+    deltas = Counter()
+    for old_role_id, old_active, count in db.session.execute(
+        db.select(User.role_id, User.is_active, db.func.count())
+        .where(target).group_by(User.role_id, User.is_active)
+    ):
+        matched += count
+        old = user_counter_keys(old_role_id, old_active)
+        if column is None:
+            new = None
+        else:
+            new = user_counter_keys(value if column == 'role_id' else old_role_id,
+                                    value if column == 'is_active' else old_active)
+            if new == old:
+                continue
+        changed += count
+        for key in old:
+            deltas[key] -= count
+        for key in new or ():
+            deltas[key] += count
+
+    if changed:
+        if column is None:
+            # Seats held by deleted students go to the waiting lists
+            seat_allocator.remove_users(target)
+            statement = db.delete(User).where(target)
+        else:
+            # Rows already in the requested state are left alone
+            statement = db.update(User).where(target, getattr(User, column).is_distinct_from(value)) \
+                .values({column: value})
+        db.session.execute(statement.execution_options(synchronize_session=False))
+
+        # Checked once for the whole batch, inside its transaction
+        admins = db.session.execute(
+            db.select(db.func.count(User.id)).join(Role, User.role_id == Role.id)
+            .where(Role.name == 'Admin', User.is_active == True)
+        ).scalar()
+        if not admins:
+            db.session.rollback()
+            raise BulkActionError('This would leave no active admin user', status=409)
+
+        apply_deltas(db.session.connection(), deltas)
+        principal_cache.invalidate_all()
+        # One entry for the whole statement, which no flush sees
+        audit_log.record(f'bulk_{action}', User.__tablename__, changes={
+            'selection': {'ids': ids} if ids is not None else {'filters': filters},
+            'set': {column: value} if column else None,
+            'matched': matched,
+            'changed': changed,
+        }, **(actor or {}))
+    db.session.commit()
+
+    return {
+        'action': action,
+        'matched': matched,
+        'changed': changed,
+        'elapsed': round(time.perf_counter() - started, 3),
+    }
@@ -1,11 +1,41 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, current_app
+from flask import Flask, Blueprint, render_template, request, redirect, url_for, flash, jsonify, current_app, send_from_directory, make_response
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from models import db, User, Session, ApplicationSettings, Role, State, Municipality
-from datetime import datetime
+from models import db, User, Session, SessionLevel, Enrollment, ApplicationSettings, Role, State, Municipality, CacheVersion, Job, AuditLog
+from settings_cache import settings_cache, SETTINGS_VERSION_KEY
+from principal_cache import principal_cache
+from page_cache import page_cache
+from instrumentation import instrumentation
+from media import media_store, MediaError, UploadOffsetError
+from assets import assets, AssetError
+from template_cache import template_cache
+from dashboard_stats import dashboard_stats
+from reference_data import reference_data
+from passwords import password_hasher
+from admission import admission, RateLimited
+from waiting_room import waiting_room, WaitingRoomError
+from enrollment import seat_allocator, EnrollmentError, ENROLLED, WAITLISTED
+from audit import audit_log, TABLES as AUDIT_TABLES
+from schema import upgrade_schema
+from database import database_config, init_database, pool_metrics
+from user_search import user_search
+from bulk_users import run_bulk_action, parse_bulk_action, BulkActionError
+from jobs import job_queue
+from server import Server, ServerError, MODELS as SERVER_MODELS
+from exports import exporter, ExportError
+from bulk_import import read_rows, import_locations, import_users, ImportFileError, DEFAULT_CHUNK_SIZE
+from datetime import datetime, timedelta
 import os
-from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
+from werkzeug.middleware.proxy_fix import ProxyFix
+from jinja2 import TemplateSyntaxError
 from functools import wraps
+import hmac
+import logging
+import multiprocessing
+import signal
+import time
+import uuid
+import click
 
 # Load environment variables from .env file
 load_dotenv()
@@ -15,29 +45,139 @@ def admin_required(f):
     def decorated_function(*args, **kwargs):
         if not current_user.is_authenticated or not current_user.is_admin():
             flash('Access denied. Admin privileges required.', 'danger')
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         return f(*args, **kwargs)
     return decorated_function
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.urandom(24)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///ceilapp.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+def like_prefix(value):
+    # LIKE pattern matching values that start with `value`, used with escape='\\'
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
 
-# Ensure upload folder exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# Routes and CLI commands live on this blueprint; create_app() registers it
+bp = Blueprint('main', __name__, cli_group=None)
 
-# Initialize extensions
-db.init_app(app)
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'
+login_manager.login_view = 'main.login'
+
+def create_app(config=None):
+    # Building the app does no database work and no password hashing, so
+    # workers start fast. Schema creation and seeding are done by `flask init-db`.
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or os.urandom(24)
+    app.config.update(database_config())
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['UPLOAD_FOLDER'] = 'static/uploads'
+    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    app.config['SETTINGS_CACHE_CHECK_INTERVAL'] = float(os.environ.get('SETTINGS_CACHE_CHECK_INTERVAL', 5))
+    app.config['PRINCIPAL_CACHE_TTL'] = float(os.environ.get('PRINCIPAL_CACHE_TTL', 300))
+    app.config['PRINCIPAL_CACHE_SIZE'] = int(os.environ.get('PRINCIPAL_CACHE_SIZE', 1024))
+    app.config['USER_SEARCH_FTS'] = os.environ.get('USER_SEARCH_FTS', '1') == '1'
+    app.config['USER_COUNT_CACHE_TTL'] = float(os.environ.get('USER_COUNT_CACHE_TTL', 60))
+    app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 0))
+    app.config['RATE_LIMIT_BACKEND'] = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+    app.config['RATE_LIMIT_DB'] = os.environ.get('RATE_LIMIT_DB')
+    app.config['RATE_LIMIT_LOGIN_IP'] = os.environ.get('RATE_LIMIT_LOGIN_IP', '60/minute')
+    app.config['RATE_LIMIT_LOGIN_USER'] = os.environ.get('RATE_LIMIT_LOGIN_USER', '10/minute')
+    app.config['RATE_LIMIT_REGISTER_IP'] = os.environ.get('RATE_LIMIT_REGISTER_IP', '30/minute')
+    app.config['RATE_LIMIT_WAITING_ROOM_IP'] = os.environ.get('RATE_LIMIT_WAITING_ROOM_IP', '60/minute')
+    app.config['HASH_CONCURRENCY'] = int(os.environ.get('HASH_CONCURRENCY', 0))
+    app.config['HASH_QUEUE_TIMEOUT'] = float(os.environ.get('HASH_QUEUE_TIMEOUT', 0.05))
+    app.config['WAITING_ROOM_RATE'] = float(os.environ.get('WAITING_ROOM_RATE', 5))
+    app.config['WAITING_ROOM_BURST'] = int(os.environ.get('WAITING_ROOM_BURST', 20))
+    app.config['WAITING_ROOM_PASS_TTL'] = int(os.environ.get('WAITING_ROOM_PASS_TTL', 600))
+    app.config['WAITING_ROOM_HASH_WAIT'] = float(os.environ.get('WAITING_ROOM_HASH_WAIT', 10))
+    # None follows RATE_LIMIT_BACKEND, but is shared whenever several workers serve
+    app.config['WAITING_ROOM_BACKEND'] = os.environ.get('WAITING_ROOM_BACKEND')
+    app.config['WAITING_ROOM_DB'] = os.environ.get('WAITING_ROOM_DB')
+    app.config['PAGE_CACHE_BACKEND'] = os.environ.get('PAGE_CACHE_BACKEND', 'memory')
+    app.config['PAGE_CACHE_DIR'] = os.environ.get('PAGE_CACHE_DIR')
+    app.config['PAGE_CACHE_SIZE'] = int(os.environ.get('PAGE_CACHE_SIZE', 256))
+    app.config['PAGE_CACHE_TTL'] = float(os.environ.get('PAGE_CACHE_TTL', 300))
+    app.config['SERVER_TIMING'] = os.environ.get('SERVER_TIMING', '1') == '1'
+    app.config['PROFILER_ENABLED'] = os.environ.get('PROFILER_ENABLED', '1') == '1'
+    app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+    app.config['MEDIA_FOLDER'] = os.environ.get('MEDIA_FOLDER')
+    app.config['MEDIA_WORKERS'] = int(os.environ.get('MEDIA_WORKERS', 2))
+    app.config['MEDIA_MAX_SIZE'] = app.config['MAX_CONTENT_LENGTH']
+    app.config['STATS_CACHE_TTL'] = float(os.environ.get('STATS_CACHE_TTL', 10))
+    app.config['IMPORT_CHUNK_SIZE'] = int(os.environ.get('IMPORT_CHUNK_SIZE', DEFAULT_CHUNK_SIZE))
+    app.config['IMPORT_ERRORS_FOLDER'] = os.path.join(app.instance_path, 'imports')
+    app.config['EXPORT_BATCH_SIZE'] = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+    app.config['EXPORT_GZIP'] = os.environ.get('EXPORT_GZIP', '1') == '1'
+    app.config['JOBS_THREADS'] = int(os.environ.get('JOBS_THREADS', 2))
+    app.config['JOBS_POLL_INTERVAL'] = float(os.environ.get('JOBS_POLL_INTERVAL', 1))
+    app.config['JOBS_TIMEOUT'] = int(os.environ.get('JOBS_TIMEOUT', 600))
+    app.config['JOBS_RETRY_BACKOFF'] = int(os.environ.get('JOBS_RETRY_BACKOFF', 10))
+    app.config['JOBS_RETENTION_DAYS'] = int(os.environ.get('JOBS_RETENTION_DAYS', 30))
+    app.config['JOBS_EAGER'] = os.environ.get('JOBS_EAGER', '0') == '1'
+    app.config['AUDIT_ENABLED'] = os.environ.get('AUDIT_ENABLED', '1') == '1'
+    app.config['AUDIT_ASYNC'] = os.environ.get('AUDIT_ASYNC', '1') == '1'
+    app.config['AUDIT_BATCH_SIZE'] = int(os.environ.get('AUDIT_BATCH_SIZE', 200))
+    app.config['AUDIT_FLUSH_INTERVAL'] = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1))
+    app.config['AUDIT_QUEUE_SIZE'] = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+    app.config['AUDIT_QUEUE_TIMEOUT'] = float(os.environ.get('AUDIT_QUEUE_TIMEOUT', 0.5))
+    app.config['TEMPLATE_CACHE'] = os.environ.get('TEMPLATE_CACHE', '1') == '1'
+    app.config['TEMPLATE_CACHE_DIR'] = os.environ.get('TEMPLATE_CACHE_DIR')
+    # None follows debug mode: templates are only re-checked for changes in development
+    app.config['TEMPLATES_AUTO_RELOAD'] = True if os.environ.get('TEMPLATES_AUTO_RELOAD') == '1' else None
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
+    app.config['SERVER_MODEL'] = os.environ.get('SERVER_MODEL', 'threaded')
+    app.config['SERVER_BIND'] = os.environ.get('SERVER_BIND', '127.0.0.1:8000')
+    app.config['SERVER_WORKERS'] = int(os.environ.get('SERVER_WORKERS', 0))
+    app.config['SERVER_THREADS'] = int(os.environ.get('SERVER_THREADS', 0))
+    app.config['SERVER_KEEPALIVE'] = int(os.environ.get('SERVER_KEEPALIVE', 5))
+    app.config['SERVER_GRACEFUL_TIMEOUT'] = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))
+    app.config['SERVER_MAX_REQUESTS'] = int(os.environ.get('SERVER_MAX_REQUESTS', 0))
+    if config:
+        app.config.update(config)
+
+    # Ensure upload folder exists
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Initialize extensions
+    db.init_app(app)
+    init_database(app, db)
+    instrumentation.init_app(app)
+    instrumentation.add_gauges('ceil_db_pool', pool_metrics.stats)
+    instrumentation.add_gauges('ceil_settings_cache', settings_cache.stats)
+    instrumentation.add_gauges('ceil_principal_cache', principal_cache.stats)
+    instrumentation.add_gauges('ceil_page_cache', page_cache.stats)
+    instrumentation.add_gauges('ceil_jobs', job_queue.stats)
+    instrumentation.add_gauges('ceil_admission', admission.stats)
+    instrumentation.add_gauges('ceil_waiting_room', waiting_room.stats)
+    instrumentation.add_gauges('ceil_enrollment', seat_allocator.stats)
+    instrumentation.add_gauges('ceil_audit', audit_log.stats)
+    settings_cache.init_app(app)
+    principal_cache.init_app(app)
+    page_cache.init_app(app)
+    media_store.init_app(app)
+    assets.init_app(app)
+    template_cache.init_app(app)
+    dashboard_stats.init_app(app)
+    reference_data.init_app(app)
+    job_queue.init_app(app)
+    exporter.init_app(app)
+    user_search.init_app(app)
+    password_hasher.init_app(app)
+    admission.init_app(app)
+    waiting_room.init_app(app)
+    seat_allocator.init_app(app)
+    audit_log.init_app(app)
+    login_manager.init_app(app)
+
+    # Behind nginx or another proxy, take the client address and scheme from
+    # the X-Forwarded-* headers it sets (rate limits are keyed on the address)
+    if app.config['TRUSTED_PROXIES']:
+        proxies = app.config['TRUSTED_PROXIES']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies, x_host=proxies)
+
+    app.register_blueprint(bp)
+    return app
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return principal_cache.get(int(user_id))
 
 def create_default_users():
     # Create default roles if they don't exist
@@ -81,6 +221,7 @@ def create_default_users():
         print("Created student user")
 
     try:
+        reference_data.invalidate('roles')
         db.session.commit()
         print("Default users created successfully")
     except Exception as e:
@@ -107,6 +248,7 @@ def create_default_settings():
             
         )
         db.session.add(settings)
+        CacheVersion.bump(SETTINGS_VERSION_KEY)
         try:
             db.session.commit()
             print("Default settings created successfully")
@@ -114,28 +256,63 @@ def create_default_settings():
             db.session.rollback()
             print(f"Error creating default settings: {e}")
 
-# Create database tables and default data
-with app.app_context():
+def init_db():
+    # Create missing tables, columns and indexes, then seed default data
     db.create_all()
+    upgrade_schema()
+    user_search.install()
     create_default_users()
     create_default_settings()
+    # Counters for rows that existed before the statistics table
+    dashboard_stats.recompute()
+
+@bp.cli.command('init-db')
+def init_db_command():
+    """Create or upgrade the database schema and seed default data."""
+    init_db()
+    click.echo('Database initialized')
 
-@app.route('/')
+@bp.route('/')
+@page_cache.anonymous_page
 def home():
     return render_template('index.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+def too_many_requests(error, template):
+    # Re-renders the form with a 429 so clients and proxies back off
+    if error.reason == 'hash_concurrency':
+        flash('The server is busy. Please try again in a moment.')
+    else:
+        flash(f'Too many attempts. Please wait {error.retry_after_header} seconds and try again.')
+    response = make_response(render_template(template), 429)
+    response.headers['Retry-After'] = error.retry_after_header
+    return response
+
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
         
     # Check if registration is open
-    settings = ApplicationSettings.query.first()
+    settings = settings_cache.get()
     if not settings or not settings.registration_open:
         flash('Registration is currently closed.', 'warning')
-        return redirect(url_for('home'))
+        return redirect(url_for('main.home'))
+
+    # When registration opens, visitors queue in the waiting room and are let
+    # through at the rate the form can be served
+    try:
+        queued = waiting_room.admit()
+    except RateLimited as e:
+        return too_many_requests(e, 'register.html')
+    if queued is not None:
+        return queued
         
     if request.method == 'POST':
+        try:
+            admission.check('register_ip', request.remote_addr)
+        except RateLimited as e:
+            return too_many_requests(e, 'register.html')
+
         username = request.form.get('username')
         email = request.form.get('email')
         password = request.form.get('password')
@@ -144,76 +321,134 @@ def register():
         # Validate input
         if not username or not email or not password:
             flash('All fields are required')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
             
         if password != confirm_password:
             flash('Passwords do not match')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
             
         if User.query.filter_by(username=username).first():
             flash('Username already exists')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
             
         if User.query.filter_by(email=email).first():
             flash('Email already registered')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
             
         # Create new user with student role
+        student_role = Role.query.filter_by(name='Student').first()
         user = User(username=username, email=email, role_id=student_role.id)
-        user.set_password(password)
+        try:
+            with admission.hashing(wait=waiting_room.hash_wait if waiting_room.enabled else None):
+                user.set_password(password)
+        except RateLimited as e:
+            return too_many_requests(e, 'register.html')
         db.session.add(user)
         
         try:
             db.session.commit()
+            waiting_room.release()
             flash('Registration successful! Please login.')
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
         except Exception as e:
             db.session.rollback()
+            current_app.logger.exception('Registration failed')
             flash('An error occurred. Please try again.')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
             
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+# The waiting room page is the same for everyone and served from the page
+# cache; it polls the status endpoint for the visitor's place in the queue
+@bp.route('/waiting-room')
+@page_cache.anonymous_page(args=('next',))
+def waiting_room_page():
+    next_url = request.args.get('next', '')
+    if not next_url.startswith('/') or next_url.startswith('//'):
+        next_url = url_for('main.register')
+    return render_template('waiting_room.html', next_url=next_url)
+
+@bp.route('/waiting-room/status')
+def waiting_room_status():
+    status = waiting_room.status()
+    if status is None:
+        response = jsonify({'error': 'No ticket; reload the page to take one'})
+        response.status_code = 404
+    else:
+        response = jsonify(status)
+    response.cache_control.no_store = True
+    return response
+
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
         
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
-        user = User.query.filter_by(username=username).first()
-        
-        if user and user.check_password(password):
+        # Per address against scripted runs, per username against guessing one account
+        username_key = (username or '').casefold()
+        try:
+            admission.check('login_ip', request.remote_addr)
+            admission.check('login_user', username_key)
+            user = User.query.filter_by(username=username).first()
+            with admission.hashing():
+                authenticated = user is not None and user.check_password(password)
+                # Re-hash with the current method and cost while the plain password is at hand
+                rehash = authenticated and user.password_needs_rehash()
+                if rehash:
+                    user.set_password(password)
+                    audit_log.ignore(user)
+        except RateLimited as e:
+            return too_many_requests(e, 'login.html')
+
+        if authenticated:
+            admission.reset('login_user', username_key)
+            if rehash:
+                try:
+                    db.session.commit()
+                except Exception as e:
+                    db.session.rollback()
+                    current_app.logger.exception('Password rehash failed for user %s', user.id)
             login_user(user)
-            return redirect(url_for('dashboard'))
+            return redirect(url_for('main.dashboard'))
         flash('Invalid username or password')
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('home'))
+    return redirect(url_for('main.home'))
 
-@app.route('/dashboard')
+@bp.route('/dashboard')
 @login_required
 def dashboard():
-    return render_template('dashboard.html')
+    # Admins see live counts, read from the cached counters table
+    stats = dashboard_stats.get() if current_user.is_admin() else None
+    return render_template('dashboard.html', stats=stats)
+
+@bp.route('/api/stats')
+@login_required
+def api_stats():
+    if not current_user.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+    return jsonify(dashboard_stats.get())
 
 # Session Management Routes
-@app.route('/sessions')
+@bp.route('/sessions')
 @login_required
 def sessions():
-    sessions = Session.query.all()
+    sessions = reference_data.get('sessions')
     return render_template('sessions.html', sessions=sessions)
 
-@app.route('/session/add', methods=['POST'])
+@bp.route('/session/add', methods=['POST'])
 @login_required
 def add_session():
     if not current_user.is_admin():
         flash('You do not have permission to add sessions', 'danger')
-        return redirect(url_for('sessions'))
+        return redirect(url_for('main.sessions'))
         
     try:
         code = request.form.get('code')
@@ -224,7 +459,7 @@ def add_session():
         
         if Session.query.filter_by(code=code).first():
             flash('Session code already exists', 'danger')
-            return redirect(url_for('sessions'))
+            return redirect(url_for('main.sessions'))
             
         session = Session(
             code=code,
@@ -234,21 +469,25 @@ def add_session():
             end_date=end_date
         )
         db.session.add(session)
+        reference_data.invalidate('sessions')
         db.session.commit()
         flash('Session added successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error adding session')
         flash('Error adding session', 'danger')
         
-    return redirect(url_for('sessions'))
+    return redirect(url_for('main.sessions'))
 
-@app.route('/session/<int:session_id>', methods=['GET'])
+@bp.route('/session/<int:session_id>', methods=['GET'])
 @login_required
 def get_session(session_id):
     if not current_user.is_admin():
         return jsonify({'error': 'Unauthorized'}), 403
         
-    session = Session.query.get_or_404(session_id)
+    session = reference_data.get_by_id('sessions', session_id)
+    if session is None:
+        return jsonify({'error': 'Session not found'}), 404
     return jsonify({
         'id': session.id,
         'code': session.code,
@@ -258,12 +497,12 @@ def get_session(session_id):
         'end_date': session.end_date.strftime('%Y-%m-%d')
     })
 
-@app.route('/session/edit', methods=['POST'])
+@bp.route('/session/edit', methods=['POST'])
 @login_required
 def edit_session():
     if not current_user.is_admin():
         flash('You do not have permission to edit sessions', 'danger')
-        return redirect(url_for('sessions'))
+        return redirect(url_for('main.sessions'))
         
     try:
         session_id = request.form.get('session_id')
@@ -272,7 +511,7 @@ def edit_session():
         code = request.form.get('code')
         if code != session.code and Session.query.filter_by(code=code).first():
             flash('Session code already exists', 'danger')
-            return redirect(url_for('sessions'))
+            return redirect(url_for('main.sessions'))
             
         session.code = code
         session.name = request.form.get('name')
@@ -280,15 +519,17 @@ def edit_session():
         session.start_date = datetime.strptime(request.form.get('start_date'), '%Y-%m-%d')
         session.end_date = datetime.strptime(request.form.get('end_date'), '%Y-%m-%d')
         
+        reference_data.invalidate('sessions')
         db.session.commit()
         flash('Session updated successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error updating session')
         flash('Error updating session', 'danger')
         
-    return redirect(url_for('sessions'))
+    return redirect(url_for('main.sessions'))
 
-@app.route('/session/<int:session_id>', methods=['DELETE'])
+@bp.route('/session/<int:session_id>', methods=['DELETE'])
 @login_required
 def delete_session(session_id):
     if not current_user.is_admin():
@@ -297,42 +538,205 @@ def delete_session(session_id):
     try:
         session = Session.query.get_or_404(session_id)
         db.session.delete(session)
+        reference_data.invalidate('sessions')
         db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error deleting session')
         return jsonify({'success': False, 'error': str(e)})
 
+# Enrollment: students claim seats in the current session's levels while
+# registration is open; see enrollment.py for how seats are allocated
+@bp.route('/enrollment')
+@login_required
+def enrollment():
+    settings = settings_cache.get()
+    current_session_id = settings.current_session_id if settings else None
+    # Admins can manage the levels of any session
+    session_id = request.args.get('session', type=int) if current_user.is_admin() else None
+    session_id = session_id or current_session_id
+    session = reference_data.get_by_id('sessions', session_id) if session_id else None
+
+    levels = seat_allocator.levels(session.id) if session else []
+    mine = seat_allocator.active_for_user(session.id, current_user.id) if session else None
+    return render_template('enrollment.html', session=session, sessions=reference_data.get('sessions'),
+                           levels=levels, enrollment=mine, position=seat_allocator.position(mine) if mine else None,
+                           is_open=bool(settings and settings.registration_open and session
+                                        and session.id == current_session_id),
+                           # Sent back with the claim, so a double submit claims once
+                           idempotency_key=uuid.uuid4().hex)
+
+def claim_seat(level_id, idempotency_key):
+    settings = settings_cache.get()
+    if not settings or not settings.registration_open or not settings.current_session_id:
+        raise EnrollmentError('Enrollment is currently closed.', status=403)
+    if not current_user.is_student():
+        raise EnrollmentError('Only students can enroll.', status=403)
+    if idempotency_key and len(idempotency_key) > 64:
+        raise EnrollmentError('Idempotency key is longer than 64 characters.')
+    return seat_allocator.claim(level_id, current_user.id, idempotency_key,
+                                session_id=settings.current_session_id)
+
+def enrollment_json(enrollment):
+    return {
+        'id': enrollment.id,
+        'level_id': enrollment.session_level_id,
+        'session_id': enrollment.session_id,
+        'status': enrollment.status,
+        'position': seat_allocator.position(enrollment),
+    }
+
+@bp.route('/enrollment/claim', methods=['POST'])
+@login_required
+def claim_enrollment():
+    try:
+        enrollment, created = claim_seat(request.form.get('level_id', type=int),
+                                         request.form.get('idempotency_key'))
+    except EnrollmentError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('main.enrollment'))
+    if enrollment.status == ENROLLED:
+        flash('Your seat is reserved.' if created else 'You already hold a seat in this session.', 'success')
+    else:
+        flash(f'The level is full. You are number {seat_allocator.position(enrollment)} on the waiting list.', 'info')
+    return redirect(url_for('main.enrollment'))
+
+@bp.route('/enrollment/<int:enrollment_id>/cancel', methods=['POST'])
+@login_required
+def cancel_enrollment(enrollment_id):
+    user_id = None if current_user.is_admin() else current_user.id
+    if seat_allocator.cancel(enrollment_id, user_id=user_id) is None:
+        flash('Enrollment not found or already cancelled.', 'warning')
+    else:
+        flash('Enrollment cancelled.', 'success')
+    return redirect(request.referrer or url_for('main.enrollment'))
+
+@bp.route('/api/enrollments', methods=['POST'])
+@login_required
+def api_claim_enrollment():
+    # {"level_id": 3} with an Idempotency-Key header; a retried request with the
+    # same key returns the original enrollment with 200 instead of 201
+    data = request.get_json(silent=True) or {}
+    level_id = data.get('level_id')
+    if type(level_id) is not int:
+        return jsonify({'error': 'level_id must be a level id'}), 400
+    try:
+        enrollment, created = claim_seat(level_id, request.headers.get('Idempotency-Key'))
+    except EnrollmentError as e:
+        return jsonify({'error': str(e)}), e.status
+    return jsonify(enrollment_json(enrollment)), 201 if created else 200
+
+@bp.route('/api/enrollments/<int:enrollment_id>', methods=['DELETE'])
+@login_required
+def api_cancel_enrollment(enrollment_id):
+    user_id = None if current_user.is_admin() else current_user.id
+    enrollment = seat_allocator.cancel(enrollment_id, user_id=user_id)
+    if enrollment is None:
+        return jsonify({'error': 'Enrollment not found or already cancelled'}), 404
+    return jsonify(enrollment_json(enrollment))
+
+@bp.route('/enrollment/levels/add', methods=['POST'])
+@login_required
+@admin_required
+def add_level():
+    session_id = request.form.get('session_id', type=int)
+    level = (request.form.get('level') or '').strip()
+    capacity = request.form.get('capacity', type=int)
+    if not level or capacity is None or capacity < 0 or reference_data.get_by_id('sessions', session_id) is None:
+        flash('Session, level and a capacity of 0 or more are required', 'danger')
+        return redirect(url_for('main.enrollment', session=session_id))
+    if SessionLevel.query.filter_by(session_id=session_id, level=level).first():
+        flash('This level already exists in the session', 'danger')
+        return redirect(url_for('main.enrollment', session=session_id))
+    try:
+        db.session.add(SessionLevel(session_id=session_id, level=level, capacity=capacity))
+        db.session.commit()
+        flash('Level added successfully', 'success')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception('Error adding level')
+        flash('Error adding level', 'danger')
+    return redirect(url_for('main.enrollment', session=session_id))
+
+@bp.route('/enrollment/levels/<int:level_id>/update', methods=['POST'])
+@login_required
+@admin_required
+def update_level(level_id):
+    level = SessionLevel.query.get_or_404(level_id)
+    session_id = level.session_id
+    capacity = request.form.get('capacity', type=int)
+    try:
+        if capacity is None:
+            raise EnrollmentError('Capacity is required')
+        promoted = seat_allocator.set_capacity(level.id, capacity)
+        flash(f'Capacity updated, {promoted} student(s) promoted from the waiting list'
+              if promoted else 'Capacity updated', 'success')
+    except EnrollmentError as e:
+        flash(str(e), 'danger')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception('Error updating level %s', level_id)
+        flash('Error updating level', 'danger')
+    return redirect(url_for('main.enrollment', session=session_id))
+
+@bp.route('/enrollment/levels/<int:level_id>/delete', methods=['POST'])
+@login_required
+@admin_required
+def delete_level(level_id):
+    level = SessionLevel.query.get_or_404(level_id)
+    session_id = level.session_id
+    if db.session.query(Enrollment.query.filter(
+            Enrollment.session_level_id == level.id, Enrollment.status.in_((ENROLLED, WAITLISTED))).exists()).scalar():
+        flash('Cannot delete a level with enrolled or waitlisted students', 'danger')
+        return redirect(url_for('main.enrollment', session=session_id))
+    try:
+        db.session.delete(level)
+        db.session.commit()
+        flash('Level deleted successfully', 'success')
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception('Error deleting level %s', level_id)
+        flash('Error deleting level', 'danger')
+    return redirect(url_for('main.enrollment', session=session_id))
+
 # Settings Management Routes
-@app.route('/settings')
+@bp.route('/settings')
 @login_required
 def settings():
     if not current_user.is_admin():
         flash('You do not have permission to access settings', 'danger')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
         
-    settings = ApplicationSettings.query.first()
-    sessions = Session.query.all()
+    settings = settings_cache.get()
+    sessions = reference_data.get('sessions')
     return render_template('settings.html', settings=settings, sessions=sessions)
 
-@app.route('/settings/update', methods=['POST'])
+@bp.route('/settings/update', methods=['POST'])
 @login_required
 def update_settings():
     if not current_user.is_admin():
         flash('You do not have permission to update settings', 'danger')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
         
     try:
         settings = ApplicationSettings.query.first()
         
-        # Handle logo upload
-        if 'logo' in request.files:
-            file = request.files['logo']
-            if file and file.filename:
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(file_path)
-                settings.logo_path = f'/static/uploads/{filename}'
+        # The logo is normally uploaded beforehand through /media/uploads and
+        # arrives as a stored name; a plain file field is the no-JavaScript fallback
+        logo_media = request.form.get('logo_media')
+        file = request.files.get('logo')
+        if logo_media:
+            if not media_store.exists(logo_media):
+                flash('Uploaded logo not found, please upload it again', 'danger')
+                return redirect(url_for('main.settings'))
+            settings.logo_path = url_for('main.media_file', name=logo_media)
+        elif file and file.filename:
+            try:
+                settings.logo_path = url_for('main.media_file', name=media_store.save(file.stream))
+            except MediaError as e:
+                flash(str(e), 'danger')
+                return redirect(url_for('main.settings'))
         
         # Update other settings
         settings.organization_name = request.form.get('organization_name')
@@ -349,70 +753,145 @@ def update_settings():
         settings.current_session_id = request.form.get('current_session_id') or None
         settings.registration_open = 'registration_open' in request.form
         
+        CacheVersion.bump(SETTINGS_VERSION_KEY)
         db.session.commit()
+        settings_cache.refresh()
+        page_cache.clear()
         flash('Settings updated successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error updating settings')
         flash('Error updating settings', 'danger')
         
-    return redirect(url_for('settings'))
+    return redirect(url_for('main.settings'))
 
-@app.context_processor
+@bp.app_context_processor
 def inject_settings():
-    settings = ApplicationSettings.query.first()
-    return dict(settings=settings)
+    return dict(settings=settings_cache.get())
+
+@bp.route('/assets/<path:filename>')
+def asset(filename):
+    # Fingerprinted build output from `flask build-assets`
+    return assets.send(filename)
+
+@bp.route('/media/<name>')
+def media_file(name):
+    # Names are content hashes, so a URL always refers to the same bytes
+    response = send_from_directory(media_store.folder, name, max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@bp.route('/media/uploads', methods=['POST'])
+@login_required
+def start_media_upload():
+    if not current_user.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        upload_id = media_store.start_upload(str(data.get('filename', '')), int(data.get('size', 0)))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'size must be an integer'}), 400
+    except MediaError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'id': upload_id, 'offset': 0,
+                    'url': url_for('main.media_upload', upload_id=upload_id)}), 201
+
+@bp.route('/media/uploads/<upload_id>', methods=['GET', 'PATCH'])
+@login_required
+def media_upload(upload_id):
+    # Resumable upload: PATCH the bytes from Upload-Offset onwards; after a
+    # failure, GET returns the offset to resume from
+    if not current_user.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        if request.method == 'GET':
+            return jsonify(media_store.upload_status(upload_id))
+        offset, name = media_store.append(
+            upload_id, request.headers.get('Upload-Offset', -1, type=int), request.stream
+        )
+    except KeyError:
+        return jsonify({'error': 'Unknown upload'}), 404
+    except UploadOffsetError as e:
+        return jsonify({'error': str(e), 'offset': e.offset}), 409
+    except MediaError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if name is None:
+        return jsonify({'offset': offset, 'complete': False})
+    return jsonify({'offset': offset, 'complete': True, 'name': name,
+                    'url': url_for('main.media_file', name=name)})
+
+@bp.route('/settings/cache-stats')
+@login_required
+@admin_required
+def settings_cache_stats():
+    return jsonify({
+        'settings': settings_cache.stats(),
+        'principals': principal_cache.stats(),
+        'pages': page_cache.stats(),
+    })
 
-@app.route('/users')
+@bp.route('/database/pool-stats')
+@login_required
+@admin_required
+def database_pool_stats():
+    stats = pool_metrics.stats()
+    stats['pool'] = db.engine.pool.status()
+    return jsonify(stats)
+
+@bp.route('/metrics')
+def metrics():
+    # Prometheus scrapers authenticate with METRICS_TOKEN; admins can also view it in the browser
+    token = current_app.config.get('METRICS_TOKEN')
+    authorized = token and hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}')
+    if not authorized and not (current_user.is_authenticated and current_user.is_admin()):
+        return jsonify({'error': 'Unauthorized'}), 403
+    return current_app.response_class(instrumentation.export(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/users')
 @login_required
 def users():
-    if not current_user.role.name == 'Admin':
+    if not current_user.is_admin():
         flash('Access denied. Admin privileges required.', 'danger')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     # Get filter parameters
-    search = request.args.get('search', '')
+    search = request.args.get('search', '').strip()
     role_id = request.args.get('role', type=int)
     status = request.args.get('status')
-    page = request.args.get('page', 1, type=int)
     per_page = 10
 
-    # Build query
-    query = User.query
+    query = user_search.filter(db.select(User), search, role_id, status)
 
-    # Apply filters
-    if search:
-        query = query.filter(
-            db.or_(
-                User.name.ilike(f'%{search}%'),
-                User.email.ilike(f'%{search}%')
-            )
+    # Keyset pagination: `after`/`before` hold the (created_at, id) of the neighbouring row
+    try:
+        users, newer_cursor, older_cursor = user_search.page(
+            query.options(db.joinedload(User.role)),
+            after=request.args.get('after'),
+            before=request.args.get('before'),
+            per_page=per_page
         )
-    
-    if role_id:
-        query = query.filter(User.role_id == role_id)
-    
-    if status == 'active':
-        query = query.filter(User.is_active == True)
-    elif status == 'inactive':
-        query = query.filter(User.is_active == False)
+    except ValueError:
+        return redirect(url_for('main.users', search=search, role=role_id, status=status))
 
-    # Get pagination
-    pagination = query.order_by(User.created_at.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-    users = pagination.items
+    total = user_search.approximate_count(query, (search, role_id, status))
 
-    # Get all roles for filter dropdown
-    roles = Role.query.all()
+    # Roles for the filter dropdowns; the per-user edit forms load them from /api/ref/roles
+    roles = reference_data.get('roles')
 
-    return render_template('users.html', users=users, roles=roles, pagination=pagination)
+    filters = {key: value for key, value in (('search', search), ('role', role_id), ('status', status)) if value}
+    return render_template('users.html', users=users, roles=roles, total=total, filters=filters,
+                           newer_cursor=newer_cursor, older_cursor=older_cursor)
 
-@app.route('/users/<int:user_id>/update', methods=['POST'])
+@bp.route('/users/<int:user_id>/update', methods=['POST'])
 @login_required
 def update_user(user_id):
-    if not current_user.role.name == 'Admin':
+    if not current_user.is_admin():
         flash('Access denied. Admin privileges required.', 'danger')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     user = User.query.get_or_404(user_id)
     
@@ -423,48 +902,150 @@ def update_user(user_id):
     user.is_active = 'is_active' in request.form
     
     try:
+        principal_cache.invalidate(user.id)
         db.session.commit()
+        user_search.clear_counts()
         flash('User updated successfully.', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error updating user %s', user_id)
         flash('Error updating user. Please try again.', 'danger')
     
-    return redirect(url_for('users'))
+    return redirect(url_for('main.users'))
 
-@app.route('/users/<int:user_id>/delete', methods=['POST'])
+@bp.route('/users/<int:user_id>/delete', methods=['POST'])
 @login_required
 def delete_user(user_id):
-    if not current_user.role.name == 'Admin':
+    if not current_user.is_admin():
         flash('Access denied. Admin privileges required.', 'danger')
-        return redirect(url_for('dashboard'))
+        return redirect(url_for('main.dashboard'))
     
     user = User.query.get_or_404(user_id)
     
     # Prevent deleting the last admin
     if user.role.name == 'Admin' and User.query.filter_by(role_id=user.role_id).count() <= 1:
         flash('Cannot delete the last admin user.', 'danger')
-        return redirect(url_for('users'))
+        return redirect(url_for('main.users'))
     
     try:
+        principal_cache.invalidate(user.id)
+        seat_allocator.remove_users(User.id == user.id)
         db.session.delete(user)
         db.session.commit()
+        user_search.clear_counts()
         flash('User deleted successfully.', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error deleting user %s', user_id)
         flash('Error deleting user. Please try again.', 'danger')
     
-    return redirect(url_for('users'))
+    return redirect(url_for('main.users'))
+
+@bp.route('/api/users/bulk', methods=['POST'])
+@login_required
+def bulk_users():
+    # {"action": "activate" | "deactivate" | "set_role" | "delete", "role_id": 2,
+    #  "ids": [1, 2, 3]} or {"filter": {"search": "...", "role": 3, "status": "active"}}
+    if not current_user.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    data = request.get_json(silent=True) or {}
+    try:
+        if data.get('ids') is None:
+            # A filter can match any number of users: validate now, run in the background
+            parse_bulk_action(data.get('action'), filters=data.get('filter'), role_id=data.get('role_id'))
+            job = job_queue.enqueue('bulk_users', {
+                'action': data.get('action'), 'filters': data.get('filter'), 'role_id': data.get('role_id')
+            }, created_by=current_user.id)
+            return job_accepted(job)
+        summary = run_bulk_action(data.get('action'), ids=data.get('ids'), role_id=data.get('role_id'))
+    except BulkActionError as e:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), e.status
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.exception('Bulk %s of users failed', data.get('action'))
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+    user_search.clear_counts()
+    return jsonify({'success': True, **summary})
+
+# Reference data for dropdowns: small tables served from the per-process registry.
+# The ETag changes with the content, so browsers revalidate and usually get a 304.
+@bp.route('/api/ref/<any(roles, states, sessions):table>')
+@login_required
+def api_ref(table):
+    payload, etag = reference_data.payload(table)
+    response = current_app.response_class(payload, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 # Location Management Routes
-@app.route('/locations')
+@bp.route('/locations')
 @login_required
 @admin_required
 def locations():
-    states = State.query.all()
-    municipalities = Municipality.query.all()
-    return render_template('locations.html', states=states, municipalities=municipalities)
+    # States come from the reference-data registry and the per-state counts from
+    # the dashboard counters. Municipalities are fetched page by page from /api/municipalities.
+    counts = dashboard_stats.counts('municipalities_by_state')
+    states = [(state, counts.get(str(state.id), 0)) for state in reference_data.get('states')]
+    return render_template('locations.html', states=states)
+
+MUNICIPALITY_API_FIELDS = ('id', 'state_id', 'name', 'name_ar')
+
+@bp.route('/api/municipalities')
+@login_required
+def api_municipalities():
+    if not current_user.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    state_id = request.args.get('state_id', type=int)
+    search = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    cursor = request.args.get('cursor', '')
+
+    # Keyset pagination on (state_id, id): the cursor is the last row of the previous page
+    query = db.select(
+        Municipality.id, Municipality.state_id, Municipality.name, Municipality.name_ar
+    ).order_by(Municipality.state_id, Municipality.id).limit(limit + 1)
+
+    if cursor:
+        try:
+            cursor_state_id, cursor_id = (int(part) for part in cursor.split(':'))
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        if not state_id:
+            query = query.where(db.tuple_(Municipality.state_id, Municipality.id) > (cursor_state_id, cursor_id))
+        elif cursor_state_id == state_id:
+            # Within one state, comparing ids lets the index seek to the cursor
+            query = query.where(Municipality.id > cursor_id)
+        elif cursor_state_id > state_id:
+            query = query.where(db.false())
 
-@app.route('/states/add', methods=['POST'])
+    if state_id:
+        query = query.where(Municipality.state_id == state_id)
+
+    if search:
+        pattern = like_prefix(search)
+        query = query.where(db.or_(
+            Municipality.name.like(pattern, escape='\\'),
+            Municipality.name_ar.like(pattern, escape='\\')
+        ))
+
+    rows = db.session.execute(query).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f'{rows[-1].state_id}:{rows[-1].id}'
+
+    return jsonify({
+        'items': [dict(zip(MUNICIPALITY_API_FIELDS, row)) for row in rows],
+        'next_cursor': next_cursor
+    })
+
+@bp.route('/states/add', methods=['POST'])
 @login_required
 @admin_required
 def add_state():
@@ -476,25 +1057,27 @@ def add_state():
         # Validate required fields
         if not all([code, name, name_ar]):
             flash('All fields are required', 'danger')
-            return redirect(url_for('locations'))
+            return redirect(url_for('main.locations'))
 
         # Check if code already exists
         if State.query.filter_by(code=code).first():
             flash('State code already exists', 'danger')
-            return redirect(url_for('locations'))
+            return redirect(url_for('main.locations'))
 
         # Create new state
         state = State(code=code, name=name, name_ar=name_ar)
         db.session.add(state)
+        reference_data.invalidate('states')
         db.session.commit()
 
         flash('State added successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error adding state')
         flash(f'Error adding state: {str(e)}', 'danger')
-    return redirect(url_for('locations'))
+    return redirect(url_for('main.locations'))
 
-@app.route('/states/<int:state_id>/update', methods=['POST'])
+@bp.route('/states/<int:state_id>/update', methods=['POST'])
 @login_required
 @admin_required
 def update_state(state_id):
@@ -506,14 +1089,16 @@ def update_state(state_id):
         state.name = request.form.get('name')
         state.name_ar = request.form.get('name_ar')
 
+        reference_data.invalidate('states')
         db.session.commit()
         flash('State updated successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error updating state %s', state_id)
         flash(f'Error updating state: {str(e)}', 'danger')
-    return redirect(url_for('locations'))
+    return redirect(url_for('main.locations'))
 
-@app.route('/states/<int:state_id>/delete', methods=['POST'])
+@bp.route('/states/<int:state_id>/delete', methods=['POST'])
 @login_required
 @admin_required
 def delete_state(state_id):
@@ -521,19 +1106,21 @@ def delete_state(state_id):
         state = State.query.get_or_404(state_id)
         
         # Check if state has municipalities
-        if state.municipalities:
+        if db.session.query(Municipality.query.filter_by(state_id=state.id).exists()).scalar():
             flash('Cannot delete state with associated municipalities', 'danger')
-            return redirect(url_for('locations'))
+            return redirect(url_for('main.locations'))
         
         db.session.delete(state)
+        reference_data.invalidate('states')
         db.session.commit()
         flash('State deleted successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error deleting state %s', state_id)
         flash(f'Error deleting state: {str(e)}', 'danger')
-    return redirect(url_for('locations'))
+    return redirect(url_for('main.locations'))
 
-@app.route('/municipalities/add', methods=['POST'])
+@bp.route('/municipalities/add', methods=['POST'])
 @login_required
 @admin_required
 def add_municipality():
@@ -545,7 +1132,7 @@ def add_municipality():
         # Validate required fields
         if not all([name, name_ar, state_id]):
             flash('All fields are required', 'danger')
-            return redirect(url_for('locations'))
+            return redirect(url_for('main.locations'))
 
         # Create new municipality
         municipality = Municipality(name=name, name_ar=name_ar, state_id=state_id)
@@ -555,10 +1142,11 @@ def add_municipality():
         flash('Municipality added successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error adding municipality')
         flash(f'Error adding municipality: {str(e)}', 'danger')
-    return redirect(url_for('locations'))
+    return redirect(url_for('main.locations'))
 
-@app.route('/municipalities/<int:municipality_id>/update', methods=['POST'])
+@bp.route('/municipalities/<int:municipality_id>/update', methods=['POST'])
 @login_required
 @admin_required
 def update_municipality(municipality_id):
@@ -574,10 +1162,11 @@ def update_municipality(municipality_id):
         flash('Municipality updated successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error updating municipality %s', municipality_id)
         flash(f'Error updating municipality: {str(e)}', 'danger')
-    return redirect(url_for('locations'))
+    return redirect(url_for('main.locations'))
 
-@app.route('/municipalities/<int:municipality_id>/delete', methods=['POST'])
+@bp.route('/municipalities/<int:municipality_id>/delete', methods=['POST'])
 @login_required
 @admin_required
 def delete_municipality(municipality_id):
@@ -588,8 +1177,301 @@ def delete_municipality(municipality_id):
         flash('Municipality deleted successfully', 'success')
     except Exception as e:
         db.session.rollback()
+        current_app.logger.exception('Error deleting municipality %s', municipality_id)
         flash(f'Error deleting municipality: {str(e)}', 'danger')
-    return redirect(url_for('locations'))
+    return redirect(url_for('main.locations'))
+
+# Bulk Import Routes
+def run_import(kind, stream, filename, progress=None, actor=None):
+    rows = read_rows(stream, filename)
+    chunk_size = current_app.config['IMPORT_CHUNK_SIZE']
+    if kind == 'locations':
+        report = import_locations(rows, chunk_size=chunk_size, progress=progress)
+    else:
+        report = import_users(rows, chunk_size=chunk_size, progress=progress)
+        user_search.clear_counts()
+
+    summary = report.summary()
+    summary['error_file'] = None
+    if report.errors:
+        os.makedirs(current_app.config['IMPORT_ERRORS_FOLDER'], exist_ok=True)
+        error_file = f"{kind}-errors-{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}.csv"
+        report.write_errors(os.path.join(current_app.config['IMPORT_ERRORS_FOLDER'], error_file))
+        summary['error_file'] = error_file
+    if report.inserted:
+        # The chunks were committed one by one; one entry covers the whole file
+        audit_log.log('import', User.__tablename__ if kind == 'users' else kind, changes={key: summary[key] for key in ('rows', 'inserted', 'skipped', 'errors')},
+                      **(actor or {}))
+    return summary
+
+@bp.route('/import/<any(locations, users):kind>', methods=['POST'])
+@login_required
+def import_file(kind):
+    if not current_user.is_admin():
+        return jsonify({'success': False, 'error': 'Unauthorized'}), 403
+
+    file = request.files.get('file')
+    if not file or not file.filename:
+        return jsonify({'success': False, 'error': 'No file uploaded'}), 400
+    extension = os.path.splitext(file.filename)[1].lower()
+    if extension not in ('.csv', '.xlsx'):
+        return jsonify({'success': False, 'error': f'Unsupported file type: {extension or file.filename}'}), 400
+
+    # The file is kept until the import job has read it
+    pending_folder = os.path.join(current_app.config['IMPORT_ERRORS_FOLDER'], 'pending')
+    os.makedirs(pending_folder, exist_ok=True)
+    path = os.path.join(pending_folder, uuid.uuid4().hex + extension)
+    file.save(path)
+    job = job_queue.enqueue('import', {'kind': kind, 'path': path, 'filename': file.filename},
+                            created_by=current_user.id)
+    return job_accepted(job)
+
+@bp.route('/import/errors/<path:filename>')
+@login_required
+@admin_required
+def import_errors(filename):
+    return send_from_directory(current_app.config['IMPORT_ERRORS_FOLDER'], filename, as_attachment=True)
+
+# Audit Log
+@bp.route('/audit')
+@login_required
+@admin_required
+def audit():
+    # ?since=&until= (dates, both inclusive), ?actor= (username or id), ?table=
+    filters = {key: request.args.get(key, '').strip() for key in ('since', 'until', 'actor', 'table')}
+    filters = {key: value for key, value in filters.items() if value}
+    try:
+        since = datetime.fromisoformat(filters['since']) if 'since' in filters else None
+        until = datetime.fromisoformat(filters['until']) + timedelta(days=1) if 'until' in filters else None
+    except ValueError:
+        flash('Dates must be given as YYYY-MM-DD', 'danger')
+        return redirect(url_for('main.audit'))
+
+    query = audit_log.filter(db.select(AuditLog), since, until, filters.get('actor'), filters.get('table'))
+    try:
+        entries, newer_cursor, older_cursor = audit_log.page(
+            query, after=request.args.get('after'), before=request.args.get('before')
+        )
+    except ValueError:
+        return redirect(url_for('main.audit', **filters))
+
+    return render_template('audit.html', entries=entries, filters=filters, tables=AUDIT_TABLES,
+                           newer_cursor=newer_cursor, older_cursor=older_cursor)
+
+# Export Routes
+@bp.route('/export/<any(users, sessions, locations):kind>')
+@login_required
+@admin_required
+def export(kind):
+    # ?format=csv (default) or xlsx; users take the same filters as the /users page
+    if kind == 'users':
+        header, query = exporter.users(
+            search=request.args.get('search', '').strip(),
+            role_id=request.args.get('role', type=int),
+            status=request.args.get('status')
+        )
+    elif kind == 'sessions':
+        header, query = exporter.sessions()
+    else:
+        header, query = exporter.locations()
+    try:
+        return exporter.response(kind, request.args.get('format', 'csv'), header, query)
+    except ExportError as e:
+        flash(str(e), 'danger')
+        return redirect(url_for(f'main.{kind}'))
+
+# Background Jobs
+WORKER_LOG_FORMAT = '%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s'
+
+def job_actor(job, kind):
+    # Audit log context for changes a job makes on behalf of the admin who queued it
+    row = db.session.execute(
+        db.select(User.id, User.username).join(Job, Job.created_by == User.id).where(Job.id == job.id)
+    ).first()
+    return {'actor_id': row.id if row else None, 'actor_name': row.username if row else None,
+            'endpoint': f'job:{kind}'}
+
+def discard_import(kind, path, filename):
+    # The uploaded file of an import job, once it has run or its worker died
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+@job_queue.handler('import', max_attempts=1, fatal=(ImportFileError,), discard=discard_import)
+def import_job(job, kind, path, filename):
+    # Not retried: a second run would reject the rows the first one inserted as duplicates
+    try:
+        with open(path, 'rb') as f:
+            return run_import(kind, f, filename, progress=job.progress, actor=job_actor(job, 'import'))
+    finally:
+        discard_import(kind, path, filename)
+
+@job_queue.handler('bulk_users', fatal=(BulkActionError,))
+def bulk_users_job(job, action, filters, role_id=None):
+    # Safe to retry: the statements only touch rows not yet in the target state
+    summary = run_bulk_action(action, filters=filters, role_id=role_id, actor=job_actor(job, 'bulk_users'))
+    user_search.clear_counts()
+    return summary
+
+def job_accepted(job):
+    return jsonify({
+        'success': True,
+        'job_id': job.id,
+        'status_url': url_for('main.job_status', job_id=job.id),
+    }), 202
+
+@bp.route('/api/jobs')
+@login_required
+def job_list():
+    if not current_user.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+    query = db.select(Job).order_by(Job.id.desc()).limit(50)
+    status = request.args.get('status')
+    if status:
+        query = query.where(Job.status == status)
+    return jsonify([job_queue.status(job) for job in db.session.execute(query).scalars()])
+
+@bp.route('/api/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    if not current_user.is_admin():
+        return jsonify({'error': 'Unauthorized'}), 403
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return jsonify({'error': 'Not found'}), 404
+    return jsonify(job_queue.status(job))
+
+def run_worker(threads):
+    # Entry point of each `flask worker --processes N` child process
+    logging.basicConfig(level=logging.INFO, format=WORKER_LOG_FORMAT)
+    job_queue.work(create_app(), threads=threads)
+
+def import_command(kind, path):
+    with open(path, 'rb') as f:
+        try:
+            summary = run_import(kind, f, path)
+        except ImportFileError as e:
+            raise click.ClickException(str(e))
+    click.echo(f"{summary['rows']} rows, {summary['inserted']} inserted, {summary['skipped']} skipped, "
+               f"{summary['errors']} errors in {summary['elapsed']}s ({summary['rows_per_sec']} rows/sec)")
+    if summary['error_file']:
+        click.echo(f"Rejected rows written to {os.path.join(current_app.config['IMPORT_ERRORS_FOLDER'], summary['error_file'])}")
+
+@bp.cli.command('import-locations')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_locations_command(path):
+    """Import states and municipalities from a CSV or XLSX file."""
+    import_command('locations', path)
+
+@bp.cli.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_users_command(path):
+    """Import user accounts from a CSV or XLSX file."""
+    import_command('users', path)
+
+@bp.cli.command('recompute-stats')
+def recompute_stats_command():
+    """Rebuild the dashboard counters from full counts and report any drift."""
+    drift = dashboard_stats.recompute()
+    for (name, key), (stored, actual) in sorted(drift.items()):
+        click.echo(f'{name}[{key}]: {stored} -> {actual}')
+    click.echo(f'{len(drift)} counters corrected')
+
+@bp.cli.command('vendor-assets')
+def vendor_assets_command():
+    """Download the pinned Bootstrap and Bootstrap Icons files into static/vendor."""
+    try:
+        assets.vendor(log=click.echo)
+    except OSError as e:
+        raise click.ClickException(f'Download failed: {e}')
+    except AssetError as e:
+        raise click.ClickException(str(e))
+
+@bp.cli.command('build-assets')
+def build_assets_command():
+    """Bundle, fingerprint and precompress static assets into static/dist."""
+    try:
+        assets.build(log=click.echo)
+    except AssetError as e:
+        raise click.ClickException(str(e))
+
+@bp.cli.command('compile-templates')
+def compile_templates_command():
+    """Compile every template into the shared bytecode cache."""
+    started = time.perf_counter()
+    try:
+        timings = template_cache.compile_all(log=click.echo)
+    except TemplateSyntaxError as e:
+        raise click.ClickException(f'{e.filename}:{e.lineno}: {e.message}')
+    if template_cache.enabled:
+        click.echo(f'{len(timings)} templates compiled into {template_cache.directory} '
+                   f'in {(time.perf_counter() - started) * 1000:.0f} ms')
+    else:
+        click.echo(f'{len(timings)} templates compiled; TEMPLATE_CACHE is off, so nothing was written')
+
+@bp.cli.command('worker')
+@click.option('--threads', type=int, help='Jobs run concurrently per process (default JOBS_THREADS).')
+@click.option('--processes', type=int, default=1, show_default=True, help='Worker processes to start.')
+def worker_command(threads, processes):
+    """Run queued background jobs until interrupted."""
+    threads = threads or current_app.config['JOBS_THREADS']
+    logging.basicConfig(level=logging.INFO, format=WORKER_LOG_FORMAT)
+    click.echo(f'Running jobs with {processes} process(es) x {threads} thread(s); Ctrl+C to stop')
+    if processes == 1:
+        job_queue.work(current_app._get_current_object(), threads=threads)
+        return
+
+    children = [multiprocessing.Process(target=run_worker, args=(threads,)) for _ in range(processes)]
+    for child in children:
+        child.start()
+    # Children stop after their current jobs on SIGTERM; Ctrl+C reaches them directly
+    signal.signal(signal.SIGTERM, lambda signum, frame: [child.terminate() for child in children])
+    for child in children:
+        while child.is_alive():
+            try:
+                child.join()
+            except KeyboardInterrupt:
+                pass
+
+@bp.cli.command('serve')
+@click.option('--model', type=click.Choice(SERVER_MODELS), help='Worker model (default SERVER_MODEL).')
+@click.option('--bind', help='host:port to listen on (default SERVER_BIND).')
+@click.option('--workers', type=int, help='Processes for the prefork model (default 2 x CPUs + 1).')
+@click.option('--threads', type=int, help='Threads per process (default depends on the model).')
+@click.option('--keepalive', type=int, help='Seconds idle keep-alive connections stay open (default SERVER_KEEPALIVE).')
+@click.option('--graceful-timeout', type=int, help='Seconds requests get to finish on shutdown or reload.')
+@click.option('--max-requests', type=int, help='Restart prefork workers after this many requests (0 = never).')
+@click.option('--pidfile', type=click.Path(dir_okay=False), help='Write the server process id here.')
+@click.option('--certfile', type=click.Path(exists=True, dir_okay=False), help='TLS certificate (enables HTTP/2 with --model async).')
+@click.option('--keyfile', type=click.Path(exists=True, dir_okay=False), help='TLS private key.')
+@click.option('--access-log', is_flag=True, help='Log every request to stdout.')
+def serve_command(model, bind, workers, threads, keepalive, graceful_timeout, max_requests, pidfile,
+                  certfile, keyfile, access_log):
+    """Run the application under a production server."""
+    config = current_app.config
+    logging.basicConfig(level=logging.INFO, format=WORKER_LOG_FORMAT)
+    try:
+        server = Server(
+            current_app._get_current_object(),
+            model=model or config['SERVER_MODEL'],
+            bind=bind or config['SERVER_BIND'],
+            workers=workers or config['SERVER_WORKERS'],
+            threads=threads or config['SERVER_THREADS'],
+            keepalive=config['SERVER_KEEPALIVE'] if keepalive is None else keepalive,
+            graceful_timeout=graceful_timeout or config['SERVER_GRACEFUL_TIMEOUT'],
+            max_requests=config['SERVER_MAX_REQUESTS'] if max_requests is None else max_requests,
+            pidfile=pidfile, certfile=certfile, keyfile=keyfile, access_log=access_log
+        )
+        if server.model == 'prefork':
+            waiting_room.share(current_app, server.workers)
+        click.echo(f'Starting {server.describe()}')
+        server.run()
+    except (ServerError, WaitingRoomError) as e:
+        raise click.ClickException(str(e))
 
 if __name__ == '__main__':
-    app.run(debug=True) 
\ No newline at end of file
+    app = create_app()
+    with app.app_context():
+        init_db()
+    app.run(debug=True)
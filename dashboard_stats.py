@@ -0,0 +1,215 @@
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session as OrmSession, object_session
+
+from models import db, User, Session, State, Municipality, StatCounter
+from reference_data import reference_data
+
+COUNTERS = StatCounter.__table__
+
+
+def user_counter_keys(role_id, is_active):
+    return [('users', ''), ('users_by_role', str(role_id)), ('users_active', '1' if is_active else '0')]
+
+
+def municipality_counter_keys(state_id):
+    return [('municipalities', ''), ('municipalities_by_state', str(state_id))]
+
+
+def _previous(target, attribute):
+    # Value before this flush; relies on active_history for changed attributes
+    history = inspect(target).attrs[attribute].history
+    return history.deleted[0] if history.deleted else getattr(target, attribute)
+
+
+def _queue(target, keys, delta):
+    # Deltas are summed per flush and written once in after_flush
+    session = object_session(target)
+    pending = session.info.setdefault('stat_deltas', Counter())
+    for key in keys:
+        pending[key] += delta
+
+
+def apply_deltas(connection, deltas):
+    # Adds each delta to its counter row, creating missing rows
+    for (name, key), delta in deltas.items():
+        if not delta:
+            continue
+        result = connection.execute(
+            db.update(COUNTERS).where(COUNTERS.c.name == name, COUNTERS.c.key == key)
+            .values(value=COUNTERS.c.value + delta)
+        )
+        if not result.rowcount:
+            connection.execute(db.insert(COUNTERS).values(name=name, key=key, value=delta))
+
+
+@event.listens_for(User, 'after_insert')
+def _user_inserted(mapper, connection, target):
+    _queue(target, user_counter_keys(target.role_id, target.is_active), 1)
+
+
+@event.listens_for(User, 'after_update')
+def _user_updated(mapper, connection, target):
+    old = user_counter_keys(_previous(target, 'role_id'), _previous(target, 'is_active'))
+    new = user_counter_keys(target.role_id, target.is_active)
+    if old != new:
+        _queue(target, old, -1)
+        _queue(target, new, 1)
+
+
+@event.listens_for(User, 'before_delete')
+def _user_deleted(mapper, connection, target):
+    _queue(target, user_counter_keys(target.role_id, target.is_active), -1)
+
+
+@event.listens_for(Session, 'after_insert')
+def _session_inserted(mapper, connection, target):
+    _queue(target, [('sessions', '')], 1)
+
+
+@event.listens_for(Session, 'before_delete')
+def _session_deleted(mapper, connection, target):
+    _queue(target, [('sessions', '')], -1)
+
+
+@event.listens_for(State, 'after_insert')
+def _state_inserted(mapper, connection, target):
+    _queue(target, [('states', '')], 1)
+
+
+@event.listens_for(State, 'before_delete')
+def _state_deleted(mapper, connection, target):
+    _queue(target, [('states', '')], -1)
+
+
+@event.listens_for(Municipality, 'after_insert')
+def _municipality_inserted(mapper, connection, target):
+    _queue(target, municipality_counter_keys(target.state_id), 1)
+
+
+@event.listens_for(Municipality, 'after_update')
+def _municipality_updated(mapper, connection, target):
+    old_state_id = _previous(target, 'state_id')
+    if old_state_id != target.state_id:
+        _queue(target, municipality_counter_keys(old_state_id), -1)
+        _queue(target, municipality_counter_keys(target.state_id), 1)
+
+
+@event.listens_for(Municipality, 'before_delete')
+def _municipality_deleted(mapper, connection, target):
+    _queue(target, municipality_counter_keys(target.state_id), -1)
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _write_deltas(session, flush_context):
+    deltas = session.info.pop('stat_deltas', None)
+    if deltas:
+        apply_deltas(session.connection(), deltas)
+
+
+class DashboardStats:
+    # Dashboard numbers read from the counters table, cached per worker for a few
+    # seconds. A miss costs one small query however many users there are.
+    def __init__(self, ttl=10):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._expires = 0.0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('STATS_CACHE_TTL', self.ttl)
+        app.extensions['dashboard_stats'] = self
+
+    def get(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() < self._expires:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or time.monotonic() >= self._expires:
+                self._snapshot = self._load()
+                self._expires = time.monotonic() + self.ttl
+            return self._snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+
+    def counts(self, name):
+        # One counter family as {key: value}, read directly rather than from the snapshot
+        return dict(db.session.execute(
+            db.select(COUNTERS.c.key, COUNTERS.c.value).where(COUNTERS.c.name == name)
+        ).all())
+
+    def recompute(self):
+        # Reconciliation: rebuilds every counter with full COUNT queries and
+        # returns {(name, key): (stored, actual)} for the counters that had drifted
+        actual = Counter()
+        for role_id, is_active, count in db.session.execute(
+            db.select(User.role_id, User.is_active, db.func.count()).group_by(User.role_id, User.is_active)
+        ):
+            for key in user_counter_keys(role_id, is_active):
+                actual[key] += count
+        actual[('sessions', '')] = db.session.execute(db.select(db.func.count(Session.id))).scalar()
+        actual[('states', '')] = db.session.execute(db.select(db.func.count(State.id))).scalar()
+        for state_id, count in db.session.execute(
+            db.select(Municipality.state_id, db.func.count()).group_by(Municipality.state_id)
+        ):
+            for key in municipality_counter_keys(state_id):
+                actual[key] += count
+
+        stored = {
+            (name, key): value
+            for name, key, value in db.session.execute(db.select(COUNTERS.c.name, COUNTERS.c.key, COUNTERS.c.value))
+        }
+        drift = {
+            key: (stored.get(key, 0), actual.get(key, 0))
+            for key in set(stored) | set(actual)
+            if stored.get(key, 0) != actual.get(key, 0)
+        }
+        db.session.execute(db.delete(COUNTERS))
+        rows = [{'name': name, 'key': key, 'value': value} for (name, key), value in actual.items() if value]
+        if rows:
+            db.session.execute(db.insert(COUNTERS), rows)
+        db.session.commit()
+        self.clear()
+        return drift
+
+    def _load(self):
+        counters = {}
+        for name, key, value in db.session.execute(db.select(COUNTERS.c.name, COUNTERS.c.key, COUNTERS.c.value)):
+            counters.setdefault(name, {})[key] = value
+        roles = reference_data.get('roles')
+        states = reference_data.get('states')
+
+        by_role = counters.get('users_by_role', {})
+        by_state = counters.get('municipalities_by_state', {})
+        active = counters.get('users_active', {})
+        return {
+            'users': {
+                'total': counters.get('users', {}).get('', 0),
+                'active': active.get('1', 0),
+                'inactive': active.get('0', 0),
+                'by_role': [
+                    {'role_id': role.id, 'name': role.name, 'color': role.color, 'count': by_role.get(str(role.id), 0)}
+                    for role in roles
+                ],
+            },
+            'sessions': {'total': counters.get('sessions', {}).get('', 0)},
+            'states': {'total': counters.get('states', {}).get('', 0)},
+            'municipalities': {
+                'total': counters.get('municipalities', {}).get('', 0),
+                'by_state': [
+                    {'state_id': state.id, 'code': state.code, 'name': state.name,
+                     'count': by_state.get(str(state.id), 0)}
+                    for state in states
+                ],
+            },
+            'generated_at': datetime.utcnow().isoformat(timespec='seconds') + 'Z',
+        }
+
+
+dashboard_stats = DashboardStats()
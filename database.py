@@ -0,0 +1,134 @@
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_DATABASE_URL = 'sqlite:///ceilapp.db'
+
+
+class PoolMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.connects = 0
+            self.checkouts = 0
+            self.checked_out = 0
+            self.peak_checked_out = 0
+            self.waits = 0
+            self.wait_time = 0.0
+            self.max_wait = 0.0
+            self.timeouts = 0
+
+    def record_wait(self, elapsed, timed_out=False):
+        with self._lock:
+            self.waits += 1
+            self.wait_time += elapsed
+            self.max_wait = max(self.max_wait, elapsed)
+            if timed_out:
+                self.timeouts += 1
+
+    def on_connect(self, *args):
+        with self._lock:
+            self.connects += 1
+
+    def on_checkout(self, *args):
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.peak_checked_out = max(self.peak_checked_out, self.checked_out)
+
+    def on_checkin(self, *args):
+        with self._lock:
+            self.checked_out -= 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'peak_checked_out': self.peak_checked_out,
+                'waits': self.waits,
+                'wait_time': round(self.wait_time, 6),
+                'avg_wait': round(self.wait_time / self.waits, 6) if self.waits else 0.0,
+                'max_wait': round(self.max_wait, 6),
+                'timeouts': self.timeouts,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that records how long each checkout waited for a free connection
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            pool_metrics.record_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_metrics.record_wait(time.perf_counter() - started)
+        return connection
+
+
+def database_config(environ=os.environ):
+    # Engine settings for the configured backend, as Flask-SQLAlchemy config keys
+    url = environ.get('DATABASE_URL', DEFAULT_DATABASE_URL)
+    backend = make_url(url).get_backend_name()
+    options = {}
+
+    if backend == 'sqlite':
+        database = make_url(url).database
+        if database and database != ':memory:':
+            options['poolclass'] = TimedQueuePool
+            options['pool_size'] = int(environ.get('DB_POOL_SIZE', 5))
+            options['max_overflow'] = int(environ.get('DB_MAX_OVERFLOW', 10))
+            options['pool_timeout'] = float(environ.get('DB_POOL_TIMEOUT', 30))
+            # The driver's own busy wait, in addition to the busy_timeout pragma
+            options['connect_args'] = {'timeout': int(environ.get('SQLITE_BUSY_TIMEOUT', 5000)) / 1000}
+    else:
+        options['poolclass'] = TimedQueuePool
+        options['pool_size'] = int(environ.get('DB_POOL_SIZE', 10))
+        options['max_overflow'] = int(environ.get('DB_MAX_OVERFLOW', 20))
+        options['pool_timeout'] = float(environ.get('DB_POOL_TIMEOUT', 30))
+        options['pool_recycle'] = int(environ.get('DB_POOL_RECYCLE', 1800))
+        options['pool_pre_ping'] = environ.get('DB_POOL_PRE_PING', '1') == '1'
+
+    return {
+        'SQLALCHEMY_DATABASE_URI': url,
+        'SQLALCHEMY_ENGINE_OPTIONS': options,
+        'SQLITE_PRAGMAS': {
+            'journal_mode': environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+            'synchronous': environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+            'busy_timeout': int(environ.get('SQLITE_BUSY_TIMEOUT', 5000)),
+            'mmap_size': int(environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        },
+    }
+
+
+def init_database(app, db):
+    # Call after db.init_app(app): attaches per-connection setup and pool metrics
+    with app.app_context():
+        engine = db.engine
+
+    if engine.dialect.name == 'sqlite':
+        pragmas = app.config.get('SQLITE_PRAGMAS', {})
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={value}')
+            cursor.close()
+
+    event.listen(engine, 'connect', pool_metrics.on_connect)
+    event.listen(engine.pool, 'checkout', pool_metrics.on_checkout)
+    event.listen(engine.pool, 'checkin', pool_metrics.on_checkin)
+    return engine
@@ -0,0 +1,225 @@
+import threading
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, User, SessionLevel, Enrollment
+from audit import audit_log
+
+ENROLLED = 'enrolled'
+WAITLISTED = 'waitlisted'
+CANCELLED = 'cancelled'
+ACTIVE = (ENROLLED, WAITLISTED)
+
+LEVELS = SessionLevel.__table__
+ENROLLMENTS = Enrollment.__table__
+
+
+class EnrollmentError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class SeatAllocator:
+    # Seats per session level. A claim first locks the level's row, then takes a
+    # seat with a conditional UPDATE (enrolled < capacity) in the same
+    # transaction as its enrollment row, so concurrent claims from any number of
+    # workers cannot overbook a level. Claims that find the level full join a
+    # FIFO waitlist, promoted in id order as seats are freed; cancellations lock
+    # the same row, so a seat is never freed between a claim finding the level
+    # full and its waitlist row being committed.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {'claims': 0, 'enrolled': 0, 'waitlisted': 0, 'replayed': 0,
+                        'cancelled': 0, 'promoted': 0}
+
+    def init_app(self, app):
+        app.extensions['seat_allocator'] = self
+
+    def claim(self, level_id, user_id, idempotency_key=None, session_id=None):
+        # Returns (enrollment, created). A repeated key, or a student who already
+        # holds a seat or waitlist place in the session, gets the existing
+        # enrollment back with created=False. With session_id, only that
+        # session's levels can be claimed.
+        self._count('claims')
+        if idempotency_key:
+            existing = self._by_key(idempotency_key, user_id, level_id)
+            if existing is not None:
+                self._count('replayed')
+                return existing, False
+
+        query = db.select(SessionLevel.session_id).where(SessionLevel.id == level_id)
+        if session_id is not None:
+            query = query.where(SessionLevel.session_id == session_id)
+        session_id = db.session.execute(query).scalar()
+        if session_id is None:
+            raise EnrollmentError('Level not found', status=404)
+
+        try:
+            # Locks the row even when the level is full, where the conditional
+            # UPDATE below would match nothing (on SQLite, takes the write lock)
+            db.session.execute(db.update(LEVELS).where(LEVELS.c.id == level_id).values(enrolled=LEVELS.c.enrolled))
+            seated = db.session.execute(
+                db.update(LEVELS).where(LEVELS.c.id == level_id, LEVELS.c.enrolled < LEVELS.c.capacity)
+                .values(enrolled=LEVELS.c.enrolled + 1)
+            ).rowcount == 1
+            status = ENROLLED if seated else WAITLISTED
+            enrollment = Enrollment(session_level_id=level_id, session_id=session_id, user_id=user_id,
+                                    status=status,
+                                    idempotency_key=idempotency_key or None)
+            db.session.add(enrollment)
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent request with the same key, or an existing enrollment
+            # in this session; the seat taken above is rolled back with it
+            db.session.rollback()
+            existing = (self._by_key(idempotency_key, user_id, level_id) if idempotency_key else None) \
+                or self.active_for_user(session_id, user_id)
+            if existing is None:
+                raise EnrollmentError('Idempotency key already used', status=409)
+            self._count('replayed')
+            return existing, False
+
+        self._count(status)
+        return enrollment, True
+
+    def cancel(self, enrollment_id, user_id=None):
+        # Cancels an active enrollment (only the given user's, if user_id is set).
+        # A freed seat goes to the head of the level's waitlist in the same
+        # transaction. Returns the enrollment, or None if there was nothing to cancel.
+        enrollment = db.session.get(Enrollment, enrollment_id)
+        if enrollment is None or (user_id is not None and enrollment.user_id != user_id):
+            return None
+
+        now = datetime.utcnow()
+        # The status condition makes concurrent cancels of one enrollment free one seat
+        freed = db.session.execute(
+            db.update(ENROLLMENTS).where(ENROLLMENTS.c.id == enrollment_id, ENROLLMENTS.c.status == ENROLLED)
+            .values(status=CANCELLED, updated_at=now)
+        ).rowcount
+        if freed:
+            db.session.execute(
+                db.update(LEVELS).where(LEVELS.c.id == enrollment.session_level_id)
+                .values(enrolled=LEVELS.c.enrolled - 1)
+            )
+            self._fill(enrollment.session_level_id)
+        elif not db.session.execute(
+            db.update(ENROLLMENTS).where(ENROLLMENTS.c.id == enrollment_id, ENROLLMENTS.c.status == WAITLISTED)
+            .values(status=CANCELLED, updated_at=now)
+        ).rowcount:
+            db.session.rollback()
+            return None
+        db.session.commit()
+        self._count('cancelled')
+        return enrollment
+
+    def set_capacity(self, level_id, capacity):
+        # Raising the capacity promotes waitlisted students at once. Lowering it
+        # below the seats taken removes nobody; the level just takes no new
+        # claims until enough students cancel.
+        if capacity < 0:
+            raise EnrollmentError('Capacity cannot be negative')
+        # Usually already loaded by the caller, so no query
+        level = db.session.get(SessionLevel, level_id)
+        db.session.execute(
+            db.update(LEVELS).where(LEVELS.c.id == level_id)
+            .values(capacity=capacity, updated_at=datetime.utcnow())
+        )
+        promoted = self._fill(level_id)
+        if level is not None and level.capacity != capacity:
+            audit_log.record('update', LEVELS.name, level_id, {'capacity': [level.capacity, capacity]})
+        db.session.commit()
+        return promoted
+
+    def remove_users(self, user_clause):
+        # Frees the seats of the users matching user_clause and deletes their
+        # enrollments, before the users themselves are deleted. Runs in the
+        # caller's transaction.
+        users = db.select(User.id).where(user_clause)
+        freed = db.session.execute(
+            db.select(ENROLLMENTS.c.session_level_id, db.func.count())
+            .where(ENROLLMENTS.c.user_id.in_(users), ENROLLMENTS.c.status == ENROLLED)
+            .group_by(ENROLLMENTS.c.session_level_id)
+        ).all()
+        db.session.execute(db.delete(ENROLLMENTS).where(ENROLLMENTS.c.user_id.in_(users)))
+        for level_id, count in freed:
+            db.session.execute(
+                db.update(LEVELS).where(LEVELS.c.id == level_id).values(enrolled=LEVELS.c.enrolled - count)
+            )
+            self._fill(level_id)
+        return sum(count for _, count in freed)
+
+    def _fill(self, level_id):
+        # Moves students from the head of the waitlist into free seats. Called
+        # after an UPDATE of the level row in the same transaction, which holds
+        # the row (or, on SQLite, the database) against concurrent claims.
+        level = db.session.execute(
+            db.select(LEVELS.c.capacity, LEVELS.c.enrolled).where(LEVELS.c.id == level_id).with_for_update()
+        ).one()
+        free = level.capacity - level.enrolled
+        if free <= 0:
+            return 0
+        head = db.select(ENROLLMENTS.c.id).where(
+            ENROLLMENTS.c.session_level_id == level_id, ENROLLMENTS.c.status == WAITLISTED
+        ).order_by(ENROLLMENTS.c.id).limit(free)
+        now = datetime.utcnow()
+        promoted = db.session.execute(
+            db.update(ENROLLMENTS)
+            .where(ENROLLMENTS.c.id.in_(head.scalar_subquery()), ENROLLMENTS.c.status == WAITLISTED)
+            .values(status=ENROLLED, promoted_at=now, updated_at=now)
+        ).rowcount
+        if promoted:
+            db.session.execute(
+                db.update(LEVELS).where(LEVELS.c.id == level_id).values(enrolled=LEVELS.c.enrolled + promoted)
+            )
+            self._count('promoted', promoted)
+        return promoted
+
+    def _by_key(self, idempotency_key, user_id, level_id):
+        enrollment = db.session.execute(
+            db.select(Enrollment).where(Enrollment.idempotency_key == idempotency_key)
+        ).scalar()
+        if enrollment is None:
+            return None
+        if enrollment.user_id != user_id or enrollment.session_level_id != level_id:
+            raise EnrollmentError('Idempotency key already used for a different request', status=409)
+        return enrollment
+
+    def active_for_user(self, session_id, user_id):
+        return db.session.execute(
+            db.select(Enrollment).where(Enrollment.session_id == session_id, Enrollment.user_id == user_id,
+                                        Enrollment.status.in_(ACTIVE))
+        ).scalar()
+
+    def position(self, enrollment):
+        # 1-based place on the waitlist, or None when not waitlisted
+        if enrollment.status != WAITLISTED:
+            return None
+        return db.session.execute(
+            db.select(db.func.count()).where(
+                ENROLLMENTS.c.session_level_id == enrollment.session_level_id,
+                ENROLLMENTS.c.status == WAITLISTED, ENROLLMENTS.c.id <= enrollment.id
+            )
+        ).scalar()
+
+    def levels(self, session_id):
+        # The session's levels with their waitlist lengths, in one query
+        waitlisted = db.select(db.func.count()).where(
+            ENROLLMENTS.c.session_level_id == SessionLevel.id, ENROLLMENTS.c.status == WAITLISTED
+        ).scalar_subquery()
+        return db.session.execute(
+            db.select(SessionLevel, waitlisted.label('waitlisted'))
+            .where(SessionLevel.session_id == session_id).order_by(SessionLevel.level)
+        ).all()
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+seat_allocator = SeatAllocator()
@@ -0,0 +1,155 @@
+import csv
+import io
+import tempfile
+import time
+import zlib
+from datetime import date, datetime
+
+from flask import request, current_app, stream_with_context
+
+from models import db, User, Role, Session, State, Municipality
+from user_search import user_search
+from instrumentation import instrumentation
+
+FORMATS = ('csv', 'xlsx')
+CHUNK_SIZE = 64 * 1024
+# Spreadsheets run cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+class ExportError(Exception):
+    pass
+
+
+def _cell(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ', timespec='seconds')
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        # Names and emails are chosen at self-registration; quote them so an
+        # admin opening the export never runs one (CSV injection)
+        return "'" + value
+    return value
+
+
+class Exporter:
+    # Streams query results as CSV or XLSX. Rows are read with column-only
+    # selects in batches of `batch_size` and written out batch by batch, so
+    # memory use does not grow with the number of rows.
+    def __init__(self, batch_size=1000, gzip=True):
+        self.batch_size = batch_size
+        self.gzip = gzip
+
+    def init_app(self, app):
+        self.batch_size = app.config.get('EXPORT_BATCH_SIZE', self.batch_size)
+        self.gzip = app.config.get('EXPORT_GZIP', self.gzip)
+        app.extensions['exporter'] = self
+
+    # Exports; each returns (header, select)
+
+    def users(self, search=None, role_id=None, status=None):
+        query = db.select(
+            User.id, User.username, User.email, User.name, Role.name,
+            db.case((User.is_active == True, 'active'), else_='inactive'), User.created_at
+        ).join(Role, User.role_id == Role.id)
+        query = user_search.filter(query, search, role_id, status).order_by(User.id)
+        return ['id', 'username', 'email', 'name', 'role', 'status', 'created_at'], query
+
+    def sessions(self):
+        query = db.select(
+            Session.id, Session.code, Session.name, Session.name_ar, Session.start_date, Session.end_date
+        ).order_by(Session.start_date, Session.id)
+        return ['id', 'code', 'name', 'name_ar', 'start_date', 'end_date'], query
+
+    def locations(self):
+        # Same columns as the locations import; states without municipalities get one row
+        query = db.select(
+            State.code, State.name, State.name_ar, Municipality.name, Municipality.name_ar
+        ).outerjoin(Municipality, Municipality.state_id == State.id).order_by(State.code, Municipality.name)
+        return ['state_code', 'state_name', 'state_name_ar', 'name', 'name_ar'], query
+
+    # Responses
+
+    def response(self, kind, fmt, header, query):
+        if fmt not in FORMATS:
+            raise ExportError(f'Unknown export format: {fmt}')
+        if fmt == 'xlsx':
+            try:
+                from openpyxl import Workbook
+            except ImportError:
+                raise ExportError('XLSX export requires openpyxl (pip install openpyxl)') from None
+            chunks = self._xlsx(Workbook, kind, header, self._batches(kind, fmt, query))
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        else:
+            chunks = self._csv(header, self._batches(kind, fmt, query))
+            mimetype = 'text/csv'
+
+        # XLSX files are zip archives already
+        compress = fmt == 'csv' and self.gzip and 'gzip' in request.accept_encodings
+        if compress:
+            chunks = self._gzip(chunks)
+        response = current_app.response_class(stream_with_context(chunks), mimetype=mimetype)
+        filename = f"{kind}-{datetime.utcnow().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+        response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response.headers['X-Accel-Buffering'] = 'no'
+        response.cache_control.no_store = True
+        if compress:
+            response.content_encoding = 'gzip'
+        response.vary.add('Accept-Encoding')
+        return response
+
+    def _batches(self, kind, fmt, query):
+        # Yields lists of rows; the counts and timing go to /metrics when the
+        # stream ends, including exports cut short by the client
+        started = time.perf_counter()
+        rows = 0
+        try:
+            result = db.session.execute(query.execution_options(yield_per=self.batch_size))
+            for batch in result.partitions():
+                rows += len(batch)
+                yield [[_cell(value) for value in row] for row in batch]
+        finally:
+            instrumentation.record_export(kind, fmt, rows, time.perf_counter() - started)
+
+    def _csv(self, header, batches):
+        # With a BOM so Excel opens the Arabic columns as UTF-8
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        buffer.write('\ufeff')
+        writer.writerow(header)
+        for batch in batches:
+            writer.writerows(batch)
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue().encode('utf-8')
+
+    def _xlsx(self, workbook_class, kind, header, batches):
+        # Write-only workbooks spool rows to a temporary file instead of keeping
+        # them in memory; the finished file is then sent in chunks
+        workbook = workbook_class(write_only=True)
+        sheet = workbook.create_sheet(kind)
+        sheet.append(header)
+        for batch in batches:
+            for row in batch:
+                sheet.append(row)
+        with tempfile.TemporaryFile() as f:
+            workbook.save(f)
+            f.seek(0)
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def _gzip(self, chunks):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+exporter = Exporter()
@@ -0,0 +1,329 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, request, current_app, has_request_context, before_render_template, template_rendered, got_request_exception
+from flask_login import current_user
+from sqlalchemy import event
+
+from models import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+EXPORT_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls', 'ncalls')
+PROFILE_LIMIT = 60
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(round(value, 6)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def export(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames, buckets):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._lock = threading.Lock()
+        # labels -> [per-bucket counts, sum, count]
+        self._values = {}
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * len(self.buckets), 0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def export(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            values = sorted((labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items())
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f'{self.name}_bucket{_labels(self.labelnames, labels, [("le", _number(bound))])} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}'
+            yield f'{self.name}_count{_labels(self.labelnames, labels)} {count}'
+
+
+class Gauge:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, labels, value):
+        with self._lock:
+            self._values[labels] = value
+
+    def export(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}'
+
+
+class RequestStats:
+    __slots__ = ('started', 'sql_count', 'sql_time', 'template_time', 'template_depth', 'template_started', 'profiler')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.template_started = 0.0
+        self.profiler = None
+
+
+class Instrumentation:
+    # Per-worker request metrics. Each process keeps its own counters, so a
+    # scraper sees one series per worker.
+    def __init__(self):
+        self.server_timing = True
+        self.profiling = True
+        # Only one cProfile profiler can be active per process on Python 3.12+;
+        # a request that finds it taken is served unprofiled
+        self._profile_lock = threading.Lock()
+        self.requests = Counter(
+            'ceil_requests_total', 'Requests handled.', ('endpoint', 'method', 'status')
+        )
+        self.exceptions = Counter(
+            'ceil_request_exceptions_total', 'Unhandled exceptions raised while handling a request.',
+            ('endpoint', 'exception')
+        )
+        self.latency = Histogram(
+            'ceil_request_duration_seconds', 'Time spent handling a request.',
+            ('endpoint', 'method'), LATENCY_BUCKETS
+        )
+        self.sql_statements = Histogram(
+            'ceil_request_sql_statements', 'SQL statements executed per request.',
+            ('endpoint',), STATEMENT_BUCKETS
+        )
+        self.sql_time = Counter(
+            'ceil_sql_duration_seconds_total', 'Time spent executing SQL statements.', ('endpoint',)
+        )
+        self.template_time = Counter(
+            'ceil_template_render_seconds_total', 'Time spent rendering templates.', ('endpoint',)
+        )
+        self.response_size = Histogram(
+            'ceil_response_size_bytes', 'Response body size.', ('endpoint',), SIZE_BUCKETS
+        )
+        self.export_rows = Counter(
+            'ceil_export_rows_total', 'Rows written by streaming exports.', ('kind', 'format')
+        )
+        self.export_duration = Histogram(
+            'ceil_export_duration_seconds', 'Time spent streaming an export, first to last row.',
+            ('kind', 'format'), EXPORT_BUCKETS
+        )
+        self.export_rate = Gauge(
+            'ceil_export_rows_per_second', 'Throughput of the most recent export.', ('kind', 'format')
+        )
+        self.rejections = Counter(
+            'ceil_admission_rejections_total', 'Requests refused by rate limits or the password hashing cap.',
+            ('endpoint', 'reason')
+        )
+        self._gauges = {}
+
+    def init_app(self, app):
+        self.server_timing = app.config.get('SERVER_TIMING', self.server_timing)
+        self.profiling = app.config.get('PROFILER_ENABLED', self.profiling)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._after_render, app)
+        got_request_exception.connect(self._on_exception, app)
+
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        event.listen(engine, 'handle_error', self._on_sql_error)
+        app.extensions['instrumentation'] = self
+
+    def add_gauges(self, prefix, source):
+        # source() returns a dict; each numeric value is exported as <prefix>_<key>
+        self._gauges[prefix] = source
+
+    def export(self):
+        lines = []
+        for metric in (self.requests, self.exceptions, self.latency, self.sql_statements,
+                       self.sql_time, self.template_time, self.response_size,
+                       self.export_rows, self.export_duration, self.export_rate, self.rejections):
+            lines.extend(metric.export())
+        for prefix, source in self._gauges.items():
+            for key, value in source().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'# TYPE {prefix}_{key} gauge')
+                    lines.append(f'{prefix}_{key} {_number(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def record_export(self, kind, fmt, rows, elapsed):
+        # Streamed bodies are sent after after_request, so exports report themselves
+        self.export_rows.inc((kind, fmt), rows)
+        self.export_duration.observe((kind, fmt), elapsed)
+        if elapsed > 0:
+            self.export_rate.set((kind, fmt), rows / elapsed)
+
+    def record_rejection(self, endpoint, reason):
+        self.rejections.inc((endpoint, reason))
+
+    # Request hooks
+
+    def _before_request(self):
+        stats = g.request_stats = RequestStats()
+        if self.profiling and '_profile' in request.args \
+                and current_user.is_authenticated and current_user.is_admin() \
+                and self._profile_lock.acquire(blocking=False):
+            stats.profiler = cProfile.Profile()
+            try:
+                stats.profiler.enable()
+            except ValueError:
+                # Another profiler, e.g. one started outside the app, is running
+                stats.profiler = None
+                self._profile_lock.release()
+
+    def _stop_profiler(self, stats):
+        stats.profiler.disable()
+        self._profile_lock.release()
+
+    def _after_request(self, response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        if stats.profiler is not None:
+            self._stop_profiler(stats)
+        elapsed = time.perf_counter() - stats.started
+        endpoint = request.endpoint or '<unmatched>'
+
+        self.requests.inc((endpoint, request.method, response.status_code))
+        self.latency.observe((endpoint, request.method), elapsed)
+        self.sql_statements.observe((endpoint,), stats.sql_count)
+        self.sql_time.inc((endpoint,), stats.sql_time)
+        self.template_time.inc((endpoint,), stats.template_time)
+        # Streamed responses have no known length until they are sent
+        size = response.content_length
+        if size is None and not response.is_streamed:
+            size = response.calculate_content_length()
+        if size is not None:
+            self.response_size.observe((endpoint,), size)
+
+        if stats.profiler is not None:
+            response = self._profile_response(stats, elapsed, endpoint, response.status_code)
+        if self.server_timing:
+            response.headers['Server-Timing'] = (
+                f'app;dur={elapsed * 1000:.2f}, '
+                f'db;dur={stats.sql_time * 1000:.2f};desc="{stats.sql_count} queries", '
+                f'tpl;dur={stats.template_time * 1000:.2f}'
+            )
+        return response
+
+    def _teardown_request(self, exception):
+        # after_request did not run, e.g. the response could not be built
+        stats = g.pop('request_stats', None)
+        if stats is not None and stats.profiler is not None:
+            self._stop_profiler(stats)
+
+    def _profile_response(self, stats, elapsed, endpoint, status):
+        sort = request.args.get('_profile')
+        output = io.StringIO()
+        output.write(
+            f'{request.method} {request.full_path} -> {endpoint} {status}\n'
+            f'{elapsed * 1000:.2f} ms total, {stats.sql_count} SQL statements in {stats.sql_time * 1000:.2f} ms, '
+            f'templates {stats.template_time * 1000:.2f} ms\n\n'
+        )
+        pstats.Stats(stats.profiler, stream=output).sort_stats(
+            sort if sort in PROFILE_SORT_KEYS else 'cumulative'
+        ).print_stats(PROFILE_LIMIT)
+        return current_app.response_class(output.getvalue(), mimetype='text/plain')
+
+    def _on_exception(self, sender, exception, **extra):
+        self.exceptions.inc((request.endpoint or '<unmatched>', type(exception).__name__))
+
+    # Template signals; nested renders (cached fragments) count once
+
+    def _before_render(self, sender, template, context, **extra):
+        stats = g.get('request_stats') if has_request_context() else None
+        if stats is not None:
+            if stats.template_depth == 0:
+                stats.template_started = time.perf_counter()
+            stats.template_depth += 1
+
+    def _after_render(self, sender, template, context, **extra):
+        stats = g.get('request_stats') if has_request_context() else None
+        if stats is not None and stats.template_depth:
+            stats.template_depth -= 1
+            if stats.template_depth == 0:
+                stats.template_time += time.perf_counter() - stats.template_started
+
+    # Engine events
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_started'].pop()
+        stats = g.get('request_stats') if has_request_context() else None
+        if stats is not None:
+            stats.sql_count += 1
+            stats.sql_time += elapsed
+
+    def _on_sql_error(self, exception_context):
+        started = exception_context.connection.info.get('query_started') if exception_context.connection else None
+        if started:
+            started.pop()
+
+
+instrumentation = Instrumentation()
@@ -0,0 +1,240 @@
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from models import db, Job
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+STATUSES = (QUEUED, RUNNING, SUCCEEDED, FAILED)
+
+logger = logging.getLogger(__name__)
+
+
+class JobContext:
+    # Handed to job handlers as their first argument
+    def __init__(self, job_id, attempt):
+        self.id = job_id
+        self.attempt = attempt
+
+    def progress(self, done, total=None):
+        # Also refreshes the job's lock, so long jobs that report progress are not
+        # taken for stale. Written on a separate connection: call it between the
+        # handler's own transactions (e.g. after each committed chunk).
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.update(Job.__table__).where(Job.__table__.c.id == self.id)
+                .values(progress=done, progress_total=total, locked_at=datetime.utcnow())
+            )
+
+
+class JobQueue:
+    # Durable job queue stored in the application database, so no broker is
+    # needed. Web workers enqueue; `flask worker` claims and runs due jobs.
+    # Failed jobs are retried with exponential backoff up to max_attempts.
+    def __init__(self, poll_interval=1.0, timeout=600, retry_backoff=10, max_backoff=3600,
+                 retention_days=30, eager=False):
+        self.poll_interval = poll_interval
+        # Running jobs whose worker has been silent this long are requeued
+        self.timeout = timeout
+        self.retry_backoff = retry_backoff
+        self.max_backoff = max_backoff
+        self.retention_days = retention_days
+        # Run jobs inside enqueue(), for development without a worker
+        self.eager = eager
+        self.handlers = {}
+
+    def init_app(self, app):
+        self.poll_interval = app.config.get('JOBS_POLL_INTERVAL', self.poll_interval)
+        self.timeout = app.config.get('JOBS_TIMEOUT', self.timeout)
+        self.retry_backoff = app.config.get('JOBS_RETRY_BACKOFF', self.retry_backoff)
+        self.retention_days = app.config.get('JOBS_RETENTION_DAYS', self.retention_days)
+        self.eager = app.config.get('JOBS_EAGER', self.eager)
+        app.extensions['job_queue'] = self
+
+    def handler(self, kind, max_attempts=3, fatal=(), discard=None):
+        # Registers f(job, **payload) for `kind`. Exceptions listed in `fatal`
+        # fail the job at once; anything else is retried. `discard(**payload)`
+        # is called when maintain() fails a job whose worker died, to remove
+        # what the handler would have cleaned up, such as an uploaded file.
+        def decorator(f):
+            self.handlers[kind] = (f, max_attempts, fatal, discard)
+            return f
+        return decorator
+
+    def enqueue(self, kind, payload=None, created_by=None):
+        if kind not in self.handlers:
+            raise KeyError(f'No job handler registered for {kind!r}')
+        job = Job(kind=kind, payload=json.dumps(payload or {}), created_by=created_by,
+                  max_attempts=self.handlers[kind][1], run_at=datetime.utcnow())
+        db.session.add(job)
+        db.session.commit()
+        if self.eager and self.claim('eager', job_id=job.id):
+            self.run(job.id)
+        return job
+
+    def claim(self, worker_id, job_id=None):
+        # Marks the oldest due job as running and returns its id, or None.
+        # The status check in the UPDATE stops two workers taking the same job.
+        while True:
+            now = datetime.utcnow()
+            query = db.select(Job.id).where(Job.status == QUEUED, Job.run_at <= now)
+            if job_id is not None:
+                query = query.where(Job.id == job_id)
+            candidate = db.session.execute(query.order_by(Job.run_at, Job.id).limit(1)).scalar()
+            if candidate is None:
+                db.session.rollback()
+                return None
+            result = db.session.execute(
+                db.update(Job).where(Job.id == candidate, Job.status == QUEUED)
+                .values(status=RUNNING, locked_by=worker_id, locked_at=now, started_at=now,
+                        attempts=Job.attempts + 1)
+                .execution_options(synchronize_session=False)
+            )
+            db.session.commit()
+            if result.rowcount:
+                return candidate
+
+    def run(self, job_id):
+        job = db.session.get(Job, job_id)
+        handler, _, fatal, _ = self.handlers.get(job.kind, (None, 0, (), None))
+        context = JobContext(job.id, job.attempts)
+        payload = json.loads(job.payload)
+        started = time.perf_counter()
+        try:
+            if handler is None:
+                raise LookupError(f'No job handler registered for {job.kind!r}')
+            result = handler(context, **payload)
+        except Exception as e:
+            db.session.rollback()
+            job = db.session.get(Job, job_id)
+            job.error = str(e) or type(e).__name__
+            if handler is not None and not isinstance(e, fatal) and job.attempts < job.max_attempts:
+                delay = self.retry_delay(job.attempts)
+                job.status = QUEUED
+                job.run_at = datetime.utcnow() + timedelta(seconds=delay)
+                logger.warning('Job %s (%s) attempt %s failed, retrying in %ss: %s',
+                               job.id, job.kind, job.attempts, delay, job.error)
+            else:
+                job.status = FAILED
+                job.finished_at = datetime.utcnow()
+                if isinstance(e, fatal):
+                    logger.warning('Job %s (%s) failed: %s', job.id, job.kind, job.error)
+                else:
+                    logger.exception('Job %s (%s) failed', job.id, job.kind)
+        else:
+            job = db.session.get(Job, job_id)
+            job.status = SUCCEEDED
+            job.result = json.dumps(result)
+            job.error = None
+            job.finished_at = datetime.utcnow()
+            logger.info('Job %s (%s) finished in %.3fs', job.id, job.kind, time.perf_counter() - started)
+        job.locked_by = None
+        job.locked_at = None
+        db.session.commit()
+
+    def retry_delay(self, attempt):
+        return min(self.retry_backoff * 2 ** (attempt - 1), self.max_backoff)
+
+    def maintain(self):
+        # Requeues jobs left running by a worker that died, and drops old finished jobs
+        now = datetime.utcnow()
+        stale = db.and_(Job.status == RUNNING, Job.locked_at < now - timedelta(seconds=self.timeout))
+        failed = db.session.execute(
+            db.select(Job.id, Job.kind, Job.payload).where(stale, Job.attempts >= Job.max_attempts)
+        ).all()
+        if failed:
+            db.session.execute(
+                db.update(Job).where(stale, Job.id.in_([job.id for job in failed]))
+                .values(status=FAILED, error='Worker stopped responding', finished_at=now,
+                        locked_by=None, locked_at=None)
+                .execution_options(synchronize_session=False)
+            )
+        requeued = db.session.execute(
+            db.update(Job).where(stale)
+            .values(status=QUEUED, run_at=now, locked_by=None, locked_at=None)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        if self.retention_days:
+            db.session.execute(
+                db.delete(Job).where(Job.status.in_((SUCCEEDED, FAILED)),
+                                     Job.finished_at < now - timedelta(days=self.retention_days))
+                .execution_options(synchronize_session=False)
+            )
+        db.session.commit()
+        if requeued:
+            logger.warning('Requeued %s stale jobs', requeued)
+        for job in failed:
+            discard = self.handlers.get(job.kind, (None, 0, (), None))[3]
+            if discard is None:
+                continue
+            try:
+                discard(**json.loads(job.payload))
+            except Exception:
+                logger.exception('Could not discard the payload of failed job %s (%s)', job.id, job.kind)
+
+    def work(self, app, threads=1, stop=None):
+        # Runs `threads` worker threads in this process until stopped by
+        # SIGINT/SIGTERM or `stop`; jobs in progress are allowed to finish
+        stop = stop or threading.Event()
+        name = f'{socket.gethostname()}:{os.getpid()}'
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+        def loop(index):
+            worker_id = f'{name}:{index}'
+            while not stop.is_set():
+                try:
+                    with app.app_context():
+                        job_id = self.claim(worker_id)
+                        if job_id is not None:
+                            self.run(job_id)
+                            continue
+                except Exception:
+                    logger.exception('Job worker %s error', worker_id)
+                stop.wait(self.poll_interval)
+
+        workers = [threading.Thread(target=loop, args=(i,), name=f'job-worker-{i}') for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        logger.info('Job worker %s started with %s threads', name, threads)
+        try:
+            while not stop.is_set():
+                with app.app_context():
+                    self.maintain()
+                stop.wait(min(60, self.timeout))
+        except KeyboardInterrupt:
+            stop.set()
+        for worker in workers:
+            worker.join()
+
+    def status(self, job):
+        return {
+            'id': job.id,
+            'kind': job.kind,
+            'status': job.status,
+            'attempts': job.attempts,
+            'max_attempts': job.max_attempts,
+            'progress': job.progress,
+            'progress_total': job.progress_total,
+            'result': json.loads(job.result) if job.result else None,
+            'error': job.error,
+            'created_at': job.created_at.isoformat() if job.created_at else None,
+            'started_at': job.started_at.isoformat() if job.started_at else None,
+            'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+            'run_at': job.run_at.isoformat() if job.status == QUEUED else None,
+        }
+
+    def stats(self):
+        counts = dict(db.session.execute(db.select(Job.status, db.func.count()).group_by(Job.status)).all())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+
+job_queue = JobQueue()
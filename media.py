@@ -0,0 +1,269 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, which only runs the single-process server models
+    fcntl = None
+
+CHUNK_SIZE = 64 * 1024
+VARIANT_WIDTHS = (128, 256, 512)
+# Unfinished resumable uploads older than this are removed
+PARTIAL_TTL = 24 * 3600
+
+MEDIA_NAME = re.compile(r'^[0-9a-f]{32}(-w\d+)?\.(png|jpg|gif|webp)$')
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+logger = logging.getLogger(__name__)
+
+
+class MediaError(Exception):
+    pass
+
+
+class UploadOffsetError(MediaError):
+    # The client's offset does not match what the server has; it should resume from `offset`
+    def __init__(self, offset):
+        super().__init__(f'Upload is at offset {offset}')
+        self.offset = offset
+
+
+def sniff_image(header):
+    # Extension for the image type given the first bytes of a file, or None
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+class MediaStore:
+    # Content-addressed image storage: files are named after their SHA-256, so
+    # identical uploads are stored once and every URL can be cached forever.
+    # Resized WebP variants are generated in a background thread pool.
+    def __init__(self, folder=None, workers=2, widths=VARIANT_WIDTHS, max_size=16 * 1024 * 1024):
+        self.folder = folder
+        self.workers = workers
+        self.widths = widths
+        self.max_size = max_size
+        self._executor = None
+        self._lock = threading.Lock()
+        # Serialises appends where flock is unavailable
+        self._append_lock = threading.Lock()
+
+    def init_app(self, app):
+        self.folder = app.config.get('MEDIA_FOLDER') or os.path.join(app.instance_path, 'media')
+        self.workers = app.config.get('MEDIA_WORKERS', self.workers)
+        self.widths = tuple(app.config.get('MEDIA_VARIANT_WIDTHS', self.widths))
+        self.max_size = app.config.get('MEDIA_MAX_SIZE', self.max_size)
+        os.makedirs(self.partial_folder, exist_ok=True)
+        app.add_template_global(self.variant_url, 'media_variant')
+        app.extensions['media_store'] = self
+
+    @property
+    def partial_folder(self):
+        return os.path.join(self.folder, 'partial')
+
+    def exists(self, name):
+        return bool(MEDIA_NAME.match(name)) and os.path.exists(os.path.join(self.folder, name))
+
+    def save(self, stream):
+        # Streams a file object to disk in chunks and returns its stored name
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.partial_folder, prefix='.save-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_size:
+                        raise MediaError(f'File is larger than {self.max_size // (1024 * 1024)} MB')
+                    digest.update(chunk)
+                    f.write(chunk)
+            return self._store(tmp_path, digest.hexdigest())
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # Resumable uploads: start, then append chunks at the current offset until complete
+
+    def start_upload(self, filename, size):
+        if not 0 < size <= self.max_size:
+            raise MediaError(f'File size must be between 1 byte and {self.max_size // (1024 * 1024)} MB')
+        self._purge_partial()
+        upload_id = uuid.uuid4().hex
+        with open(self._partial_path(upload_id) + '.json', 'w') as f:
+            json.dump({'filename': filename, 'size': size}, f)
+        open(self._partial_path(upload_id), 'wb').close()
+        return upload_id
+
+    def upload_status(self, upload_id):
+        # Raises KeyError for unknown or finished uploads
+        meta = self._read_meta(upload_id)
+        try:
+            return {'offset': os.path.getsize(self._partial_path(upload_id)), 'size': meta['size']}
+        except FileNotFoundError:
+            raise KeyError(upload_id) from None
+
+    def append(self, upload_id, offset, stream):
+        # Returns (offset, stored name or None until the upload is complete)
+        meta = self._read_meta(upload_id)
+        path = self._partial_path(upload_id)
+        with self._locked_partial(path, meta['size']) as f:
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                raise UploadOffsetError(current)
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                current += len(chunk)
+                if current > meta['size']:
+                    f.truncate(offset)
+                    raise MediaError('More data than the declared upload size')
+                f.write(chunk)
+            f.flush()
+            if current < meta['size']:
+                return current, None
+
+            digest = hashlib.sha256()
+            f.seek(0)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+            try:
+                name = self._store(path, digest.hexdigest())
+            finally:
+                for leftover in (path, path + '.json'):
+                    if os.path.exists(leftover):
+                        os.remove(leftover)
+            return current, name
+
+    # Variants
+
+    def variant_url(self, url, width):
+        # Jinja global: URL of the WebP variant at `width` once it exists, else `url`
+        if not url or not url.startswith('/media/'):
+            return url
+        stem = os.path.splitext(url.rsplit('/', 1)[1])[0]
+        variant = f'{stem}-w{width}.webp'
+        if os.path.exists(os.path.join(self.folder, variant)):
+            return url.rsplit('/', 1)[0] + '/' + variant
+        return url
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _store(self, tmp_path, digest):
+        with open(tmp_path, 'rb') as f:
+            extension = sniff_image(f.read(16))
+        if extension is None:
+            raise MediaError('Only PNG, JPEG, GIF and WebP images are accepted')
+        name = f'{digest[:32]}.{extension}'
+        path = os.path.join(self.folder, name)
+        if not os.path.exists(path):
+            os.replace(tmp_path, path)
+        self._submit_variants(name)
+        return name
+
+    def _submit_variants(self, name):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='media')
+            executor = self._executor
+        executor.submit(self._make_variants, name)
+
+    def _make_variants(self, name):
+        try:
+            from PIL import Image
+        except ImportError:
+            logger.warning('Pillow is not installed; serving %s without resized variants', name)
+            return
+        stem = os.path.splitext(name)[0]
+        try:
+            with Image.open(os.path.join(self.folder, name)) as image:
+                image.load()
+                for width in self.widths:
+                    if width >= image.width:
+                        continue
+                    path = os.path.join(self.folder, f'{stem}-w{width}.webp')
+                    if os.path.exists(path):
+                        continue
+                    variant = image.copy()
+                    variant.thumbnail((width, width * 10))
+                    fd, tmp_path = tempfile.mkstemp(dir=self.partial_folder, prefix='.variant-')
+                    with os.fdopen(fd, 'wb') as f:
+                        variant.save(f, 'WEBP', quality=80, method=4)
+                    os.replace(tmp_path, path)
+        except Exception:
+            logger.exception('Could not generate variants for %s', name)
+
+    def _partial_path(self, upload_id):
+        if not UPLOAD_ID.match(upload_id):
+            raise KeyError(upload_id)
+        return os.path.join(self.partial_folder, upload_id)
+
+    def _read_meta(self, upload_id):
+        try:
+            with open(self._partial_path(upload_id) + '.json') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise KeyError(upload_id) from None
+
+    @contextmanager
+    def _locked_partial(self, path, size):
+        # The partial file, open for reading and appending under an exclusive
+        # flock, so appends from different workers on the host are serialised.
+        # Raises UploadOffsetError(size) once a concurrent request has finished
+        # the upload, which moves or removes the file.
+        try:
+            f = open(path, 'r+b')
+        except FileNotFoundError:
+            raise UploadOffsetError(size) from None
+        with f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            else:
+                self._append_lock.acquire()
+            try:
+                try:
+                    finished = not os.path.samestat(os.fstat(f.fileno()), os.stat(path))
+                except FileNotFoundError:
+                    finished = True
+                if finished:
+                    raise UploadOffsetError(size)
+                yield f
+            finally:
+                if fcntl is None:
+                    self._append_lock.release()
+
+    def _purge_partial(self):
+        cutoff = time.time() - PARTIAL_TTL
+        for entry in os.scandir(self.partial_folder):
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+
+media_store = MediaStore()
@@ -1,10 +1,19 @@
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+import json
+import unicodedata
+
+from passwords import password_hasher
 
 db = SQLAlchemy()
 
+def normalize_search(value):
+    # Lower-cased, compatibility-normalised form used by the indexed search columns
+    if not value:
+        return None
+    return unicodedata.normalize('NFKC', value).casefold().strip()
+
 class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
@@ -15,20 +24,42 @@ class Role(db.Model):
         return f'<Role {self.name}>'
 
 class User(UserMixin, db.Model):
+    __table_args__ = (
+        db.Index('ix_user_role_active_created', 'role_id', 'is_active', 'created_at'),
+        # /users filtered by role alone: is_active would otherwise sit between
+        # role_id and the (created_at, id) keyset order
+        db.Index('ix_user_role_created', 'role_id', 'created_at', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
-    password_hash = db.Column(db.String(128))
-    role_id = db.Column(db.Integer, db.ForeignKey('role.id'), nullable=False)
-    is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    name = db.Column(db.String(120))
+    password_hash = db.Column(db.String(255))
+    # active_history keeps the previous value around for the dashboard counters
+    role_id = db.column_property(db.Column(db.Integer, db.ForeignKey('role.id'), nullable=False), active_history=True)
+    is_active = db.column_property(db.Column(db.Boolean, default=True), active_history=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # Normalised copies of the searchable fields, kept in sync by the validator below
+    username_norm = db.Column(db.String(80), index=True)
+    email_norm = db.Column(db.String(120), index=True)
+    name_norm = db.Column(db.String(120), index=True)
+
+    @db.validates('username', 'email', 'name')
+    def _normalize_search_fields(self, key, value):
+        setattr(self, f'{key}_norm', normalize_search(value))
+        return value
+
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
         
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return password_hasher.needs_rehash(self.password_hash)
     
     def is_admin(self):
         return self.role.name == 'Admin'
@@ -52,9 +83,58 @@ class Session(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    # Levels offered in this session, each with its own seats
+    levels = db.relationship('SessionLevel', backref='session', lazy=True, cascade='all, delete-orphan')
+
     def __repr__(self):
         return f'<Session {self.name}>'
 
+class SessionLevel(db.Model):
+    __tablename__ = 'session_levels'
+    __table_args__ = (
+        db.UniqueConstraint('session_id', 'level', name='uq_session_levels_session_id_level'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=False)
+    level = db.Column(db.String(50), nullable=False)
+    capacity = db.Column(db.Integer, nullable=False, default=0)
+    # Seats taken, changed only by conditional UPDATEs in enrollment.py
+    enrolled = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    enrollments = db.relationship('Enrollment', backref='session_level', lazy=True, cascade='all, delete-orphan')
+
+    def __repr__(self):
+        return f'<SessionLevel {self.level} {self.enrolled}/{self.capacity}>'
+
+class Enrollment(db.Model):
+    __tablename__ = 'enrollments'
+    __table_args__ = (
+        # Waitlist order and per-level counts
+        db.Index('ix_enrollments_level_status_id', 'session_level_id', 'status', 'id'),
+        # One seat or waitlist place per student and session
+        db.Index('ux_enrollments_session_user_active', 'session_id', 'user_id', unique=True,
+                 sqlite_where=db.text("status IN ('enrolled', 'waitlisted')"),
+                 postgresql_where=db.text("status IN ('enrolled', 'waitlisted')")),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    session_level_id = db.Column(db.Integer, db.ForeignKey('session_levels.id'), nullable=False)
+    # Copied from the level so the unique index can cover the whole session
+    session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    status = db.Column(db.String(20), nullable=False)
+    # Client-chosen key; repeating a claim with the same key returns the first result
+    idempotency_key = db.Column(db.String(64), unique=True)
+    promoted_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Enrollment {self.id} {self.status}>'
+
 class ApplicationSettings(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     organization_name = db.Column(db.String(100), nullable=False)
@@ -98,13 +178,118 @@ class State(db.Model):
 
 class Municipality(db.Model):
     __tablename__ = 'municipalities'
+    __table_args__ = (
+        db.Index('ix_municipalities_state_id_name', 'state_id', 'name'),
+        # Serves the (state_id, id) keyset order of /api/municipalities
+        db.Index('ix_municipalities_state_id_id', 'state_id', 'id'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     name_ar = db.Column(db.String(100), nullable=False)
-    state_id = db.Column(db.Integer, db.ForeignKey('states.id'), nullable=False)
+    state_id = db.column_property(db.Column(db.Integer, db.ForeignKey('states.id'), nullable=False), active_history=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
-        return f'<Municipality {self.name}>' 
\ No newline at end of file
+        return f'<Municipality {self.name}>'
+
+class CacheVersion(db.Model):
+    __tablename__ = 'cache_versions'
+
+    # One row per cached dataset; workers compare versions to detect changes
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    @classmethod
+    def current(cls, name):
+        return db.session.execute(
+            db.select(cls.version).where(cls.name == name)
+        ).scalar() or 0
+
+    @classmethod
+    def bump(cls, name):
+        # Runs inside the caller's transaction so the bump commits with the change
+        result = db.session.execute(
+            db.update(cls).where(cls.name == name).values(
+                version=cls.version + 1, updated_at=datetime.utcnow()
+            )
+        )
+        if not result.rowcount:
+            db.session.add(cls(name=name, version=1))
+
+    def __repr__(self):
+        return f'<CacheVersion {self.name}={self.version}>'
+
+
+class StatCounter(db.Model):
+    __tablename__ = 'stat_counters'
+
+    # Denormalised counts for the dashboard, maintained by dashboard_stats;
+    # `key` splits a counter by role, state, etc. and is '' for totals
+    name = db.Column(db.String(50), primary_key=True)
+    key = db.Column(db.String(50), primary_key=True, default='')
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<StatCounter {self.name}[{self.key}]={self.value}>'
+
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    # Background work run by `flask worker`; see jobs.py
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    progress_total = db.Column(db.Integer)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    # Plain user id rather than a foreign key, so job history outlives deleted users
+    created_by = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
+
+
+class AuditLog(db.Model):
+    __tablename__ = 'audit_log'
+    __table_args__ = (
+        db.Index('ix_audit_log_created_at_id', 'created_at', 'id'),
+        db.Index('ix_audit_log_actor_created_at', 'actor_id', 'created_at', 'id'),
+        db.Index('ix_audit_log_table_row', 'table_name', 'row_id'),
+    )
+
+    # Who changed what and when; written in batches by audit.py. Plain ids and
+    # a copy of the username, so entries outlive deleted users and rows.
+    id = db.Column(db.Integer, primary_key=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    actor_id = db.Column(db.Integer)
+    actor_name = db.Column(db.String(80))
+    action = db.Column(db.String(20), nullable=False)
+    table_name = db.Column(db.String(50), nullable=False)
+    row_id = db.Column(db.Integer)
+    # JSON {"column": [before, after]}; before is null for inserts, after for deletes
+    changes = db.Column(db.Text, nullable=False, default='{}')
+    endpoint = db.Column(db.String(100))
+    remote_addr = db.Column(db.String(45))
+
+    def change_set(self):
+        return json.loads(self.changes)
+
+    def __repr__(self):
+        return f'<AuditLog {self.id} {self.action} {self.table_name}:{self.row_id}>'
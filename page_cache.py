@@ -0,0 +1,199 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+
+from flask import request, render_template, make_response
+from flask_login import current_user
+from markupsafe import Markup
+
+from settings_cache import settings_cache
+
+
+class MemoryBackend:
+    # Per-process LRU
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class FileSystemBackend:
+    # Shared by every worker on the host; one pickle file per key. Beyond
+    # maxsize files, the least recently written are removed.
+    def __init__(self, directory, maxsize=256):
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires <= time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        # Write to a temporary file and rename so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((time.time() + ttl, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self._path(key))
+        self._prune()
+
+    def _prune(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith('.tmp-'):
+                    continue
+                try:
+                    entries.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    pass
+        if len(entries) <= self.maxsize:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.maxsize]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class PageCache:
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend or MemoryBackend()
+        # Upper bound on entry age; entries are normally replaced by a settings version change
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('PAGE_CACHE_TTL', self.ttl)
+        if app.config.get('PAGE_CACHE_BACKEND', 'memory') == 'filesystem':
+            self.backend = FileSystemBackend(
+                app.config.get('PAGE_CACHE_DIR') or os.path.join(app.instance_path, 'page_cache'),
+                app.config.get('PAGE_CACHE_SIZE', 256)
+            )
+        else:
+            self.backend = MemoryBackend(app.config.get('PAGE_CACHE_SIZE', 256))
+        app.add_template_global(self.fragment, 'cached_fragment')
+        app.extensions['page_cache'] = self
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value, self.ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'backend': type(self.backend).__name__,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+        }
+
+    def anonymous_page(self, view=None, args=()):
+        # Full-page cache for anonymous GETs, keyed on the path, the query `args`
+        # the view reads and the settings version, with ETag/Last-Modified so
+        # repeat visitors get a 304. Requests with any other query arg are not
+        # cached, so made-up query strings cannot fill the cache.
+        if view is None:
+            return lambda view: self.anonymous_page(view, args)
+
+        @wraps(view)
+        def wrapper(*view_args, **kwargs):
+            if request.method != 'GET' or current_user.is_authenticated \
+                    or any(name not in args for name in request.args):
+                return view(*view_args, **kwargs)
+
+            version = settings_cache.version
+            query = urlencode(sorted(request.args.items(multi=True)))
+            key = f'page:{request.path}?{query}:{version}'
+            entry = self.get(key)
+            if entry is None:
+                response = make_response(view(*view_args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                settings = settings_cache.get()
+                entry = {
+                    'body': body,
+                    'mimetype': response.mimetype,
+                    'etag': hashlib.sha1(body).hexdigest(),
+                    'last_modified': settings.updated_at if settings else None,
+                }
+                self.set(key, entry)
+
+            response = make_response(entry['body'])
+            response.mimetype = entry['mimetype']
+            response.set_etag(entry['etag'])
+            if entry['last_modified']:
+                response.last_modified = entry['last_modified']
+            response.cache_control.no_cache = True
+            response.vary.add('Cookie')
+            return response.make_conditional(request)
+        return wrapper
+
+    def fragment(self, name, *vary):
+        # Jinja global: renders templates/<name>.html once per settings version
+        key = f'fragment:{name}:{settings_cache.version}:{":".join(map(str, vary))}'
+        html = self.get(key)
+        if html is None:
+            html = render_template(f'{name}.html')
+            self.set(key, html)
+        return Markup(html)
+
+
+page_cache = PageCache()
@@ -0,0 +1,82 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+DEFAULT_METHOD = 'scrypt'
+
+
+def _hash_chunk(method, salt_length, passwords):
+    # Runs in a pool worker process
+    return [generate_password_hash(password, method, salt_length) for password in passwords]
+
+
+class PasswordHasher:
+    def __init__(self, method=DEFAULT_METHOD, salt_length=16, workers=0, batch_threshold=64):
+        # method is any Werkzeug method string, e.g. 'scrypt:16384:8:1' or 'pbkdf2:sha256:600000'
+        self.method = method
+        self.salt_length = salt_length
+        # Process pool size for hash_many(); 0 uses every CPU, 1 hashes in-process
+        self.workers = workers
+        # Batches smaller than this are not worth shipping to the pool
+        self.batch_threshold = batch_threshold
+        self._canonical_method = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.method = app.config.get('PASSWORD_HASH_METHOD', self.method)
+        self.workers = app.config.get('PASSWORD_HASH_WORKERS', self.workers)
+        self._canonical_method = None
+        app.extensions['password_hasher'] = self
+
+    @property
+    def canonical_method(self):
+        # Werkzeug fills in default parameters, e.g. 'scrypt' -> 'scrypt:32768:8:1'.
+        # Hashing once with a minimal salt is the reliable way to learn the stored prefix.
+        if self._canonical_method is None:
+            self._canonical_method = generate_password_hash('', self.method, 1).split('$', 1)[0]
+        return self._canonical_method
+
+    def hash(self, password):
+        return generate_password_hash(password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        if not password_hash or password is None:
+            return False
+        return check_password_hash(password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        return bool(password_hash) and password_hash.split('$', 1)[0] != self.canonical_method
+
+    def hash_many(self, passwords):
+        passwords = list(passwords)
+        workers = self.workers or os.cpu_count() or 1
+        if workers <= 1 or len(passwords) < self.batch_threshold:
+            return [self.hash(password) for password in passwords]
+
+        chunk_size = -(-len(passwords) // (workers * 4))
+        chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+        results = self._executor(workers).map(
+            _hash_chunk,
+            [self.method] * len(chunks),
+            [self.salt_length] * len(chunks),
+            chunks
+        )
+        return [password_hash for chunk in results for password_hash in chunk]
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def _executor(self, workers):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=workers)
+            return self._pool
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+from models import db, User, Role, CacheVersion
+
+PRINCIPALS_VERSION_KEY = 'principals'
+# session.info key holding the ids to evict once the transaction commits
+PENDING_KEY = 'principal_cache_evict'
+# Stands for every id in the pending set
+ALL = '*'
+
+RoleRef = namedtuple('RoleRef', 'name color')
+
+
+class UserPrincipal(namedtuple('UserPrincipal', 'id username email role_id role_name role_color is_active')):
+    # Immutable stand-in for the User model on authenticated requests.
+    # Exposes the attributes and helpers templates and routes rely on.
+    __slots__ = ()
+
+    is_anonymous = False
+
+    @property
+    def is_authenticated(self):
+        return bool(self.is_active)
+
+    @property
+    def role(self):
+        return RoleRef(self.role_name, self.role_color)
+
+    def get_id(self):
+        return str(self.id)
+
+    def is_admin(self):
+        return self.role_name == 'Admin'
+
+    def is_teacher(self):
+        return self.role_name == 'Teacher'
+
+    def is_student(self):
+        return self.role_name == 'Student'
+
+
+class PrincipalCache:
+    def __init__(self, ttl=300, maxsize=1024, check_interval=5.0):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # Seconds between checks of the shared version stamp written by other workers
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+        self._checked_at = 0.0
+        # Bumped on every eviction, so a load that raced it is not cached
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('PRINCIPAL_CACHE_TTL', self.ttl)
+        self.maxsize = app.config.get('PRINCIPAL_CACHE_SIZE', self.maxsize)
+        self.check_interval = app.config.get('SETTINGS_CACHE_CHECK_INTERVAL', self.check_interval)
+        app.extensions['principal_cache'] = self
+
+    def get(self, user_id):
+        if self.ttl <= 0:
+            self.misses += 1
+            return self._load(user_id)
+
+        self._check_version()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[1]
+
+        generation = self._generation
+        principal = self._load(user_id)
+        self.misses += 1
+        if principal is not None:
+            with self._lock:
+                if generation != self._generation:
+                    return principal
+                self._entries[user_id] = (now + self.ttl, principal)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return principal
+
+    def invalidate(self, *user_ids):
+        # Call before commit so other workers see the new version with the change.
+        # This worker's entries are evicted after the commit: evicted earlier, a
+        # concurrent request could cache the old row again until the next check.
+        CacheVersion.bump(PRINCIPALS_VERSION_KEY)
+        db.session.info.setdefault(PENDING_KEY, set()).update(user_ids)
+
+    def invalidate_all(self):
+        # For set-based updates where the affected ids are not known
+        CacheVersion.bump(PRINCIPALS_VERSION_KEY)
+        db.session.info.setdefault(PENDING_KEY, set()).add(ALL)
+
+    def evict(self, user_ids):
+        if ALL in user_ids:
+            self.clear()
+            return
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._version = None
+            self._checked_at = 0.0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            'size': len(self._entries),
+            'version': self._version,
+        }
+
+    def _check_version(self):
+        now = time.monotonic()
+        if self._version is not None and now - self._checked_at < self.check_interval:
+            return
+        version = CacheVersion.current(PRINCIPALS_VERSION_KEY)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            self._checked_at = now
+
+    def _load(self, user_id):
+        # One joined select; no ORM objects are left attached to the session
+        row = db.session.execute(
+            db.select(
+                User.id, User.username, User.email, User.role_id,
+                Role.name, Role.color, User.is_active
+            ).join(Role, User.role_id == Role.id).where(User.id == user_id)
+        ).first()
+        return UserPrincipal(*row) if row else None
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _evict_committed(session):
+    user_ids = session.info.pop(PENDING_KEY, None)
+    if user_ids:
+        principal_cache.evict(user_ids)
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+principal_cache = PrincipalCache()
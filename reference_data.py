@@ -0,0 +1,141 @@
+import hashlib
+import json
+import threading
+import time
+from collections import namedtuple
+from datetime import date
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+from models import db, Role, State, Session, CacheVersion
+
+VERSION_PREFIX = 'ref:'
+# session.info key holding the tables to evict once the transaction commits
+PENDING_KEY = 'reference_data_evict'
+
+RoleRecord = namedtuple('RoleRecord', 'id name color')
+StateRecord = namedtuple('StateRecord', 'id code name name_ar')
+SessionRecord = namedtuple('SessionRecord', 'id code name name_ar start_date end_date')
+
+# Table name -> (record type, select returning the record's columns in order)
+TABLES = {
+    'roles': (RoleRecord, lambda: db.select(Role.id, Role.name, Role.color).order_by(Role.id)),
+    'states': (StateRecord, lambda: db.select(State.id, State.code, State.name, State.name_ar).order_by(State.code)),
+    'sessions': (SessionRecord, lambda: db.select(
+        Session.id, Session.code, Session.name, Session.name_ar, Session.start_date, Session.end_date
+    ).order_by(Session.id)),
+}
+
+
+def _json_value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+class ReferenceTable:
+    __slots__ = ('version', 'records', 'by_id', 'payload', 'etag')
+
+    def __init__(self, version, records):
+        self.version = version
+        self.records = records
+        self.by_id = {record.id: record for record in records}
+        self.payload = json.dumps(
+            [{field: _json_value(value) for field, value in record._asdict().items()} for record in records],
+            ensure_ascii=False, separators=(',', ':')
+        ).encode('utf-8')
+        self.etag = hashlib.sha256(self.payload).hexdigest()[:32]
+
+
+class ReferenceData:
+    # Small, rarely changing tables loaded once per process as tuples of
+    # namedtuples. Routes that change them call invalidate() before committing;
+    # other workers notice the new version stamp within check_interval seconds.
+    def __init__(self, check_interval=5.0):
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._tables = {}
+        self._versions = {}
+        self._checked_at = 0.0
+        # Bumped on every eviction, so a version check that raced it is redone
+        self._generation = 0
+
+    def init_app(self, app):
+        self.check_interval = app.config.get('SETTINGS_CACHE_CHECK_INTERVAL', self.check_interval)
+        app.extensions['reference_data'] = self
+
+    def get(self, table):
+        return self._table(table).records
+
+    def get_by_id(self, table, record_id):
+        return self._table(table).by_id.get(record_id)
+
+    def payload(self, table):
+        # (JSON bytes, strong ETag) for /api/ref/<table>
+        entry = self._table(table)
+        return entry.payload, entry.etag
+
+    def invalidate(self, *tables):
+        # Call before commit so the new version is committed with the change.
+        # This worker drops its copies after the commit, so a concurrent request
+        # cannot reload the old rows in between and keep them.
+        for table in tables:
+            CacheVersion.bump(VERSION_PREFIX + table)
+        db.session.info.setdefault(PENDING_KEY, set()).update(tables)
+
+    def evict(self, tables):
+        # Forces a version check on the next read, which reloads any copy
+        # loaded before the commit
+        with self._lock:
+            self._generation += 1
+            for table in tables:
+                self._tables.pop(table, None)
+            self._checked_at = 0.0
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+            self._versions.clear()
+            self._checked_at = 0.0
+
+    def _table(self, table):
+        record_type, query = TABLES[table]
+        self._check_versions()
+        entry = self._tables.get(table)
+        if entry is None or entry.version != self._versions.get(table, 0):
+            version = self._versions.get(table, 0)
+            records = tuple(record_type(*row) for row in db.session.execute(query()))
+            entry = ReferenceTable(version, records)
+            with self._lock:
+                self._tables[table] = entry
+        return entry
+
+    def _check_versions(self):
+        # One query for all tables' stamps, at most every check_interval seconds
+        now = time.monotonic()
+        if self._checked_at and now - self._checked_at < self.check_interval:
+            return
+        generation = self._generation
+        rows = db.session.execute(
+            db.select(CacheVersion.name, CacheVersion.version)
+            .where(CacheVersion.name.in_([VERSION_PREFIX + table for table in TABLES]))
+        ).all()
+        versions = {name[len(VERSION_PREFIX):]: version for name, version in rows}
+        with self._lock:
+            self._versions = versions
+            if generation == self._generation:
+                self._checked_at = now
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _evict_committed(session):
+    tables = session.info.pop(PENDING_KEY, None)
+    if tables:
+        reference_data.evict(tables)
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+reference_data = ReferenceData()
@@ -0,0 +1,27 @@
+from models import db
+
+
+def upgrade_schema():
+    # db.create_all() only creates missing tables; columns and indexes added to
+    # existing tables after the first deployment have to be created here.
+    # New columns must be nullable (or have a server default) for this to work.
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+
+        columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in columns:
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                with db.engine.begin() as conn:
+                    conn.exec_driver_sql(
+                        f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+                    )
+                print(f"Added column {table.name}.{column.name}")
+
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(db.engine)
+                print(f"Created index {index.name}")
@@ -0,0 +1,226 @@
+import asyncio
+import gc
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from models import db
+
+MODELS = ('threaded', 'prefork', 'async')
+
+logger = logging.getLogger(__name__)
+
+
+class ServerError(Exception):
+    pass
+
+
+def default_workers(model):
+    # Pre-fork: the usual 2 x cores + 1 keeps every core busy while some workers
+    # wait on the database. The other models run one process.
+    return 2 * (os.cpu_count() or 1) + 1 if model == 'prefork' else 1
+
+
+def default_threads(model):
+    cpus = os.cpu_count() or 1
+    if model == 'prefork':
+        return 2
+    # Threads waiting on SQLite or scrypt release the GIL, so a single process
+    # benefits from a few per core
+    return min(32, cpus * 4) if model == 'threaded' else min(32, cpus + 4)
+
+
+def preload(app):
+    # Compiles every template in the parent process, then moves all objects
+    # allocated so far into the GC's permanent generation. Forked workers share
+    # those pages copy-on-write; without the freeze the first collection in
+    # each worker would write to every object and copy them all.
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    gc.collect()
+    gc.freeze()
+    return app
+
+
+def after_fork(app):
+    # Connections opened before the fork must not be shared between processes
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+class Server:
+    # Runs the app under a production WSGI server. Each model needs its server
+    # package, imported only when that model is chosen:
+    #   threaded  waitress: one process, a thread pool; also runs on Windows
+    #   prefork   gunicorn: preloaded master forking `workers` processes with
+    #             `threads` each; kill -HUP the master to restart them gracefully
+    #   async     hypercorn: one asyncio event loop holding the connections
+    #             (HTTP/2 over TLS with certfile/keyfile) and calling the app
+    #             in a pool of `threads`
+    def __init__(self, app, model='threaded', bind='127.0.0.1:8000', workers=None, threads=None,
+                 keepalive=5, graceful_timeout=30, max_requests=0, pidfile=None,
+                 certfile=None, keyfile=None, access_log=False):
+        if model not in MODELS:
+            raise ServerError(f'Unknown server model {model!r}, expected one of {", ".join(MODELS)}')
+        if bool(certfile) != bool(keyfile):
+            raise ServerError('certfile and keyfile must be given together')
+        self.app = app
+        self.model = model
+        self.bind = bind
+        self.workers = workers or default_workers(model)
+        self.threads = threads or default_threads(model)
+        # Seconds an idle keep-alive connection is held open; behind a proxy,
+        # keep it above the proxy's upstream idle timeout
+        self.keepalive = keepalive
+        # Seconds in-flight requests get to finish on shutdown or reload
+        self.graceful_timeout = graceful_timeout
+        # Restart a prefork worker after this many requests (0 = never)
+        self.max_requests = max_requests
+        self.pidfile = pidfile
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.access_log = access_log
+
+    def describe(self):
+        processes = f'{self.workers} process(es) x ' if self.model == 'prefork' else ''
+        return f'{self.model} server on {self.bind}: {processes}{self.threads} thread(s), keep-alive {self.keepalive}s'
+
+    def run(self):
+        if self.model != 'prefork' and self.workers > 1:
+            raise ServerError(f'The {self.model} model runs one process; use --model prefork for more workers')
+        preload(self.app)
+        getattr(self, f'_run_{self.model}')()
+
+    def _run_threaded(self):
+        try:
+            from waitress import create_server, wasyncore
+            from waitress.channel import HTTPChannel
+            from waitress.server import BaseWSGIServer
+        except ImportError:
+            raise ServerError('The threaded model requires waitress (pip install waitress)') from None
+        if self.certfile:
+            raise ServerError('The threaded model does not serve TLS; terminate it at a reverse proxy')
+        if self.access_log:
+            logger.warning('waitress writes no access log; use the prefork or async model for one')
+        server = create_server(self.app, listen=self.bind, threads=self.threads,
+                               channel_timeout=self.keepalive, ident='CeilApp')
+        if self.pidfile:
+            self._write_pidfile()
+        # One listener is the server itself, several share its socket map
+        socket_map = getattr(server, 'map', None) or server._map
+        poll = dict(map=socket_map, use_poll=server.adj.asyncore_use_poll, count=1)
+
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+        while not stopping:
+            try:
+                wasyncore.loop(timeout=server.adj.asyncore_loop_timeout, **poll)
+            except KeyboardInterrupt:
+                break
+
+        # waitress would give running requests a fixed 5 seconds and stop
+        # writing responses once its loop exits. Instead, stop accepting, close
+        # idle keep-alive connections and keep the loop running until the
+        # others have sent their responses or graceful_timeout has passed.
+        deadline = time.monotonic() + self.graceful_timeout
+        for dispatcher in list(socket_map.values()):
+            if isinstance(dispatcher, BaseWSGIServer):
+                wasyncore.dispatcher.close(dispatcher)
+        while time.monotonic() < deadline:
+            busy = False
+            for channel in list(socket_map.values()):
+                if not isinstance(channel, HTTPChannel):
+                    continue
+                if channel.requests or channel.request is not None or channel.total_outbufs_len:
+                    busy = True
+                else:
+                    channel.handle_close()
+            if not busy:
+                break
+            try:
+                wasyncore.loop(timeout=0.1, **poll)
+            except KeyboardInterrupt:
+                break
+        server.task_dispatcher.shutdown(timeout=max(0.0, deadline - time.monotonic()))
+        wasyncore.close_all(socket_map)
+
+    def _run_prefork(self):
+        try:
+            from gunicorn.app.base import BaseApplication
+        except ImportError:
+            raise ServerError('The prefork model requires gunicorn (pip install gunicorn), '
+                              'which runs on Linux and macOS') from None
+
+        settings = {
+            'bind': [self.bind],
+            'workers': self.workers,
+            # gthread workers honour keep-alive; the sync worker closes every connection
+            'worker_class': 'gthread',
+            'threads': self.threads,
+            'keepalive': self.keepalive,
+            'graceful_timeout': self.graceful_timeout,
+            'max_requests': self.max_requests,
+            'max_requests_jitter': self.max_requests // 10,
+            # The app is built once in the master, before forking
+            'preload_app': True,
+            'pidfile': self.pidfile,
+            'certfile': self.certfile,
+            'keyfile': self.keyfile,
+            'accesslog': '-' if self.access_log else None,
+            'post_fork': lambda arbiter, worker: after_fork(self.app),
+        }
+        app = self.app
+
+        class Application(BaseApplication):
+            def load_config(self):
+                for key, value in settings.items():
+                    self.cfg.set(key, value)
+
+            def load(self):
+                return app
+
+        Application().run()
+
+    def _run_async(self):
+        try:
+            from hypercorn.asyncio import serve
+            from hypercorn.config import Config
+        except ImportError:
+            raise ServerError('The async model requires hypercorn (pip install hypercorn)') from None
+
+        config = Config()
+        config.bind = [self.bind]
+        config.keep_alive_timeout = self.keepalive
+        config.graceful_timeout = self.graceful_timeout
+        config.certfile = self.certfile
+        config.keyfile = self.keyfile
+        # Through the root logger, like the rest of the app
+        config.errorlog = logging.getLogger('hypercorn.error')
+        if self.access_log:
+            config.accesslog = '-'
+        if self.pidfile:
+            self._write_pidfile()
+
+        async def main():
+            loop = asyncio.get_running_loop()
+            # The WSGI app runs in the loop's default executor
+            loop.set_default_executor(ThreadPoolExecutor(self.threads, thread_name_prefix='wsgi'))
+            stop = asyncio.Event()
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    loop.add_signal_handler(signum, stop.set)
+                except NotImplementedError:
+                    # Windows: Ctrl+C raises KeyboardInterrupt instead
+                    pass
+            await serve(self.app, config, mode='wsgi', shutdown_trigger=stop.wait)
+
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
+
+    def _write_pidfile(self):
+        with open(self.pidfile, 'w') as f:
+            f.write(f'{os.getpid()}\n')
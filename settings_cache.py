@@ -0,0 +1,84 @@
+import threading
+import time
+from collections import namedtuple
+
+from models import db, ApplicationSettings, CacheVersion
+
+SETTINGS_VERSION_KEY = 'settings'
+
+# Plain immutable copy of the settings row, safe to share across requests and threads
+SettingsSnapshot = namedtuple(
+    'SettingsSnapshot', [column.name for column in ApplicationSettings.__table__.columns]
+)
+
+
+class SettingsCache:
+    def __init__(self, check_interval=5.0):
+        # Seconds between version checks against the database
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.version_checks = 0
+
+    def init_app(self, app):
+        self.check_interval = app.config.get('SETTINGS_CACHE_CHECK_INTERVAL', self.check_interval)
+        app.extensions['settings_cache'] = self
+
+    def get(self):
+        if self._version is not None and time.monotonic() - self._checked_at < self.check_interval:
+            self.hits += 1
+            return self._snapshot
+
+        with self._lock:
+            version = CacheVersion.current(SETTINGS_VERSION_KEY)
+            self.version_checks += 1
+            if version == self._version:
+                self._checked_at = time.monotonic()
+                self.hits += 1
+            else:
+                self._load(version)
+                self.misses += 1
+            return self._snapshot
+
+    @property
+    def version(self):
+        # Current version stamp, checked against the database like get()
+        self.get()
+        return self._version
+
+    def refresh(self):
+        # Called after a committed settings change in this worker
+        with self._lock:
+            self._load(CacheVersion.current(SETTINGS_VERSION_KEY))
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+            self._version = None
+            self._checked_at = 0.0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'version_checks': self.version_checks,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            'version': self._version,
+        }
+
+    def _load(self, version):
+        # Core select so the snapshot is never bound to a SQLAlchemy session
+        row = db.session.execute(
+            db.select(ApplicationSettings.__table__).order_by(ApplicationSettings.id).limit(1)
+        ).mappings().first()
+        self._snapshot = SettingsSnapshot(**row) if row else None
+        self._version = version
+        self._checked_at = time.monotonic()
+
+
+settings_cache = SettingsCache()
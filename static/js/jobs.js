@@ -0,0 +1,22 @@
+// Polls a background job's status URL until it has finished.
+// onUpdate(job) is called on every poll; resolves with the finished job.
+function waitForJob(statusUrl, onUpdate, interval) {
+    return new Promise(function(resolve, reject) {
+        function poll() {
+            fetch(statusUrl)
+                .then(response => response.json())
+                .then(job => {
+                    if (onUpdate) {
+                        onUpdate(job);
+                    }
+                    if (job.status === 'succeeded' || job.status === 'failed') {
+                        resolve(job);
+                    } else {
+                        setTimeout(poll, interval || 1000);
+                    }
+                })
+                .catch(reject);
+        }
+        poll();
+    });
+}
@@ -0,0 +1,28 @@
+// Fills <select data-ref="/api/ref/<table>"> elements from the reference-data
+// endpoints. Each URL is fetched once per page; the browser revalidates it
+// with its ETag. Optional attributes: data-selected (value to preselect) and
+// data-ref-label (record field shown as the option text, default "name").
+var referenceData = {};
+
+function loadReference(url) {
+    if (!referenceData[url]) {
+        referenceData[url] = fetch(url, {credentials: 'same-origin'}).then(response => response.json());
+    }
+    return referenceData[url];
+}
+
+function fillReferenceSelect(select) {
+    return loadReference(select.dataset.ref).then(records => {
+        var label = select.dataset.refLabel || 'name';
+        var selected = select.dataset.selected;
+        records.forEach(record => {
+            var option = new Option(record[label], record.id);
+            option.selected = String(record.id) === selected;
+            select.add(option);
+        });
+    });
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    document.querySelectorAll('select[data-ref]').forEach(fillReferenceSelect);
+});
@@ -0,0 +1,27 @@
+// Polls the waiting-room status endpoint from the element marked
+// data-waiting-room="<status url>", shows the visitor's place in line and
+// moves on to data-next once they are admitted. The server says how long to
+// wait before the next poll.
+function pollWaitingRoom(room) {
+    fetch(room.dataset.waitingRoom, {credentials: 'same-origin', cache: 'no-store'})
+        .then(response => response.ok ? response.json() : {admitted: true})
+        .then(status => {
+            if (status.admitted) {
+                window.location.assign(room.dataset.next);
+                return;
+            }
+            room.querySelector('[data-waiting-room-position]').textContent = status.position;
+            var minutes = Math.ceil(status.wait_seconds / 60);
+            room.querySelector('[data-waiting-room-wait]').textContent =
+                minutes > 1 ? 'Estimated wait: about ' + minutes + ' minutes.' : 'Estimated wait: less than a minute.';
+            setTimeout(() => pollWaitingRoom(room), status.poll_after * 1000);
+        })
+        .catch(() => setTimeout(() => pollWaitingRoom(room), 5000));
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+    var room = document.querySelector('[data-waiting-room]');
+    if (room) {
+        pollWaitingRoom(room);
+    }
+});
@@ -0,0 +1,47 @@
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+
+class TemplateCache:
+    # Compiled templates are kept as Jinja bytecode files shared by every
+    # worker on the host, so a fresh worker loads each template instead of
+    # parsing and compiling it. Entries are keyed on the template source and
+    # ignored once it changes. `flask compile-templates` fills the cache at
+    # deploy time.
+    def __init__(self, directory=None, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self.app = None
+
+    def init_app(self, app):
+        self.directory = app.config.get('TEMPLATE_CACHE_DIR') or os.path.join(app.instance_path, 'jinja_cache')
+        self.enabled = app.config.get('TEMPLATE_CACHE', self.enabled)
+        if self.enabled:
+            os.makedirs(self.directory, exist_ok=True)
+            app.jinja_env.bytecode_cache = FileSystemBytecodeCache(self.directory)
+        self.app = app
+        app.extensions['template_cache'] = self
+
+    def template_names(self):
+        return sorted(name for name in self.app.jinja_env.list_templates() if name.endswith('.html'))
+
+    def compile_all(self, log=print):
+        # Compiles every template into the bytecode cache. Returns {name: ms}.
+        env = self.app.jinja_env
+        timings = {}
+        for name in self.template_names():
+            started = time.perf_counter()
+            source, filename, _ = env.loader.get_source(env, name)
+            code = env.compile(source, name, filename)
+            if env.bytecode_cache is not None:
+                bucket = env.bytecode_cache.get_bucket(env, name, filename, source)
+                bucket.code = code
+                env.bytecode_cache.set_bucket(bucket)
+            timings[name] = (time.perf_counter() - started) * 1000
+            log(f'{name:<24} {timings[name]:7.1f} ms')
+        return timings
+
+
+template_cache = TemplateCache()
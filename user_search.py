@@ -0,0 +1,198 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy.exc import OperationalError
+
+from models import db, User, normalize_search
+
+FTS_TABLE = 'user_search'
+# The trigram tokenizer only matches terms of three characters or more
+FTS_MIN_LENGTH = 3
+# Upper bound for prefix range scans on the normalised columns
+PREFIX_UPPER = '\U0010ffff'
+
+FTS_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        username, email, name, content='user', content_rowid='id', tokenize='trigram'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON "user" BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, username, email, name)
+        VALUES (new.id, new.username, new.email, new.name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON "user" BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, username, email, name)
+        VALUES ('delete', old.id, old.username, old.email, old.name);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF username, email, name ON "user" BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, username, email, name)
+        VALUES ('delete', old.id, old.username, old.email, old.name);
+        INSERT INTO {FTS_TABLE}(rowid, username, email, name)
+        VALUES (new.id, new.username, new.email, new.name);
+    END""",
+]
+
+
+class UserSearch:
+    def __init__(self, use_fts=True, count_ttl=60.0, count_cache_size=256):
+        self.use_fts = use_fts
+        # Totals are shown as approximate and refreshed at most every count_ttl seconds
+        self.count_ttl = count_ttl
+        self.count_cache_size = count_cache_size
+        self._fts_available = None
+        self._lock = threading.Lock()
+        self._counts = OrderedDict()
+
+    def init_app(self, app):
+        self.use_fts = app.config.get('USER_SEARCH_FTS', self.use_fts)
+        self.count_ttl = app.config.get('USER_COUNT_CACHE_TTL', self.count_ttl)
+        app.extensions['user_search'] = self
+
+    def install(self):
+        # Backfill normalised columns for rows created before they existed.
+        # Walks ids in order, so a row whose username normalises to NULL is
+        # visited once rather than selected again on every pass.
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                db.select(User.id, User.username, User.email, User.name)
+                .where(User.username_norm.is_(None), User.id > last_id)
+                .order_by(User.id).limit(1000)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            db.session.execute(db.update(User), [
+                {
+                    'id': row.id,
+                    'username_norm': normalize_search(row.username),
+                    'email_norm': normalize_search(row.email),
+                    'name_norm': normalize_search(row.name),
+                }
+                for row in rows
+            ])
+            db.session.commit()
+
+        if not self.use_fts or db.engine.dialect.name != 'sqlite':
+            return
+        created = not db.inspect(db.engine).has_table(FTS_TABLE)
+        try:
+            with db.engine.begin() as conn:
+                for statement in FTS_SCHEMA:
+                    conn.exec_driver_sql(statement)
+                if created:
+                    conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        except OperationalError as e:
+            # SQLite built without FTS5 or the trigram tokenizer: prefix search only
+            print(f"Full-text user search unavailable: {e}")
+            return
+        self._fts_available = None
+        if created:
+            print(f"Created full-text index {FTS_TABLE}")
+
+    @property
+    def fts_available(self):
+        if self._fts_available is None:
+            self._fts_available = (
+                self.use_fts
+                and db.engine.dialect.name == 'sqlite'
+                and db.inspect(db.engine).has_table(FTS_TABLE)
+            )
+        return self._fts_available
+
+    def filter(self, query, search=None, role_id=None, status=None):
+        if search:
+            query = query.where(self._search_clause(search))
+        if role_id:
+            query = query.where(User.role_id == role_id)
+        if status == 'active':
+            query = query.where(User.is_active == True)
+        elif status == 'inactive':
+            query = query.where(User.is_active == False)
+        return query
+
+    def page(self, query, after=None, before=None, per_page=10):
+        # Keyset pagination, newest first, on (created_at, id).
+        # Returns the rows plus cursors for the newer and older neighbouring pages.
+        if before:
+            created_at, user_id = self.decode_cursor(before)
+            rows = db.session.execute(
+                query.where(db.or_(
+                    User.created_at > created_at,
+                    db.and_(User.created_at == created_at, User.id > user_id)
+                )).order_by(User.created_at.asc(), User.id.asc()).limit(per_page + 1)
+            ).scalars().all()
+            has_newer = len(rows) > per_page
+            rows = list(reversed(rows[:per_page]))
+            newer = self.encode_cursor(rows[0]) if has_newer and rows else None
+            older = self.encode_cursor(rows[-1]) if rows else None
+            return rows, newer, older
+
+        if after:
+            created_at, user_id = self.decode_cursor(after)
+            query = query.where(db.or_(
+                User.created_at < created_at,
+                db.and_(User.created_at == created_at, User.id < user_id)
+            ))
+        rows = db.session.execute(
+            query.order_by(User.created_at.desc(), User.id.desc()).limit(per_page + 1)
+        ).scalars().all()
+        has_older = len(rows) > per_page
+        rows = rows[:per_page]
+        newer = self.encode_cursor(rows[0]) if after and rows else None
+        older = self.encode_cursor(rows[-1]) if has_older else None
+        return rows, newer, older
+
+    def approximate_count(self, query, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is not None and entry[0] > now:
+                self._counts.move_to_end(key)
+                return entry[1]
+
+        total = db.session.execute(
+            query.with_only_columns(db.func.count(User.id)).order_by(None)
+        ).scalar()
+        with self._lock:
+            self._counts[key] = (now + self.count_ttl, total)
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.count_cache_size:
+                self._counts.popitem(last=False)
+        return total
+
+    def clear_counts(self):
+        with self._lock:
+            self._counts.clear()
+
+    @staticmethod
+    def encode_cursor(user):
+        return f'{user.created_at.isoformat()},{user.id}'
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            created_at, user_id = cursor.rsplit(',', 1)
+            return datetime.fromisoformat(created_at), int(user_id)
+        except ValueError:
+            raise ValueError(f'Invalid cursor: {cursor!r}') from None
+
+    def _search_clause(self, search):
+        if self.fts_available and len(search) >= FTS_MIN_LENGTH:
+            # Substring match through the trigram index, quoted as a single FTS phrase
+            phrase = '"' + search.replace('"', '""') + '"'
+            matches = db.text(
+                f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :phrase'
+            ).bindparams(phrase=phrase).columns(db.column('rowid'))
+            return User.id.in_(matches)
+
+        # Prefix match as a range scan, which every backend can serve from an index
+        term = normalize_search(search)
+        return db.or_(*[
+            db.and_(column >= term, column < term + PREFIX_UPPER)
+            for column in (User.username_norm, User.email_norm, User.name_norm)
+        ])
+
+
+user_search = UserSearch()
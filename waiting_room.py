@@ -0,0 +1,266 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+
+from flask import request, redirect, url_for, current_app, after_this_request
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+
+from admission import admission
+
+COOKIE_NAME = 'ceil_waiting_room'
+
+
+class WaitingRoomError(Exception):
+    pass
+
+
+def _advance(issued, serving, updated, now, rate, burst):
+    # The serving number moves up `rate` tickets a second, and runs at most
+    # `burst` tickets ahead of the last one issued, so after a quiet spell
+    # the next `burst` visitors go straight through
+    return min(serving + (now - updated) * rate, issued + burst)
+
+
+# (issued, serving, updated) of an empty queue: updated at the epoch, so the
+# first visitors find the serving number a full burst ahead
+EMPTY = (0, 0.0, 0.0)
+
+
+class MemoryQueue:
+    # Ticket counter for a single worker process
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = EMPTY
+
+    def take(self, rate, burst):
+        now = time.time()
+        with self._lock:
+            issued, serving, updated = self._state
+            serving = _advance(issued, serving, updated, now, rate, burst)
+            self._state = (issued + 1, serving, now)
+        return issued + 1
+
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def clear(self):
+        with self._lock:
+            self._state = EMPTY
+
+
+class SQLiteQueue:
+    # Ticket counter in a small SQLite file shared by every worker on the host,
+    # so tickets are numbered and admitted in one order. Only taking a ticket
+    # writes; positions are computed from the stored row.
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS waiting_room '
+            '(id INTEGER PRIMARY KEY CHECK (id = 1), issued INTEGER NOT NULL, serving REAL NOT NULL, updated REAL NOT NULL)'
+        )
+        conn.execute('INSERT OR IGNORE INTO waiting_room VALUES (1, ?, ?, ?)', EMPTY)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def take(self, rate, burst):
+        now = time.time()
+        conn = self._connection()
+        # One statement: SQLite applies it under the write lock, so concurrent
+        # workers never hand out the same number
+        return conn.execute(
+            'UPDATE waiting_room SET serving = MIN(serving + (? - updated) * ?, issued + ?), '
+            'issued = issued + 1, updated = ? WHERE id = 1 RETURNING issued',
+            (now, rate, burst, now)
+        ).fetchone()[0]
+
+    def state(self):
+        return self._connection().execute('SELECT issued, serving, updated FROM waiting_room WHERE id = 1').fetchone()
+
+    def clear(self):
+        self._connection().execute('UPDATE waiting_room SET issued = ?, serving = ?, updated = ?', EMPTY)
+
+
+class WaitingRoom:
+    # Admission queue in front of expensive forms such as /register. Each
+    # visitor takes a numbered ticket, kept in a signed cookie, and is admitted
+    # once the serving number reaches it; the serving number advances at `rate`
+    # tickets a second, set to what the backend has been measured to sustain.
+    # Waiting visitors see a static page that polls a cheap status endpoint.
+    # Admitted visitors get a pass valid for `pass_ttl` seconds.
+    def __init__(self, rate=0, burst=20, pass_ttl=600, ticket_ttl=3600, hash_wait=10.0, status_ttl=1.0):
+        self.rate = rate
+        self.burst = burst
+        self.pass_ttl = pass_ttl
+        self.ticket_ttl = ticket_ttl
+        # Admitted visitors have waited their turn: they queue this many seconds
+        # for a password hashing slot instead of being refused with a 429
+        self.hash_wait = hash_wait
+        # Seconds a worker reuses the queue state for status polls
+        self.status_ttl = status_ttl
+        self.backend = MemoryQueue()
+        self._lock = threading.Lock()
+        self._state = None
+        self._state_at = 0.0
+        self.tickets = 0
+        self.admitted = 0
+        self.turned_away = 0
+
+    def init_app(self, app):
+        self.rate = app.config.get('WAITING_ROOM_RATE', self.rate)
+        self.burst = app.config.get('WAITING_ROOM_BURST', self.burst)
+        self.pass_ttl = app.config.get('WAITING_ROOM_PASS_TTL', self.pass_ttl)
+        self.ticket_ttl = app.config.get('WAITING_ROOM_TICKET_TTL', self.ticket_ttl)
+        self.hash_wait = app.config.get('WAITING_ROOM_HASH_WAIT', self.hash_wait)
+        backend = app.config.get('WAITING_ROOM_BACKEND') or app.config.get('RATE_LIMIT_BACKEND', 'memory')
+        if backend == 'sqlite':
+            self.backend = SQLiteQueue(
+                app.config.get('WAITING_ROOM_DB') or os.path.join(app.instance_path, 'waiting_room.db')
+            )
+        else:
+            self.backend = MemoryQueue()
+        self._state = None
+        app.extensions['waiting_room'] = self
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def share(self, app, workers):
+        # Tickets are numbered by the queue that issued them, so with several
+        # processes each needs the same queue: per-worker queues admit
+        # workers x rate and compare a ticket with another worker's counter.
+        # Switches to the SQLite queue unless memory was asked for explicitly.
+        if workers < 2 or not self.enabled or not isinstance(self.backend, MemoryQueue):
+            return
+        if app.config.get('WAITING_ROOM_BACKEND') == 'memory':
+            raise WaitingRoomError(f'WAITING_ROOM_BACKEND=memory gives each of the {workers} workers its own '
+                                   'queue; use sqlite or set WAITING_ROOM_RATE=0')
+        app.config['WAITING_ROOM_BACKEND'] = 'sqlite'
+        self.init_app(app)
+
+    def _serializer(self):
+        return URLSafeTimedSerializer(current_app.secret_key, salt='waiting-room')
+
+    def _read_cookie(self):
+        # Returns the cookie's payload, or None if it is missing, forged or expired
+        value = request.cookies.get(COOKIE_NAME)
+        if not value:
+            return None
+        try:
+            payload, signed_at = self._serializer().loads(value, return_timestamp=True)
+        except BadSignature:
+            return None
+        # A pass expires pass_ttl after admission, a ticket ticket_ttl after issue
+        if time.time() - signed_at.timestamp() > (self.pass_ttl if payload.get('pass') else self.ticket_ttl):
+            return None
+        return payload
+
+    def _set_cookie(self, payload):
+        value = self._serializer().dumps(payload)
+        max_age = self.pass_ttl if payload.get('pass') else self.ticket_ttl
+
+        @after_this_request
+        def set_cookie(response):
+            response.set_cookie(COOKIE_NAME, value, max_age=max_age, httponly=True,
+                                samesite='Lax', secure=request.is_secure)
+            return response
+
+    def serving(self, fresh=False):
+        # Highest admitted ticket number and the number of tickets issued. Status
+        # polls reuse the state for status_ttl seconds; it moves on with the clock.
+        now = time.time()
+        with self._lock:
+            if fresh or self._state is None or now - self._state_at > self.status_ttl:
+                self._state = self.backend.state()
+                self._state_at = now
+            issued, serving, updated = self._state
+        return math.floor(_advance(issued, serving, updated, now, self.rate, self.burst)), issued
+
+    def admit(self):
+        # Call at the top of a guarded view. Returns None when the visitor may
+        # go on, or a redirect to the waiting room. Raises RateLimited when the
+        # visitor's address has taken too many tickets.
+        if not self.enabled:
+            return None
+        payload = self._read_cookie() or {}
+        if payload.get('pass'):
+            return None
+        ticket = payload.get('ticket')
+        new = ticket is None
+        if new:
+            # Every ticket goes behind the ones already issued, so a client that
+            # drops its cookie must not be able to push everyone back
+            admission.check('waiting_room_ip', request.remote_addr)
+            ticket = self.backend.take(self.rate, self.burst)
+            with self._lock:
+                self.tickets += 1
+        if ticket <= self.serving(fresh=new)[0]:
+            with self._lock:
+                self.admitted += 1
+            self._set_cookie({'ticket': ticket, 'pass': True})
+            return None
+        if new:
+            self._set_cookie({'ticket': ticket})
+        with self._lock:
+            self.turned_away += 1
+        # 303 so a queued POST comes back as a GET
+        return redirect(url_for('main.waiting_room_page', next=request.path), 303)
+
+    def status(self):
+        # Position of the visitor's ticket, for the waiting-room page to poll
+        payload = self._read_cookie()
+        if payload is None:
+            return None
+        if payload.get('pass') or not self.enabled:
+            return {'admitted': True, 'position': 0, 'wait_seconds': 0, 'poll_after': 0}
+        serving, _ = self.serving()
+        position = max(0, payload['ticket'] - serving)
+        wait_seconds = math.ceil(position / self.rate)
+        return {
+            'admitted': position == 0,
+            'position': position,
+            'wait_seconds': wait_seconds,
+            # Far from the front, poll rarely; near it, every second
+            'poll_after': min(10, max(1, wait_seconds // 4)),
+        }
+
+    def release(self):
+        # Ends the visitor's pass, e.g. once they have registered
+        @after_this_request
+        def delete_cookie(response):
+            response.delete_cookie(COOKIE_NAME)
+            return response
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self._state = None
+
+    def stats(self):
+        serving, issued = self.serving()
+        with self._lock:
+            return {
+                'rate': self.rate,
+                'issued': issued,
+                'serving': serving,
+                'depth': max(0, issued - serving),
+                'tickets': self.tickets,
+                'admitted': self.admitted,
+                'turned_away': self.turned_away,
+            }
+
+
+waiting_room = WaitingRoom()